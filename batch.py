@@ -0,0 +1,183 @@
+import argparse
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from utils import cacheutils, readingutils
+
+# options of main.py which apply to a whole run, the cache of batch.py is shared by all jobs
+UNSUPPORTED_JOB_OPTIONS = ("--profile", "--metrics-json", "--profile-hook", "--no-cache", "--cache-dir", "--cache-size")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Create PSF and PDB files for many Packmol inputs at once")
+
+    parser.add_argument("Inputs", metavar="input", type=str, nargs="*", help="Paths to Packmol input files")
+    parser.add_argument("-m", "--manifest", type=str,
+                        help="File with one job per line, given with the same arguments as for main.py")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="Number of jobs whose output files are written at the same time")
+    parser.add_argument("-o", "--output-dir", type=str,
+                        help="Directory for output files of inputs given on the command line, by default the "
+                             "directory of every input")
+    parser.add_argument("--no-psf", action="store_true", help="Do not write PSF files for inputs from the command line")
+    parser.add_argument("--no-pdb", action="store_true", help="Do not write PDB files for inputs from the command line")
+    parser.add_argument("-t", "--tinker", action="store_true", help="Read .xyz in Tinker analyse format")
+    parser.add_argument("--tinker-connectivity", choices=(readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                                                          readingutils.InputReader.TINKER_CONNECTIVITY_XYZ),
+                        default=readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                        help="Source of bonds, angles and dihedrals of Tinker residues")
+    parser.add_argument("-d", "--drude", action="store_true", help="Create output for polarizable force field")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Write only output files whose inputs changed, for inputs from the command line")
+    parser.add_argument("--validate", action="store_true",
+                        help="Check geometry of systems before writing them, for inputs from the command line")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the cache of parsed residue templates")
+    parser.add_argument("--cache-dir", type=str, default=cacheutils.TemplateCache.default_directory(),
+                        help="Directory of the residue template cache")
+    parser.add_argument("--cache-size", type=int, default=cacheutils.TemplateCache.DEFAULT_MAX_SIZE // 2 ** 20,
+                        help="Maximal size of the residue template cache in MiB")
+
+    return parser
+
+
+def create_jobs(args):
+    # list of (job name, main.py arguments or None, error message)
+    jobs = []
+    job_parser = main.create_parser()
+
+    for input_file_name in args.Inputs:
+        output_directory = args.output_dir or os.path.dirname(input_file_name)
+        output_base = os.path.join(output_directory, os.path.splitext(os.path.basename(input_file_name))[0])
+        job_arguments = [input_file_name]
+        if not args.no_psf:
+            job_arguments += ["-psf", output_base + ".psf"]
+        if not args.no_pdb:
+            job_arguments += ["-pdb", output_base + ".pdb"]
+        if args.tinker:
+            job_arguments += ["-t", "--tinker-connectivity", args.tinker_connectivity]
+        if args.drude:
+            job_arguments.append("-d")
+        if args.incremental:
+            job_arguments.append("--incremental")
+        if args.validate:
+            job_arguments.append("--validate")
+
+        jobs.append((input_file_name, job_parser.parse_args(job_arguments), None))
+
+    if args.manifest:
+        with open(args.manifest, 'r') as manifest_file:
+            for (line_number, line) in enumerate(manifest_file, 1):
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+
+                job_name = "{}:{}".format(args.manifest, line_number)
+                try:
+                    job_args = job_parser.parse_args(shlex.split(line))
+                except SystemExit:
+                    jobs.append((job_name, None, "invalid job arguments: {}".format(line)))
+                    continue
+
+                unsupported = []
+                for option in UNSUPPORTED_JOB_OPTIONS:
+                    destination = option[2:].replace("-", "_")
+                    if getattr(job_args, destination) != job_parser.get_default(destination):
+                        unsupported.append(option)
+
+                if unsupported:
+                    jobs.append((job_name, None, "unsupported option in a manifest job: {}".format(
+                        ", ".join(unsupported))))
+                else:
+                    jobs.append((job_name, job_args, None))
+
+    return jobs
+
+
+def save_job(job_args, system):
+    start = time.perf_counter()
+    succeeded = main.save_outputs(job_args, system)
+    return succeeded, time.perf_counter() - start
+
+
+def run_jobs(jobs, workers, template_cache):
+    # residues are read in this process, so every template is parsed once and shared by all jobs using it,
+    # while output files of already read systems are written by the pool
+    reports = []
+    futures = []
+
+    with ProcessPoolExecutor(max(1, workers)) as executor:
+        for (job_name, job_args, message) in jobs:
+            report = {"job": job_name, "succeeded": False, "read_time": 0.0, "write_time": 0.0, "message": message}
+            reports.append(report)
+            if job_args is None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                reader = main.create_reader(job_args, template_cache)
+                reader.parse_packmol_input()
+                (outdated_args, fingerprints) = main.select_outdated_outputs(job_args, reader)
+                if job_args.incremental and not fingerprints:
+                    report["succeeded"] = True
+                    report["message"] = "up to date"
+                    continue
+                system = reader.read_xyz_data()
+                if job_args.validate and not main.validate_system(job_args, system):
+                    report["message"] = "geometry validation failed, see messages above"
+                    continue
+            except Exception as error:
+                report["message"] = "{}: {}".format(type(error).__name__, error)
+                continue
+            finally:
+                report["read_time"] = time.perf_counter() - start
+
+            futures.append((report, fingerprints, executor.submit(save_job, outdated_args, system)))
+
+        for (report, fingerprints, future) in futures:
+            try:
+                (succeeded, write_time) = future.result()
+                report["succeeded"] = succeeded
+                report["write_time"] = write_time
+                if succeeded:
+                    for fingerprint in fingerprints:
+                        fingerprint.record()
+                else:
+                    report["message"] = "output files were not written, see messages above"
+            except Exception as error:
+                report["message"] = "{}: {}".format(type(error).__name__, error)
+
+    return reports
+
+
+def print_reports(reports):
+    for report in reports:
+        print("{:8} {}  read {:.3f} s  write {:.3f} s{}".format("[OK]" if report["succeeded"] else "[FAILED]",
+                                                                report["job"],
+                                                                report["read_time"],
+                                                                report["write_time"],
+                                                                "  " + report["message"] if report["message"] else ""))
+
+    failed = len([report for report in reports if not report["succeeded"]])
+    print("{} jobs, {} failed".format(len(reports), failed))
+
+
+def batch():
+    args = create_parser().parse_args()
+
+    backing_cache = None
+    if not args.no_cache:
+        backing_cache = cacheutils.TemplateCache(args.cache_dir, args.cache_size * 2 ** 20)
+
+    reports = run_jobs(create_jobs(args), args.workers, cacheutils.MemoryTemplateCache(backing_cache))
+    print_reports(reports)
+
+    if not all(report["succeeded"] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    batch()
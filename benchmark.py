@@ -0,0 +1,187 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+from utils import metricsutils, readingutils, savingutils, syntheticutils
+
+CASES = ("default", "default-drude", "tinker", "tinker-drude")
+COMPONENTS = ("read", "psf", "pdb")
+DEFAULT_SIZES = (1000, 10000, 100000)
+DEFAULT_TOLERANCE = 0.2
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description="Measure throughput and peak memory of reading residues and writing "
+                                                 "PSF and PDB files for synthetic systems of growing size")
+
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Approximate numbers of atoms of generated systems, without Drude particles")
+    parser.add_argument("-c", "--cases", choices=CASES, nargs="+", default=list(CASES),
+                        help="Input formats, with or without Drude particles")
+    parser.add_argument("--residue-atoms", type=int, default=syntheticutils.DEFAULT_RESIDUE_ATOMS,
+                        help="Number of atoms of every generated residue")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of timed runs of every component, the fastest one is reported")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Do not measure peak memory, which needs one more, much slower run of every component")
+    parser.add_argument("--data-dir", type=str,
+                        help="Directory for generated inputs, reused by later runs, by default a temporary one")
+    parser.add_argument("--save-baseline", type=str, help="Save results as a baseline to a JSON file")
+    parser.add_argument("--baseline", type=str, help="Compare results with a baseline saved before")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed relative loss of throughput or growth of peak memory compared to the baseline")
+
+    return parser
+
+
+def result_key(case, size, component):
+    return "{}/{}/{}".format(case, size, component)
+
+
+def prepare_input(data_directory, case, size, residue_atoms):
+    # inputs depend only on the format, with and without Drude particles the same files are read
+    tinker_format = case.startswith("tinker")
+    directory = os.path.join(data_directory, "{}-{}-{}".format("tinker" if tinker_format else "default", size,
+                                                                residue_atoms))
+    packmol_file_name = os.path.join(directory, syntheticutils.PACKMOL_FILE_NAME)
+    if not os.path.exists(os.path.join(directory, syntheticutils.SYSTEM_FILE_NAME)):
+        syntheticutils.generate_system(directory, size, tinker_format, residue_atoms)
+
+    return packmol_file_name
+
+
+def run_component(component, case, packmol_file_name, output_directory, system, profiler):
+    # returns the system read by the reader, savers use the one read before
+    with profiler.stage(component):
+        if component == "read":
+            reader = readingutils.InputReader(packmol_file_name, case.startswith("tinker"), case.endswith("drude"))
+            reader.parse_packmol_input()
+            return reader.read_xyz_data()
+
+        messages = io.StringIO()
+        with contextlib.redirect_stdout(messages):
+            if component == "psf":
+                saver = savingutils.PSFSaver(os.path.join(output_directory, "system.psf"), system)
+            else:
+                saver = savingutils.PDBSaver(os.path.join(output_directory, "system.pdb"), system)
+            succeeded = saver.save_to_file()
+
+    if not succeeded:
+        raise RuntimeError("{} of {} failed: {}".format(component, packmol_file_name, messages.getvalue().strip()))
+
+    return system
+
+
+def measure_component(component, case, packmol_file_name, output_directory, system, repeat, trace_memory):
+    wall_times = []
+    for _ in range(0, max(1, repeat)):
+        profiler = metricsutils.Profiler()
+        system = run_component(component, case, packmol_file_name, output_directory, system, profiler)
+        wall_times.append(profiler.stages[0].wall_time)
+
+    peak_memory = None
+    if trace_memory:
+        profiler = metricsutils.Profiler(trace_memory=True)
+        profiler.start()
+        try:
+            run_component(component, case, packmol_file_name, output_directory, system, profiler)
+        finally:
+            profiler.stop()
+        peak_memory = profiler.stages[0].peak_memory
+
+    return system, min(wall_times), peak_memory
+
+
+def run_benchmarks(sizes, cases, data_directory, residue_atoms=syntheticutils.DEFAULT_RESIDUE_ATOMS, repeat=3,
+                   trace_memory=True):
+    # throughput is given in atoms, Drude particles included, per second
+    results = {}
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        for size in sizes:
+            for case in cases:
+                packmol_file_name = prepare_input(data_directory, case, size, residue_atoms)
+                system = None
+
+                for component in COMPONENTS:
+                    (system, wall_time, peak_memory) = measure_component(component, case, packmol_file_name,
+                                                                         output_directory, system, repeat,
+                                                                         trace_memory)
+                    atoms_number = system.atoms_number_with_drude
+                    results[result_key(case, size, component)] = {
+                        "atoms": atoms_number,
+                        "wall_time": wall_time,
+                        "throughput": atoms_number / wall_time if wall_time > 0 else None,
+                        "peak_memory": peak_memory
+                    }
+
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # list of (key, metric, baseline value, current value) exceeding the tolerance
+    regressions = []
+
+    for (key, result) in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+
+        if None not in (result["throughput"], reference.get("throughput")) and \
+                result["throughput"] < reference["throughput"] * (1 - tolerance):
+            regressions.append((key, "throughput", reference["throughput"], result["throughput"]))
+        if None not in (result["peak_memory"], reference.get("peak_memory")) and \
+                result["peak_memory"] > reference["peak_memory"] * (1 + tolerance):
+            regressions.append((key, "peak_memory", reference["peak_memory"], result["peak_memory"]))
+
+    return regressions
+
+
+def save_results(file_name, results):
+    with open(file_name, 'w') as json_file:
+        json.dump({"results": results}, json_file, indent=2, sort_keys=True)
+
+
+def load_results(file_name):
+    with open(file_name, 'r') as json_file:
+        return json.load(json_file)["results"]
+
+
+def print_results(results):
+    print("{:<32} {:>10} {:>10} {:>14} {:>12}".format("benchmark", "atoms", "time [s]", "atoms/s", "peak [MiB]"))
+    for (key, result) in results.items():
+        throughput = "-" if result["throughput"] is None else "{:.0f}".format(result["throughput"])
+        peak_memory = "-" if result["peak_memory"] is None else "{:.2f}".format(result["peak_memory"] / 2 ** 20)
+        print("{:<32} {:>10} {:>10.3f} {:>14} {:>12}".format(key, result["atoms"], result["wall_time"], throughput,
+                                                            peak_memory))
+
+
+def benchmark():
+    args = create_parser().parse_args()
+
+    if args.data_dir:
+        results = run_benchmarks(args.sizes, args.cases, args.data_dir, args.residue_atoms, args.repeat,
+                                 not args.no_memory)
+    else:
+        with tempfile.TemporaryDirectory() as data_directory:
+            results = run_benchmarks(args.sizes, args.cases, data_directory, args.residue_atoms, args.repeat,
+                                     not args.no_memory)
+
+    print_results(results)
+    if args.save_baseline:
+        save_results(args.save_baseline, results)
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, load_results(args.baseline), args.tolerance)
+        for (key, metric, reference, value) in regressions:
+            print("[REGRESSION] {} {}: baseline {:.6g}, now {:.6g}".format(key, metric, reference, value))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
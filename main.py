@@ -1,33 +1,272 @@
 import argparse
+import importlib
+import sys
 
-from utils import readingutils, savingutils
+from utils import cacheutils, fingerprintutils, metricsutils, model, readingutils, savingutils, validationutils
 
 
-def main():
+def positive_distance(value):
+    distance = float(value)
+    if not 0 < distance < float('inf'):
+        raise argparse.ArgumentTypeError("distance must be a positive number, got '{}'".format(value))
+
+    return distance
+
+
+def non_negative_distance(value):
+    distance = float(value)
+    if not 0 <= distance < float('inf'):
+        raise argparse.ArgumentTypeError("distance must be a non-negative number, got '{}'".format(value))
+
+    return distance
+
+
+class BondCutoffAction(argparse.Action):
+    # collects (symbol, symbol, distance) of every --bond-cutoff
+    def __call__(self, parser, namespace, values, option_string=None):
+        (first_symbol, second_symbol, distance) = values
+        try:
+            distance = positive_distance(distance)
+        except (ValueError, argparse.ArgumentTypeError):
+            parser.error("argument {}: distance must be a positive number, got '{}'".format(option_string, distance))
+
+        setattr(namespace, self.dest, (getattr(namespace, self.dest) or []) + [(first_symbol, second_symbol, distance)])
+
+
+def create_parser():
     parser = argparse.ArgumentParser(description="Create PSF and PDB file from Packmol/Tinker output")
 
     parser.add_argument("Input", metavar="input", type=str, help='Path to Packmol input file')
     parser.add_argument("-psf", type=str, help="Output PSF file name")
     parser.add_argument("-pdb", type=str, help="Output PDB file name")
+    parser.add_argument("-coor", type=str, help="Output NAMD binary coordinates file name")
+    parser.add_argument("-dcd", type=str, help="Output DCD trajectory file name")
+    parser.add_argument("--trajectory", type=str,
+                        help="Multi-frame .xyz converted to the DCD file, by default the Packmol output")
     parser.add_argument("-t", "--tinker", action="store_true", help="Read .xyz in Tinker analyse format")
+    parser.add_argument("--tinker-connectivity", choices=(readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                                                          readingutils.InputReader.TINKER_CONNECTIVITY_XYZ),
+                        default=readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                        help="Read bonds, angles and dihedrals of Tinker residues from .conn files or derive them from "
+                             "connectivity columns of Tinker .xyz files")
     parser.add_argument("-d", "--drude", action="store_true", help="Create output for polarizable force field")
+    parser.add_argument("--pdb-numbering", choices=(savingutils.PDBSaver.NUMBERING_HYBRID36,
+                                                    savingutils.PDBSaver.NUMBERING_WRAP),
+                        default=savingutils.PDBSaver.NUMBERING_HYBRID36,
+                        help="Numbering of atoms and residues exceeding PDB field widths")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the cache of parsed residue templates")
+    parser.add_argument("--cache-dir", type=str, default=cacheutils.TemplateCache.default_directory(),
+                        help="Directory of the residue template cache")
+    parser.add_argument("--cache-size", type=int, default=cacheutils.TemplateCache.DEFAULT_MAX_SIZE // 2 ** 20,
+                        help="Maximal size of the residue template cache in MiB")
+    parser.add_argument("--compression", choices=savingutils.OutputTarget.COMPRESSIONS,
+                        default=savingutils.OutputTarget.COMPRESSION_AUTO,
+                        help="Compression of output files, by default chosen by their suffixes (.gz, .bz2, .xz)")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="Write PSF and PDB files at the same time, keeping neither of them if one fails")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of worker processes writing PSF and PDB files in parallel")
+    parser.add_argument("--buffer-size", type=int, default=savingutils.FileSaver.DEFAULT_BUFFER_SIZE // 2 ** 10,
+                        help="Size in KiB of rendered output collected in memory before it is written to a file")
+    parser.add_argument("--bond-threshold", type=positive_distance, default=model.Molecule.DEFAULT_BOND_THRESHOLD,
+                        help="Maximal distance between bonded atoms used when bonds are detected automatically")
+    parser.add_argument("--bond-cutoff", nargs=3, action=BondCutoffAction, metavar=("SYMBOL1", "SYMBOL2", "DISTANCE"),
+                        help="Bond detection threshold for a given pair of element symbols, can be repeated")
+    parser.add_argument("--validate", action="store_true",
+                        help="Check lengths of bonds and distances between residues in the Packmol output before "
+                             "writing output files, which are not written when the check fails")
+    parser.add_argument("--bond-tolerance", type=non_negative_distance, default=validationutils.DEFAULT_BOND_TOLERANCE,
+                        help="Allowed difference in angstroms between bond lengths in the system and in residue files")
+    parser.add_argument("--clash-distance", type=positive_distance, default=validationutils.DEFAULT_CLASH_DISTANCE,
+                        help="Minimal distance in angstroms between atoms of different residues")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Write only output files whose inputs or options changed since they were last written")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print wall time, CPU time, peak traced memory and counts of every stage")
+    parser.add_argument("--metrics-json", type=str, help="Save metrics of every stage to a JSON file")
+    parser.add_argument("--profile-hook", type=str, metavar="MODULE:FUNCTION",
+                        help="Function called with (\"start\" or \"end\", stage name) around every stage")
 
-    args = parser.parse_args()
-    input_file_name = args.Input
+    return parser
 
-    reader = readingutils.InputReader(input_file_name, args.tinker, args.drude)
-    reader.parse_packmol_input()
-    system = reader.read_xyz_data()
 
-    psf_file_name = args.psf
-    if psf_file_name:
-        psf_saver = savingutils.PSFSaver(psf_file_name, system)
-        psf_saver.save_to_file()
+def create_profiler(args, parser):
+    if not (args.profile or args.metrics_json or args.profile_hook):
+        return None
+
+    hook = None
+    if args.profile_hook:
+        hook = load_profile_hook(args.profile_hook, parser)
+
+    return metricsutils.Profiler(trace_memory=bool(args.profile or args.metrics_json), hook=hook)
+
+
+def load_profile_hook(value, parser):
+    # wrong values end the program with a usage message, like other invalid arguments
+    (module_name, separator, function_name) = value.partition(":")
+    if not (module_name and separator and function_name):
+        parser.error("argument --profile-hook: expected MODULE:FUNCTION, got '{}'".format(value))
+
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as error:
+        parser.error("argument --profile-hook: cannot import module {}: {}".format(module_name, error))
+
+    hook = getattr(module, function_name, None)
+    if not callable(hook):
+        parser.error("argument --profile-hook: module {} has no function {}".format(module_name, function_name))
+
+    return hook
+
+
+def create_template_cache(args):
+    if args.no_cache:
+        return None
+
+    return cacheutils.TemplateCache(args.cache_dir, args.cache_size * 2 ** 20)
+
+
+def create_reader(args, template_cache, profiler=None):
+    bond_cutoffs = {}
+    for (first_symbol, second_symbol, distance) in args.bond_cutoff or []:
+        bond_cutoffs[(first_symbol, second_symbol)] = distance
+
+    return readingutils.InputReader(args.Input, args.tinker, args.drude, args.bond_threshold, bond_cutoffs,
+                                    template_cache, args.tinker_connectivity, profiler)
+
+
+def output_fingerprints(args, reader):
+    # fingerprint of every requested output file with all input files and options it depends on,
+    # the PSF file does not depend on coordinates of the system
+    residue_file_names = []
+    for (xyz_file_name, molecule_count) in reader.xyz_data:
+        residue_file_names.extend(reader.residue_file_names(xyz_file_name))
+    topology = (reader.xyz_data, reader.topology_options())
+    coordinates_file_names = residue_file_names + [reader.packmol_output_name]
 
+    inputs = {
+        "psf": (residue_file_names, topology),
+        "pdb": (coordinates_file_names, (topology, args.pdb_numbering)),
+        "coor": (coordinates_file_names, topology),
+        "dcd": (residue_file_names + [args.trajectory or reader.packmol_output_name], topology)
+    }
+
+    fingerprints = {}
+    for (output_format, (input_file_names, options)) in inputs.items():
+        output_file_name = getattr(args, output_format)
+        if output_file_name:
+            compression = savingutils.OutputTarget.resolve_compression(output_file_name, args.compression)
+            fingerprints[output_format] = fingerprintutils.OutputFingerprint(output_file_name, input_file_names,
+                                                                             (output_format, options, compression))
+
+    return fingerprints
+
+
+def select_outdated_outputs(args, reader):
+    # with --incremental, returns arguments without output files which are up to date and fingerprints to record
+    # once the remaining ones are written
+    if not args.incremental:
+        return args, []
+
+    outdated_args = argparse.Namespace(**vars(args))
+    fingerprints = []
+    for (output_format, fingerprint) in output_fingerprints(args, reader).items():
+        if fingerprint.up_to_date():
+            print('{} file {} is up to date'.format(output_format.upper(), fingerprint.output_file_name))
+            setattr(outdated_args, output_format, None)
+            # inputs touched without changes are not hashed again next time
+            fingerprint.record()
+        else:
+            fingerprint.invalidate()
+            fingerprints.append(fingerprint)
+
+    return outdated_args, fingerprints
+
+
+def validate_system(args, system, profiler=None):
+    with (profiler or metricsutils.NULL_PROFILER).stage("validate") as stage:
+        system_coordinates = readingutils.SystemXYZReader(system.xyz_file_name).read()
+        if not savingutils.validate_coordinates(system, system_coordinates):
+            return False
+
+        report = validationutils.validate_geometry(system, system_coordinates, args.bond_tolerance,
+                                                   args.clash_distance)
+        stage.count("atoms", system.atoms_number)
+        stage.count("bonds", report.bonds_checked)
+        stage.count("stretched_bonds", report.stretched_bonds_number)
+        stage.count("clashes", report.clashes_number)
+
+    print(report.summary(system, system_coordinates))
+    if not report.valid:
+        print('[ERROR] Geometry of {} is not valid'.format(system.xyz_file_name))
+
+    return report.valid
+
+
+def save_outputs(args, system, profiler=None):
+    psf_file_name = args.psf
     pdb_file_name = args.pdb
-    if pdb_file_name:
-        pdb_saver = savingutils.PDBSaver(pdb_file_name, system)
-        pdb_saver.save_to_file()
+    buffer_size = args.buffer_size * 2 ** 10
+    compression = args.compression
+    succeeded = True
+    if args.concurrent and psf_file_name and pdb_file_name:
+        # savers run in their own processes, only the whole step is measured
+        with (profiler or metricsutils.NULL_PROFILER).stage("write_concurrently"):
+            succeeded = savingutils.save_concurrently(system, [
+                (savingutils.PSFSaver, psf_file_name, (args.jobs, buffer_size)),
+                (savingutils.PDBSaver, pdb_file_name, (args.pdb_numbering, args.jobs, buffer_size))], compression)
+    else:
+        if psf_file_name:
+            psf_saver = savingutils.PSFSaver(psf_file_name, system, args.jobs, buffer_size, profiler, compression)
+            succeeded = psf_saver.save_to_file() and succeeded
+
+        if pdb_file_name:
+            pdb_saver = savingutils.PDBSaver(pdb_file_name, system, args.pdb_numbering, args.jobs, buffer_size,
+                                             profiler, compression)
+            succeeded = pdb_saver.save_to_file() and succeeded
+
+    if args.coor:
+        coor_saver = savingutils.NAMDBinarySaver(args.coor, system, profiler=profiler, compression=compression)
+        succeeded = coor_saver.save_to_file() and succeeded
+
+    if args.dcd:
+        dcd_saver = savingutils.DCDSaver(args.dcd, system, args.trajectory, profiler=profiler,
+                                         compression=compression)
+        succeeded = dcd_saver.save_to_file() and succeeded
+
+    return succeeded
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args()
+    profiler = create_profiler(args, parser)
+
+    if profiler is not None:
+        profiler.start()
+    try:
+        reader = create_reader(args, create_template_cache(args), profiler)
+        reader.parse_packmol_input()
+        (outdated_args, fingerprints) = select_outdated_outputs(args, reader)
+
+        valid = True
+        if fingerprints or not args.incremental:
+            system = reader.read_xyz_data()
+            valid = not args.validate or validate_system(args, system, profiler)
+            if valid and save_outputs(outdated_args, system, profiler):
+                for fingerprint in fingerprints:
+                    fingerprint.record()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+
+    if args.profile:
+        print(profiler.report())
+    if args.metrics_json:
+        profiler.save_json(args.metrics_json)
+
+    if not valid:
+        sys.exit(1)
 
     print("Done")
 
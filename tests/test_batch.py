@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import batch
+import main
+from utils import cacheutils
+
+PACKMOL_FILE_NAME = "li-ec/li-ec-01.inp"
+PACKMOL_TINKER_FILE_NAME = "fsi-tinker/fsi.inp"
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self._output_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._output_directory.cleanup()
+
+    def __output_path(self, file_name):
+        return os.path.join(self._output_directory.name, file_name)
+
+    def test_create_jobs(self):
+        manifest_file_name = self.__output_path("manifest.txt")
+        with open(manifest_file_name, 'w') as manifest_file:
+            manifest_file.write("# comment\n\n{} -psf fsi.psf -t\n--unknown\n".format(PACKMOL_TINKER_FILE_NAME))
+            manifest_file.write("{} -psf fsi.psf --profile --no-cache\n".format(PACKMOL_TINKER_FILE_NAME))
+
+        args = batch.create_parser().parse_args([PACKMOL_FILE_NAME, "-o", "out", "--no-pdb", "-m", manifest_file_name])
+        jobs = batch.create_jobs(args)
+
+        self.assertEqual(4, len(jobs))
+        self.assertEqual(os.path.join("out", "li-ec-01.psf"), jobs[0][1].psf)
+        self.assertIsNone(jobs[0][1].pdb)
+        self.assertTrue(jobs[1][1].tinker)
+        self.assertEqual(manifest_file_name + ":3", jobs[1][0])
+        self.assertIsNone(jobs[2][1])
+        self.assertIsNotNone(jobs[2][2])
+        self.assertIsNone(jobs[3][1])
+        self.assertIn("unsupported option in a manifest job: --profile, --no-cache", jobs[3][2])
+
+    def test_run_jobs(self):
+        parser = main.create_parser()
+        jobs = [
+            ("li-ec", parser.parse_args([PACKMOL_FILE_NAME, "-psf", self.__output_path("li-ec.psf")]), None),
+            ("missing", parser.parse_args(["missing.inp", "-psf", self.__output_path("missing.psf")]), None),
+            ("fsi", parser.parse_args([PACKMOL_TINKER_FILE_NAME, "-t", "-pdb", self.__output_path("fsi.pdb")]), None)
+        ]
+
+        reports = batch.run_jobs(jobs, 2, cacheutils.MemoryTemplateCache())
+
+        self.assertEqual([True, False, True], [report["succeeded"] for report in reports])
+        self.assertIn("FileNotFoundError", reports[1]["message"])
+        self.assertTrue(os.path.exists(self.__output_path("li-ec.psf")))
+        self.assertTrue(os.path.exists(self.__output_path("fsi.pdb")))
@@ -0,0 +1,30 @@
+import tempfile
+import unittest
+
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        with tempfile.TemporaryDirectory() as data_directory:
+            results = benchmark.run_benchmarks([100], ["default", "tinker-drude"], data_directory, repeat=1)
+
+        self.assertEqual(6, len(results))
+        self.assertEqual(200, results["tinker-drude/100/psf"]["atoms"])
+        self.assertTrue(all(result["peak_memory"] > 0 for result in results.values()))
+
+    def test_compare_with_baseline(self):
+        baseline = {"default/100/psf": {"throughput": 1000.0, "peak_memory": 100},
+                    "default/100/pdb": {"throughput": 1000.0, "peak_memory": 100}}
+        results = {"default/100/psf": {"throughput": 850.0, "peak_memory": 115},
+                   "default/100/pdb": {"throughput": 700.0, "peak_memory": None},
+                   "tinker/100/pdb": {"throughput": 1.0, "peak_memory": 1}}
+
+        self.assertEqual([("default/100/pdb", "throughput", 1000.0, 700.0)],
+                         benchmark.compare_with_baseline(results, baseline, 0.2))
+        self.assertEqual(3, len(benchmark.compare_with_baseline(results, baseline, 0.1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
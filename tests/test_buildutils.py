@@ -0,0 +1,42 @@
+import gzip
+import io
+import os
+import tempfile
+import unittest
+
+from utils import buildutils, savingutils
+
+PACKMOL_FILE_NAME = "li-ec/li-ec-01.inp"
+
+
+class TestBuildUtils(unittest.TestCase):
+
+    def test_build_system(self):
+        with tempfile.TemporaryDirectory() as output_directory:
+            psf_file_name = os.path.join(output_directory, "li-ec.psf.gz")
+            (system, rendered) = buildutils.build_system(PACKMOL_FILE_NAME, {"psf": psf_file_name, "pdb": None})
+
+            with gzip.open(psf_file_name, 'rb') as psf_file:
+                psf_data = psf_file.read()
+
+        self.assertEqual(524, system.atoms_number)
+        self.assertEqual(["pdb"], list(rendered))
+        self.assertTrue(rendered["pdb"].startswith(savingutils.PDBSaver.FIRST_LINE.encode()))
+        self.assertEqual(524 + 2, len(rendered["pdb"].splitlines()))
+        self.assertIn(b"!NATOM", psf_data)
+
+    def test_build_system_errors(self):
+        with self.assertRaises(ValueError):
+            buildutils.build_system(PACKMOL_FILE_NAME, {"gro": None})
+        with self.assertRaises(ValueError):
+            buildutils.build_system(PACKMOL_FILE_NAME, {"psf": io.StringIO()}, compression="gzip")
+
+        with tempfile.TemporaryDirectory() as output_directory:
+            trajectory_file_name = os.path.join(output_directory, "empty.xyz")
+            open(trajectory_file_name, 'w').close()
+            with self.assertRaises(RuntimeError):
+                buildutils.build_system(PACKMOL_FILE_NAME, {"dcd": None}, trajectory_file_name=trajectory_file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
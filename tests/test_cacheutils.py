@@ -0,0 +1,93 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from utils import cacheutils, model, readingutils
+
+PACKMOL_DRUDE_FILE_NAME = "fsi-tinker-drude/fsi.inp"
+RESIDUE_FILE_NAMES = ["fsi-tinker-drude/fsi.xyz", "fsi-tinker-drude/fsi.dat", "fsi-tinker-drude/fsi.conn"]
+
+
+class TestCacheUtils(unittest.TestCase):
+
+    def setUp(self):
+        self._cache_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._cache_directory.cleanup()
+
+    def __read_system(self, cache, include_drude=True):
+        reader = readingutils.InputReader(PACKMOL_DRUDE_FILE_NAME, tinker_format=True, include_drude=include_drude,
+                                          template_cache=cache)
+        reader.parse_packmol_input()
+        return reader.read_xyz_data()
+
+    def test_cached_template(self):
+        cache = cacheutils.TemplateCache(self._cache_directory.name)
+        system = self.__read_system(cache)
+        self.assertEqual(1, len(os.listdir(self._cache_directory.name)))
+
+        cached_system = self.__read_system(cache)
+        molecule = system.molecules[0][0]
+        cached_molecule = cached_system.molecules[0][0]
+
+        self.assertIsNot(molecule, cached_molecule)
+        self.assertEqual(molecule, cached_molecule)
+        self.assertEqual(molecule.bonds, cached_molecule.bonds)
+        self.assertEqual(molecule.drude_bonds, cached_molecule.drude_bonds)
+        self.assertEqual(molecule.angles, cached_molecule.angles)
+        self.assertEqual(molecule.dihedrals, cached_molecule.dihedrals)
+        self.assertEqual(molecule.shifts, cached_molecule.shifts)
+        self.assertEqual(molecule.atoms_number_with_drude, cached_molecule.atoms_number_with_drude)
+        self.assertEqual(molecule.atoms[0].drude_atom, cached_molecule.atoms[0].drude_atom)
+
+    def test_key(self):
+        cache = cacheutils.TemplateCache(self._cache_directory.name)
+        key = cache.key(RESIDUE_FILE_NAMES, (True, True))
+
+        self.assertEqual(key, cache.key(RESIDUE_FILE_NAMES, (True, True)))
+        self.assertNotEqual(key, cache.key(RESIDUE_FILE_NAMES, (True, False)))
+        self.assertNotEqual(key, cache.key(RESIDUE_FILE_NAMES[:2], (True, True)))
+        self.assertNotEqual(key, cache.key(RESIDUE_FILE_NAMES[:2] + ["missing.conn"], (True, True)))
+
+        self.__read_system(cache, include_drude=False)
+        self.__read_system(cache, include_drude=True)
+        self.assertEqual(2, len(os.listdir(self._cache_directory.name)))
+
+    def test_eviction(self):
+        molecule = model.Molecule([model.Atom("C", model.Coordinates(float(i), 0.0, 0.0)) for i in range(0, 10)])
+        cache = cacheutils.TemplateCache(self._cache_directory.name)
+        cache.store("first", molecule)
+        entry_size = os.path.getsize(os.path.join(self._cache_directory.name, "first" + cache.ENTRY_SUFFIX))
+        os.utime(os.path.join(self._cache_directory.name, "first" + cache.ENTRY_SUFFIX), (0, 0))
+
+        cache = cacheutils.TemplateCache(self._cache_directory.name, int(1.5 * entry_size))
+        cache.store("second", molecule)
+
+        self.assertIsNone(cache.load("first"))
+        self.assertEqual(molecule, cache.load("second"))
+
+    def test_damaged_entry(self):
+        cache = cacheutils.TemplateCache(self._cache_directory.name)
+        with open(os.path.join(self._cache_directory.name, "broken" + cache.ENTRY_SUFFIX), 'wb') as entry_file:
+            entry_file.write(b"not a pickle")
+
+        self.assertIsNone(cache.load("broken"))
+        self.assertEqual([], os.listdir(self._cache_directory.name))
+
+    def test_unusable_directory(self):
+        # the cache directory would have to be created inside a regular file
+        blocking_file_name = os.path.join(self._cache_directory.name, "file")
+        open(blocking_file_name, 'w').close()
+        cache = cacheutils.TemplateCache(os.path.join(blocking_file_name, "cache"))
+
+        messages = io.StringIO()
+        with contextlib.redirect_stdout(messages):
+            system = self.__read_system(cache)
+            self.assertIsNone(cache.load(cache.key(RESIDUE_FILE_NAMES, (True, True))))
+
+        self.assertEqual(self.__read_system(None).molecules[0][0], system.molecules[0][0])
+        self.assertEqual(1, messages.getvalue().count("[WARNING]"))
+        self.assertEqual(["file"], os.listdir(self._cache_directory.name))
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import main
+from utils import fingerprintutils
+
+PACKMOL_DIRECTORY = "li-ec"
+
+
+class TestFingerprintUtils(unittest.TestCase):
+
+    def setUp(self):
+        self._output_directory = tempfile.TemporaryDirectory()
+        self._input_directory = os.path.join(self._output_directory.name, PACKMOL_DIRECTORY)
+        shutil.copytree(PACKMOL_DIRECTORY, self._input_directory)
+
+    def tearDown(self):
+        self._output_directory.cleanup()
+
+    def __path(self, file_name):
+        return os.path.join(self._input_directory, file_name)
+
+    def __build(self, *arguments):
+        # returns formats of outputs which were written
+        args = main.create_parser().parse_args([self.__path("li-ec-01.inp"), "--incremental", *arguments])
+        reader = main.create_reader(args, None)
+        reader.parse_packmol_input()
+        (outdated_args, fingerprints) = main.select_outdated_outputs(args, reader)
+        if fingerprints:
+            self.assertTrue(main.save_outputs(outdated_args, reader.read_xyz_data()))
+            for fingerprint in fingerprints:
+                fingerprint.record()
+
+        return [output_format for output_format in ("psf", "pdb") if getattr(outdated_args, output_format)]
+
+    def test_file_fingerprint(self):
+        file_name = self.__path("li.dat")
+        fingerprint = fingerprintutils.file_fingerprint(file_name)
+        self.assertEqual(os.path.getsize(file_name), fingerprint["size"])
+        self.assertIs(fingerprint, fingerprintutils.file_fingerprint(file_name, fingerprint))
+        self.assertIsNone(fingerprintutils.file_fingerprint(self.__path("missing.dat")))
+
+    def test_incremental_build(self):
+        outputs = ["-psf", self.__path("li-ec.psf"), "-pdb", self.__path("li-ec.pdb")]
+        self.assertEqual(["psf", "pdb"], self.__build(*outputs))
+        with open(self.__path("li-ec.psf"), 'rb') as psf_file:
+            psf_data = psf_file.read()
+        self.assertEqual([], self.__build(*outputs))
+
+        # new coordinates of the system change only the PDB file
+        with open(self.__path("li-ec-01.xyz"), 'a') as xyz_file:
+            xyz_file.write("\n")
+        self.assertEqual(["pdb"], self.__build(*outputs))
+        with open(self.__path("li-ec.psf"), 'rb') as psf_file:
+            self.assertEqual(psf_data, psf_file.read())
+
+        os.utime(self.__path("li.dat"), (0, 0))
+        self.assertEqual([], self.__build(*outputs))
+
+        with open(self.__path("li.dat"), 'a') as dat_file:
+            dat_file.write("\n")
+        self.assertEqual(["psf", "pdb"], self.__build(*outputs))
+        self.assertEqual(["pdb"], self.__build(*outputs, "--pdb-numbering", "wrap"))
+
+        os.remove(self.__path("li-ec.psf"))
+        self.assertEqual(["psf"], self.__build(*outputs, "--pdb-numbering", "wrap"))
+
+    def test_failed_build_is_not_recorded(self):
+        psf_file_name = self.__path("li-ec.psf")
+        fingerprint = fingerprintutils.OutputFingerprint(psf_file_name, [self.__path("li.dat")], ())
+        self.assertFalse(fingerprint.up_to_date())
+        with open(psf_file_name, 'w') as psf_file:
+            psf_file.write("old")
+        fingerprint.record()
+        self.assertTrue(fingerprintutils.OutputFingerprint(psf_file_name, [self.__path("li.dat")], ()).up_to_date())
+
+        fingerprint.invalidate()
+        self.assertFalse(fingerprintutils.OutputFingerprint(psf_file_name, [self.__path("li.dat")], ()).up_to_date())
+
+
+if __name__ == '__main__':
+    unittest.main()
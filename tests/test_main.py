@@ -0,0 +1,66 @@
+import contextlib
+import io
+import unittest
+
+import main
+
+PACKMOL_FILE_NAME = "li-ec/li-ec-01.inp"
+
+
+class TestMain(unittest.TestCase):
+
+    @staticmethod
+    def __usage_error(arguments):
+        parser = main.create_parser()
+        messages = io.StringIO()
+        with contextlib.redirect_stderr(messages):
+            try:
+                main.create_profiler(parser.parse_args([PACKMOL_FILE_NAME] + arguments), parser)
+            except SystemExit as error:
+                return error.code, messages.getvalue()
+
+        return None, messages.getvalue()
+
+    def test_profile_hook(self):
+        parser = main.create_parser()
+        profiler = main.create_profiler(parser.parse_args([PACKMOL_FILE_NAME, "--profile-hook", "os.path:join"]),
+                                        parser)
+        self.assertIsNotNone(profiler)
+
+        for (value, message) in (("os.path", "expected MODULE:FUNCTION"), (":join", "expected MODULE:FUNCTION"),
+                                 ("missing_module:join", "cannot import module missing_module"),
+                                 ("os.path:missing", "module os.path has no function missing"),
+                                 ("os:sep", "module os has no function sep")):
+            (code, messages) = self.__usage_error(["--profile-hook", value])
+            self.assertEqual(2, code)
+            self.assertIn(message, messages)
+
+    def test_bond_distances(self):
+        args = main.create_parser().parse_args([PACKMOL_FILE_NAME, "--bond-threshold", "1.5", "--bond-cutoff", "O",
+                                                "H", "1.1", "--bond-cutoff", "C", "H", "1.2"])
+        self.assertEqual(1.5, args.bond_threshold)
+        self.assertEqual([("O", "H", 1.1), ("C", "H", 1.2)], args.bond_cutoff)
+
+        for arguments in (["--bond-threshold", "0"], ["--bond-threshold", "-1.5"], ["--bond-threshold", "nan"],
+                          ["--bond-cutoff", "O", "H", "0"], ["--bond-cutoff", "O", "H", "short"]):
+            (code, messages) = self.__usage_error(arguments)
+            self.assertEqual(2, code)
+            self.assertIn("--bond-", messages)
+
+    def test_clash_distance(self):
+        (code, messages) = self.__usage_error(["--validate", "--clash-distance", "0"])
+        self.assertEqual(2, code)
+        self.assertIn("--clash-distance", messages)
+
+    def test_bond_tolerance(self):
+        args = main.create_parser().parse_args([PACKMOL_FILE_NAME, "--validate", "--bond-tolerance", "0"])
+        self.assertEqual(0.0, args.bond_tolerance)
+
+        for value in ("-0.1", "nan", "inf"):
+            (code, messages) = self.__usage_error(["--validate", "--bond-tolerance", value])
+            self.assertEqual(2, code)
+            self.assertIn("--bond-tolerance", messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+
+from utils import metricsutils, readingutils, savingutils
+
+PACKMOL_DRUDE_FILE_NAME = "fsi-tinker-drude/fsi.inp"
+
+
+class TestMetricsUtils(unittest.TestCase):
+
+    def test_profiler_stages(self):
+        events = []
+        profiler = metricsutils.Profiler(trace_memory=True, hook=lambda event, name: events.append((event, name)))
+        profiler.start()
+        try:
+            with profiler.stage("outer") as outer:
+                outer.count("items", 2)
+                for i in range(0, 3):
+                    with profiler.stage("inner") as inner:
+                        inner.count("items", i)
+                        data = [0] * 100000
+                        del data
+        finally:
+            profiler.stop()
+
+        (outer, inner) = profiler.stages
+        self.assertEqual(("outer", 1, {"items": 2}), (outer.name, outer.calls, outer.counts))
+        self.assertEqual(("inner", 3, {"items": 3}), (inner.name, inner.calls, inner.counts))
+        self.assertGreaterEqual(inner.peak_memory, 800000)
+        self.assertGreaterEqual(outer.peak_memory, inner.peak_memory)
+        self.assertGreaterEqual(outer.wall_time, inner.wall_time)
+        self.assertEqual([("start", "outer")] + [("start", "inner"), ("end", "inner")] * 3 + [("end", "outer")],
+                         events)
+        self.assertIn("inner", profiler.report())
+
+    def test_null_profiler(self):
+        with metricsutils.NULL_PROFILER.stage("ignored") as metrics:
+            metrics.count("items", 1)
+
+        self.assertEqual([], metricsutils.NULL_PROFILER.stages)
+
+    def test_metrics_json(self):
+        profiler = metricsutils.Profiler()
+        reader = readingutils.InputReader(PACKMOL_DRUDE_FILE_NAME, tinker_format=True, include_drude=True,
+                                          profiler=profiler)
+        reader.parse_packmol_input()
+        system = reader.read_xyz_data()
+
+        with tempfile.TemporaryDirectory() as output_directory:
+            psf_file_name = os.path.join(output_directory, "system.psf")
+            self.assertTrue(savingutils.PSFSaver(psf_file_name, system, profiler=profiler).save_to_file())
+            json_file_name = os.path.join(output_directory, "metrics.json")
+            profiler.save_json(json_file_name)
+
+            with open(json_file_name, 'r') as json_file:
+                stages = {stage["name"]: stage for stage in json.load(json_file)["stages"]}
+            psf_size = os.path.getsize(psf_file_name)
+
+        self.assertEqual(["parse_packmol_input", "read_residues", "topology", "write_psf"], list(stages))
+        self.assertEqual({"structures": 1, "residues": 1}, stages["parse_packmol_input"]["counts"])
+        self.assertEqual(system.atoms_number_with_drude, stages["read_residues"]["counts"]["atoms_with_drude"])
+        self.assertEqual({"atoms": system.atoms_number_with_drude, "bytes_written": psf_size},
+                         stages["write_psf"]["counts"])
+        self.assertIsNone(stages["write_psf"]["peak_memory"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -62,7 +62,9 @@ class TestModel(unittest.TestCase):
         molecule3 = model.Molecule([atom1, atom2, atom3], "MOL")
 
         self.assertEqual(molecule1, molecule2)
+        self.assertEqual(hash(molecule1), hash(molecule2))
         self.assertNotEqual(molecule2, molecule3)
+        self.assertEqual(molecule3, molecule3)
 
     def __make_example_molecule(self):
         coordinatesH1 = model.Coordinates(0.0, 0.0, 0.95)
@@ -84,6 +86,37 @@ class TestModel(unittest.TestCase):
         expected_bonds = ((0, 2), (1, 2))
         self.assertEqual(bonds, expected_bonds)
 
+    def test_determine_bonds_with_cutoffs(self):
+        molecule = self.__make_example_molecule()
+        molecule.determine_bonds(1.50, {("O", "H"): 0.96})
+        bonds = molecule.bonds
+        expected_bonds = ((0, 2), (1, 2))
+        self.assertEqual(bonds, expected_bonds)
+
+        molecule.determine_bonds(1.50, {("H", "O"): 0.90})
+        self.assertEqual(molecule.bonds, ())
+
+    def test_determine_bonds_invalid_threshold(self):
+        molecule = self.__make_example_molecule()
+        self.assertRaises(ValueError, molecule.determine_bonds, 0.0)
+        self.assertRaises(ValueError, molecule.determine_bonds, 1.50, {("O", "H"): -0.96})
+
+    def test_determine_bonds_chain(self):
+        # atoms are spread over many cells and listed in non-spatial order
+        order = [5, 0, 9, 3, 7, 1, 8, 2, 6, 4]
+        atoms = [model.Atom("C", model.Coordinates(1.5 * i, 0.3 * (i % 2), -1.5 * i / 3.0)) for i in order]
+        molecule = model.Molecule(atoms, "MOL")
+        molecule.determine_bonds(1.70)
+
+        expected_bonds = []
+        for i in range(0, len(atoms)):
+            for j in range(i + 1, len(atoms)):
+                if atoms[i].coordinates.calculate_distance(atoms[j].coordinates) <= 1.70:
+                    expected_bonds.append((i, j))
+
+        self.assertEqual(molecule.bonds, tuple(expected_bonds))
+        self.assertEqual(len(molecule.bonds), 9)
+
     def test_determine_angles(self):
         molecule = self.__make_example_molecule()
         molecule.determine_bonds(1.50)
@@ -92,6 +125,26 @@ class TestModel(unittest.TestCase):
         expected_angles = ((0, 2, 1),)
         self.assertEqual(angles, expected_angles)
 
+    def test_adjacency(self):
+        molecule = self.__make_example_molecule()
+        molecule.bonds = ((0, 2), (1, 2))
+        self.assertEqual(molecule.adjacency, {0: [2], 1: [2], 2: [0, 1]})
+
+        molecule.bonds = ((2, 3),)
+        self.assertEqual(molecule.adjacency, {2: [3], 3: [2]})
+
+    def test_determine_angles_and_dihedrals_branched(self):
+        atoms = [model.Atom("C", model.Coordinates(float(i), 0.0, 0.0)) for i in range(0, 6)]
+        molecule = model.Molecule(atoms, "MOL")
+        molecule.bonds = ((0, 1), (1, 2), (1, 3), (3, 4), (3, 5))
+        molecule.determine_angles()
+        molecule.determine_dihedrals()
+
+        expected_angles = ((0, 1, 2), (0, 1, 3), (2, 1, 3), (1, 3, 4), (1, 3, 5), (4, 3, 5))
+        expected_dihedrals = ((0, 1, 3, 4), (0, 1, 3, 5), (2, 1, 3, 4), (2, 1, 3, 5))
+        self.assertEqual(molecule.angles, expected_angles)
+        self.assertEqual(molecule.dihedrals, expected_dihedrals)
+
     def test_determine_dihedrals(self):
         coordinatesO1 = model.Coordinates(0.0, 0.0, 0.0)
         coordinatesO2 = model.Coordinates(0.0, 0.0, 1.48)
@@ -111,3 +164,112 @@ class TestModel(unittest.TestCase):
         dihedrals = molecule.dihedrals
         expected_dihedrals = ((2, 0, 1, 3),)
         self.assertEqual(dihedrals, expected_dihedrals)
+
+    def test_residue_template(self):
+        template = model.ResidueTemplate()
+        template.append("O", 0.0, 0.0, 0.0, -0.8, 15.9994, "OT")
+        template.append("H", 0.0, 0.0, 0.95, 0.4, 1.008, "HT")
+        template.append("H", 0.89567, 0.0, -0.316663, 0.4, 1.008, "HT")
+
+        self.assertEqual(3, len(template))
+        self.assertEqual("H", template.symbol(2))
+        self.assertEqual("HT", template.namd_symbol(1))
+        self.assertEqual(model.Coordinates(0.0, 0.0, 0.95), template.atom_coordinates(1))
+
+        molecule = model.Molecule(template, "TIP")
+        atom = molecule.atoms[2]
+        atom.charge = 0.41
+        atom.namd_symbol = "HW"
+        self.assertEqual(0.41, template.charges[2])
+        self.assertEqual("HW", template.namd_symbol(2))
+        self.assertEqual("HT", template.namd_symbol(1))
+
+    def test_atom_view_drude(self):
+        atoms = [model.Atom("O", model.Coordinates(), -0.8, 15.9994, "OT"),
+                 model.Atom("H", model.Coordinates(0.0, 0.0, 0.95), 0.4, 1.008, "HT")]
+        molecule = model.Molecule(atoms, "MOL")
+        drude_bonds = []
+        molecule.add_drude_atom(molecule.atoms[0], 1.0, drude_bonds)
+
+        atom = molecule.atoms[0]
+        drude_atom = atom.drude_atom
+        drude_charge = model.Atom.DRUDE_CHARGE_FACTOR * math.sqrt(1000.0)
+        self.assertEqual("DOT", drude_atom.namd_symbol)
+        self.assertEqual(drude_charge, drude_atom.charge)
+        self.assertEqual(-0.8 - drude_charge, atom.charge)
+        self.assertEqual(-1.0, atom.polarizability)
+        self.assertIsNone(molecule.atoms[1].drude_atom)
+        self.assertEqual(3, molecule.atoms_number_with_drude)
+        self.assertEqual([(0, 1)], drude_bonds)
+        self.assertEqual(-0.8, atoms[0].charge)
+        self.assertRaises(ValueError, molecule.add_drude_atom, atoms[1], 1.0, drude_bonds)
+
+    def test_create_drude_atoms_identical_atoms(self):
+        atoms = [model.Atom("O", model.Coordinates(), -0.8, 15.9994, "OT") for _ in range(0, 3)] + \
+                [model.Atom("H", model.Coordinates(0.0, 0.0, 0.95), 0.4, 1.008, "HT")]
+        molecule = model.Molecule(atoms, "MOL")
+        molecule.create_drude_atoms({1: 1.0, 2: 1.0})
+
+        self.assertEqual([None, "DOT", "DOT", None],
+                         [atom.drude_atom and atom.drude_atom.namd_symbol for atom in molecule.atoms])
+        self.assertEqual([0, 0, 1, 2], list(molecule.shifts))
+        self.assertEqual(((1, 2), (3, 4)), molecule.drude_bonds)
+        self.assertEqual(6, molecule.atoms_number_with_drude)
+
+    def test_system_counts(self):
+        water = self.__make_example_molecule()
+        water.determine_bonds(1.50)
+        water.determine_angles()
+        lithium = model.Molecule([model.Atom("Li", model.Coordinates(), 1.0, 6.997, "kLi")], "LI")
+        system = model.System([(water, 3), (lithium, 2)], "system.xyz")
+
+        self.assertEqual(14, system.atoms_number)
+        self.assertEqual(14, system.atoms_number_with_drude)
+        self.assertEqual(6, system.bonds_number)
+        self.assertEqual(3, system.angles_number)
+        self.assertEqual(0, system.dihedrals_number)
+        self.assertEqual(8, system.atom_offset(0, 2))
+        self.assertEqual(13, system.atom_offset(1, 1))
+
+        water.create_drude_atoms({2: 1.0})
+        self.assertEqual(17, system.atoms_number_with_drude)
+        self.assertEqual(9, system.bonds_number)
+        self.assertEqual(10, system.atom_offset_with_drude(0, 2))
+        self.assertEqual(16, system.atom_offset_with_drude(1, 1))
+        self.assertEqual(13, system.atom_offset(1, 1))
+
+    def test_system_global_indices(self):
+        water = self.__make_example_molecule()
+        water.create_drude_atoms({2: 1.0})
+        water.determine_bonds(1.50)
+        water.determine_angles()
+        lithium = model.Molecule([model.Atom("Li", model.Coordinates(), 1.0, 6.997, "kLi")], "LI")
+        system = model.System([(lithium, 2), (water, 2), (lithium, 0), (lithium, 1)], "system.xyz")
+
+        self.assertEqual((1, 1, 2), system.locate_atom(8))
+        self.assertEqual((3, 0, 0), system.locate_atom(10))
+        self.assertEqual((1, 1, 3), system.locate_atom(10, with_drude=True))
+        self.assertEqual((3, 0, 0), system.locate_atom(12, with_drude=True))
+        self.assertRaises(IndexError, system.locate_atom, 11)
+
+        for with_drude in (False, True):
+            atoms_number = system.atoms_number_with_drude if with_drude else system.atoms_number
+            for global_index in range(0, atoms_number):
+                located = system.locate_atom(global_index, with_drude)
+                self.assertEqual(global_index, system.global_atom_index(*located, with_drude=with_drude))
+
+        self.assertEqual([(2, 4), (3, 4), (4, 5), (7, 9), (8, 9), (9, 10)], list(system.global_bonds()))
+        self.assertEqual([(2, 4), (3, 4), (7, 9), (8, 9)], list(system.global_bonds(include_drude=False)))
+        self.assertEqual([(2, 4, 3), (7, 9, 8)], list(system.global_angles()))
+        self.assertEqual([], list(system.global_dihedrals()))
+
+    def test_determine_dihedrals_three_membered_ring(self):
+        atoms = [model.Atom("C", model.Coordinates(x, y, 0.0)) for (x, y) in ((0.0, 0.0), (1.5, 0.0), (0.75, 1.3))]
+        atoms.append(model.Atom("H", model.Coordinates(-1.0, 0.0, 0.0)))
+        molecule = model.Molecule(atoms, "CYC")
+        molecule.bonds = ((0, 1), (0, 2), (0, 3), (1, 2))
+        molecule.determine_dihedrals()
+        self.assertEqual(((2, 0, 1, 2), (3, 0, 1, 2), (1, 0, 2, 1), (3, 0, 2, 1), (0, 1, 2, 0)), molecule.dihedrals)
+
+        molecule.determine_dihedrals(skip_three_rings=True)
+        self.assertEqual(((3, 0, 1, 2), (3, 0, 2, 1)), molecule.dihedrals)
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from utils import model, readingutils
@@ -78,3 +81,130 @@ class TestFileUtils(unittest.TestCase):
 
         self.assertIn((4, 0, 8, 9), dihedrals)
         self.assertIn((0, 8, 9, 13), dihedrals)
+
+    def test_tinker_connectivity_from_xyz(self):
+        molecules = []
+        for tinker_connectivity in (readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                                    readingutils.InputReader.TINKER_CONNECTIVITY_XYZ):
+            reader = readingutils.InputReader(PACKMOL_DRUDE_FILE_NAME, tinker_format=True, include_drude=True,
+                                              tinker_connectivity=tinker_connectivity)
+            reader.parse_packmol_input()
+            molecules.append(reader.read_xyz_data().molecules[0][0])
+
+        (conn_molecule, xyz_molecule) = molecules
+        self.assertEqual(conn_molecule.bonds, xyz_molecule.bonds)
+        self.assertEqual(conn_molecule.angles, xyz_molecule.angles)
+        self.assertEqual(conn_molecule.dihedrals, xyz_molecule.dihedrals)
+        self.assertRaises(ValueError, readingutils.InputReader, PACKMOL_DRUDE_FILE_NAME, True,
+                          tinker_connectivity="analyze")
+
+    def test_conn_sections(self):
+        reader = readingutils.InputReader(PACKMOL_TINKER_FILE_NAME, tinker_format=True)
+        reader.parse_packmol_input()
+        expected_molecule = reader.read_xyz_data().molecules[0][0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            residue_directory = os.path.join(directory, "fsi-tinker")
+            shutil.copytree("fsi-tinker", residue_directory)
+            conn_file_name = os.path.join(residue_directory, "fsi.conn")
+            with open(conn_file_name) as conn_file:
+                content = conn_file.read()
+            dihedrals_end = content.index("Atomic Multipole Parameters")
+
+            # the last section may end with the file
+            with open(conn_file_name, 'w') as conn_file:
+                conn_file.write(content[:dihedrals_end].rstrip())
+            reader = readingutils.InputReader(os.path.join(residue_directory, "fsi.inp"), tinker_format=True)
+            reader.parse_packmol_input()
+            molecule = reader.read_xyz_data().molecules[0][0]
+            self.assertEqual(expected_molecule.bonds, molecule.bonds)
+            self.assertEqual(expected_molecule.angles, molecule.angles)
+            self.assertEqual(expected_molecule.dihedrals, molecule.dihedrals)
+
+            with open(conn_file_name, 'w') as conn_file:
+                conn_file.write(content[:content.index(readingutils.InputReader.DIHEDRAL_SECTION_BEGINNING)])
+            reader = readingutils.InputReader(os.path.join(residue_directory, "fsi.inp"), tinker_format=True)
+            reader.parse_packmol_input()
+            self.assertRaises(ValueError, reader.read_xyz_data)
+
+    def test_system_xyz_reader(self):
+        reader = readingutils.SystemXYZReader("li-ec/li-ec-01.xyz")
+        system_coordinates = reader.read()
+
+        self.assertEqual(524, system_coordinates.declared_atoms_number)
+        self.assertEqual(524, system_coordinates.atoms_number)
+        self.assertEqual("Li", system_coordinates.symbol(0))
+        self.assertEqual("F", system_coordinates.symbol(523))
+        self.assertEqual([-9.160643, -7.711224, 1.521350], list(system_coordinates.coordinates[0:3]))
+        self.assertEqual(3, system_coordinates.line_number(0))
+
+    def test_system_xyz_reader_irregular_lines(self):
+        content = "3\ncomment\nC 0.0 1.0 2.0\n\nO 3.0 4.0 5.0 extra\nH 6.0 7.0 8.0\n\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.xyz', delete=False) as xyz_file:
+            xyz_file.write(content)
+
+        try:
+            for chunk_size in (4, 1 << 20):
+                reader = readingutils.SystemXYZReader(xyz_file.name)
+                reader.CHUNK_SIZE = chunk_size
+                system_coordinates = reader.read()
+
+                self.assertEqual(["C", "O", "H"], [system_coordinates.symbol(i) for i in range(0, 3)])
+                self.assertEqual([float(i) for i in range(0, 9)], list(system_coordinates.coordinates))
+                self.assertEqual([3, 5, 6], [system_coordinates.line_number(i) for i in range(0, 3)])
+        finally:
+            os.remove(xyz_file.name)
+
+    def test_system_xyz_reader_blank_lines_at_chunk_boundary(self):
+        content = "4\ncomment\nC 0.0 0.0 0.0\nC 1.0 0.0 0.0\n\n\nO 2.0 0.0 0.0\nH 3.0 0.0 0.0\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.xyz', delete=False) as xyz_file:
+            xyz_file.write(content)
+
+        try:
+            for chunk_size in list(range(4, 29)) + [1 << 20]:
+                reader = readingutils.SystemXYZReader(xyz_file.name)
+                reader.CHUNK_SIZE = chunk_size
+                system_coordinates = reader.read()
+
+                self.assertEqual([0.0, 1.0, 2.0, 3.0], list(system_coordinates.coordinates[0::3]))
+                self.assertEqual([3, 4, 7, 8], [system_coordinates.line_number(i) for i in range(0, 4)])
+        finally:
+            os.remove(xyz_file.name)
+
+    def test_repeated_structure_shares_molecule(self):
+        content = "output li-ec-01.xyz\nstructure li.xyz\n  number 2\nend structure\n" \
+                  "structure ec.xyz\n  number 1\nend structure\nstructure li.xyz\n  number 2\nend structure\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.inp', dir="li-ec", delete=False) as input_file:
+            input_file.write(content)
+
+        try:
+            reader = readingutils.InputReader(input_file.name)
+            reader.parse_packmol_input()
+            molecules = reader.read_xyz_data().molecules
+
+            self.assertIs(molecules[0][0], molecules[2][0])
+            self.assertIsNot(molecules[0][0], molecules[1][0])
+            self.assertEqual([2, 1, 2], [counter for (molecule, counter) in molecules])
+        finally:
+            os.remove(input_file.name)
+
+    def test_system_xyz_reader_frames(self):
+        content = "2\nframe 1\nC 0.0 1.0 2.0\nO 3.0 4.0 5.0\n2\nframe 2\nC 1.0 1.0 2.0\n\nO 4.0 4.0 5.0\n\n" \
+                  "2\n\nC 2.0 1.0 2.0\nO 5.0 4.0 5.0"
+        with tempfile.NamedTemporaryFile('w', suffix='.xyz', delete=False) as xyz_file:
+            xyz_file.write(content)
+
+        try:
+            for chunk_size in (4, 1 << 20):
+                reader = readingutils.SystemXYZReader(xyz_file.name)
+                reader.CHUNK_SIZE = chunk_size
+                frames = list(reader.frames())
+
+                self.assertEqual(3, len(frames))
+                self.assertEqual([0.0, 1.0, 2.0], [frame.coordinates[0] for frame in frames])
+                self.assertEqual([[3, 4], [7, 9], [13, 14]],
+                                 [[frame.line_number(i) for i in range(0, 2)] for frame in frames])
+                self.assertEqual(["C", "O"], [frames[2].symbol(i) for i in range(0, 2)])
+                self.assertEqual(list(frames[0].coordinates), list(reader.read().coordinates))
+        finally:
+            os.remove(xyz_file.name)
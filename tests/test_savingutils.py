@@ -0,0 +1,388 @@
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import struct
+import tempfile
+import time
+import tracemalloc
+import unittest
+from array import array
+from unittest import mock
+
+from utils import model, savingutils
+
+
+class SlowSaver(savingutils.FileSaver):
+    # writes a part of its output and never finishes
+
+    def _save(self):
+        output_file = self._target.open()
+        output_file.write(b"partial output")
+        output_file.flush()
+        time.sleep(60)
+        return True
+
+
+class FailingSaver(savingutils.FileSaver):
+    # fails once the file of SlowSaver, named slow.*, is being written
+
+    def _save(self):
+        directory = os.path.dirname(self._output)
+        for _ in range(0, 100):
+            if any(file_name.startswith("slow.") for file_name in os.listdir(directory)):
+                break
+            time.sleep(0.05)
+        return False
+
+
+class TestSavingUtils(unittest.TestCase):
+
+    def setUp(self):
+        self._output_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._output_directory.cleanup()
+
+    def __output_path(self, file_name):
+        return os.path.join(self._output_directory.name, file_name)
+
+    @staticmethod
+    def __make_chain_system(copies):
+        atoms = [model.Atom("C", model.Coordinates(1.5 * i, 0.0, 0.0), 0.0, 12.011, "CT") for i in range(0, 3)]
+        molecule = model.Molecule(atoms, "PRO")
+        molecule.bonds = ((0, 1), (1, 2))
+        molecule.determine_angles()
+        molecule.determine_dihedrals()
+
+        return model.System([(molecule, copies)], "unused.xyz")
+
+    def __write_system_xyz(self, system):
+        xyz_file_name = self.__output_path("system.xyz")
+        with open(xyz_file_name, 'w') as xyz_file:
+            xyz_file.write("{}\ncomment\n".format(system.atoms_number))
+            for (molecule, counter) in system.molecules:
+                for i in range(0, counter):
+                    for atom in molecule.atoms:
+                        coordinates = atom.coordinates
+                        xyz_file.write("{} {} {} {}\n".format(atom.symbol, coordinates.x, coordinates.y + i,
+                                                              coordinates.z))
+
+        return model.System(system.molecules, xyz_file_name)
+
+    @staticmethod
+    def __read_section(lines, header):
+        start = [i for (i, line) in enumerate(lines) if header in line][0]
+        terms_number = int(lines[start].split()[0])
+        section = []
+        for line in lines[start + 1:]:
+            if line == "" or "!" in line:
+                break
+            section.append(line)
+
+        return terms_number, section
+
+    def test_psf_connectivity_layout(self):
+        system = self.__make_chain_system(5)
+        psf_file_name = self.__output_path("chain.psf")
+        savingutils.PSFSaver(psf_file_name, system).save_to_file()
+
+        with open(psf_file_name) as psf_file:
+            lines = psf_file.read().split("\n")
+
+        bonds_number, bond_lines = self.__read_section(lines, "!NBOND")
+        self.assertEqual(10, bonds_number)
+        self.assertEqual(3, len(bond_lines))
+        self.assertEqual(" " + "{:9d} {:9d} ".format(1, 2) + "{:9d} {:9d} ".format(2, 3) +
+                         "{:9d} {:9d} ".format(4, 5) + "{:9d} {:9d} ".format(5, 6), bond_lines[0])
+        self.assertEqual(" " + "{:9d} {:9d} ".format(13, 14) + "{:9d} {:9d} ".format(14, 15), bond_lines[2])
+
+        angles_number, angle_lines = self.__read_section(lines, "!NTHETA")
+        self.assertEqual(5, angles_number)
+        self.assertEqual(2, len(angle_lines))
+        self.assertEqual(" " + "{:9d} {:9d} {:9d} ".format(10, 11, 12) + "{:9d} {:9d} {:9d} ".format(13, 14, 15),
+                         angle_lines[1])
+
+        dihedrals_number, dihedral_lines = self.__read_section(lines, "!NPHI")
+        self.assertEqual(0, dihedrals_number)
+        self.assertEqual([" "], dihedral_lines)
+
+    def test_hybrid36_encode(self):
+        self.assertEqual("    1", savingutils.hybrid36_encode(5, 1))
+        self.assertEqual("99999", savingutils.hybrid36_encode(5, 99999))
+        self.assertEqual("A0000", savingutils.hybrid36_encode(5, 100000))
+        self.assertEqual("A0001", savingutils.hybrid36_encode(5, 100001))
+        self.assertEqual("ZZZZ", savingutils.hybrid36_encode(4, 10000 + 26 * 36 ** 3 - 1))
+        self.assertEqual("a000", savingutils.hybrid36_encode(4, 10000 + 26 * 36 ** 3))
+        self.assertRaises(ValueError, savingutils.hybrid36_encode, 2, 100 + 2 * 26 * 36)
+
+    def test_hybrid36_encode_range(self):
+        # decimal, upper and lower case blocks of width 3 and the boundaries between them
+        for (start, stop) in ((0, 1000), (990, 1010), (999 + 26 * 36 ** 2 - 40, 999 + 26 * 36 ** 2 + 40),
+                              (1000, 1000 + 2 * 26 * 36 ** 2), (1001, 1002), (5, 5)):
+            self.assertEqual([savingutils.hybrid36_encode(3, value) for value in range(start, stop)],
+                             savingutils.hybrid36_encode_range(3, start, stop))
+
+    def test_pdb_numbering_out_of_hybrid36_range(self):
+        max_residue_id = savingutils.hybrid36_max(savingutils.PDBRenderer.RESIDUE_ID_WIDTH)
+        self.assertEqual(2436111, max_residue_id)
+        self.assertEqual("zzzz", savingutils.hybrid36_encode(4, max_residue_id))
+        self.assertRaises(ValueError, savingutils.hybrid36_encode, 4, max_residue_id + 1)
+
+        molecule = model.Molecule([model.Atom("Li", model.Coordinates(), 1.0, 6.94, "LI")], "LIT")
+        renderer = savingutils.PDBRenderer(model.System([(molecule, max_residue_id)], "unused.xyz"),
+                                           array('d', [0.0] * 3))
+        self.assertEqual("zzzz", renderer.atoms(0, max_residue_id - 1, 1, max_residue_id, 0)[22:26])
+
+        pdb_file_name = self.__output_path("lithium.pdb")
+        system = model.System([(molecule, max_residue_id + 1)], "unused.xyz")
+        messages = io.StringIO()
+        with contextlib.redirect_stdout(messages):
+            self.assertFalse(savingutils.PDBSaver(pdb_file_name, system).save_to_file())
+        self.assertIn("[ERROR] PDB residue ids up to 2436112", messages.getvalue())
+        self.assertEqual([], os.listdir(self._output_directory.name))
+
+    def test_pdb_numbering(self):
+        atoms = [model.Atom("Li", model.Coordinates(), 1.0, 6.94, "LI")]
+        system = self.__write_system_xyz(model.System([(model.Molecule(atoms, "LIT"), 10001)], "unused.xyz"))
+
+        for (numbering, last_residue) in ((savingutils.PDBSaver.NUMBERING_HYBRID36, "A001"),
+                                          (savingutils.PDBSaver.NUMBERING_WRAP, "   1")):
+            pdb_file_name = self.__output_path("lithium.pdb")
+            savingutils.PDBSaver(pdb_file_name, system, numbering).save_to_file()
+
+            with open(pdb_file_name) as pdb_file:
+                lines = pdb_file.read().split("\n")
+
+            self.assertEqual(savingutils.PDBSaver.FIRST_LINE, lines[0] + "\n")
+            self.assertEqual("ATOM      1  LI  LIT X   1       0.000   0.000   0.000  0.00  0.00      IL  ", lines[1])
+            self.assertEqual("ATOM  10001  LI  LIT X" + last_residue + "       0.000"
+                             + " 10000.000   0.000  0.00  0.00      IL  ", lines[10001])
+            self.assertEqual("END", lines[10002])
+
+    def test_pdb_unknown_numbering(self):
+        system = self.__make_chain_system(1)
+        self.assertRaises(ValueError, savingutils.PDBSaver, self.__output_path("chain.pdb"), system, "roman")
+
+    def test_parallel_output_matches_serial(self):
+        system = self.__write_system_xyz(self.__make_chain_system(7))
+        chunk_sizes = (savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK, savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK,
+                       savingutils.PDBRenderer.LINES_PER_CHUNK)
+        savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK = 1
+        savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK = 2
+        savingutils.PDBRenderer.LINES_PER_CHUNK = 2
+
+        try:
+            outputs = {}
+            for workers in (1, 3):
+                psf_file_name = self.__output_path("chain-{}.psf".format(workers))
+                pdb_file_name = self.__output_path("chain-{}.pdb".format(workers))
+                savingutils.PSFSaver(psf_file_name, system, workers).save_to_file()
+                savingutils.PDBSaver(pdb_file_name, system, workers=workers).save_to_file()
+
+                with open(psf_file_name) as psf_file, open(pdb_file_name) as pdb_file:
+                    outputs[workers] = (psf_file.read(), pdb_file.read())
+        finally:
+            (savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK, savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK,
+             savingutils.PDBRenderer.LINES_PER_CHUNK) = chunk_sizes
+
+        self.assertEqual(outputs[1], outputs[3])
+
+    def test_psf_streaming_memory(self):
+        system = self.__make_chain_system(20000)
+        psf_file_name = self.__output_path("chain.psf")
+        buffer_size = 1 << 16
+        saver = savingutils.PSFSaver(psf_file_name, system, buffer_size=buffer_size)
+        chunk_sizes = (savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK, savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK)
+        savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK = 256
+        savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK = 1024
+
+        tracemalloc.start()
+        try:
+            self.assertTrue(saver.save_to_file())
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            (savingutils.PSFRenderer.CONNECTIVITY_LINES_PER_CHUNK,
+             savingutils.PSFRenderer.ATOM_LINES_PER_CHUNK) = chunk_sizes
+
+        largest_chunk = 1024 * len(savingutils.PSFRenderer.ATOM_LINE_FORMAT.format(
+            1, "IL", 1, "PRO", "C", "CT", 0.0, 12.011, 0.0, 0.0))
+        self.assertGreater(os.path.getsize(psf_file_name), 32 * largest_chunk)
+        self.assertLessEqual(saver.peak_buffered_size, buffer_size + largest_chunk)
+        self.assertLess(peak, 8 * largest_chunk)
+
+        with open(psf_file_name) as psf_file:
+            lines = psf_file.read().split("\n")
+        self.assertEqual(60000, int(lines[4].split()[0]))
+        (bonds_number, section) = self.__read_section(lines, "!NBOND")
+        self.assertEqual(40000, bonds_number)
+        self.assertEqual(10000, len(section))
+
+    def test_namd_binary_coordinates(self):
+        system = self.__write_system_xyz(self.__make_chain_system(2))
+        system.molecules[0][0].create_drude_atoms({0: 1.0})
+        coor_file_name = self.__output_path("chain.coor")
+        self.assertTrue(savingutils.NAMDBinarySaver(coor_file_name, system).save_to_file())
+
+        with open(coor_file_name, 'rb') as coor_file:
+            data = coor_file.read()
+        self.assertEqual(4 + 8 * 3 * 8, len(data))
+        self.assertEqual((8,), struct.unpack_from('<i', data))
+        coordinates = struct.unpack_from('<24d', data, 4)
+        self.assertEqual((0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.5, 0.0, 0.0, 3.0, 0.0, 0.0,
+                          0.0, 1.0, 0.0, 0.0, 1.0, 0.0, 1.5, 1.0, 0.0, 3.0, 1.0, 0.0), coordinates)
+
+    def test_dcd_trajectory(self):
+        system = self.__make_chain_system(2)
+        system.molecules[0][0].create_drude_atoms({1: 1.0})
+        trajectory_file_name = self.__output_path("trajectory.xyz")
+        with open(trajectory_file_name, 'w') as trajectory_file:
+            for frame in range(0, 3):
+                trajectory_file.write("6\nframe {}\n".format(frame))
+                for atom_index in range(0, 6):
+                    trajectory_file.write("C {} {} {}\n".format(frame, atom_index, -atom_index))
+
+        dcd_file_name = self.__output_path("chain.dcd")
+        self.assertTrue(savingutils.DCDSaver(dcd_file_name, system, trajectory_file_name).save_to_file())
+
+        with open(dcd_file_name, 'rb') as dcd_file:
+            data = dcd_file.read()
+        header = struct.unpack_from(savingutils.DCDSaver.HEADER_FORMAT, data)
+        self.assertEqual((84, b'CORD', 3), header[0:3])
+        self.assertEqual((24, 84), header[-2:])
+        position = struct.calcsize(savingutils.DCDSaver.HEADER_FORMAT) + \
+            struct.calcsize(savingutils.DCDSaver.TITLE_FORMAT)
+        self.assertEqual((4, 8, 4), struct.unpack_from(savingutils.DCDSaver.ATOMS_FORMAT, data, position))
+        position += struct.calcsize(savingutils.DCDSaver.ATOMS_FORMAT)
+
+        record_format = '<i8fi'
+        frames = []
+        while position < len(data):
+            frame = []
+            for axis in range(0, 3):
+                record = struct.unpack_from(record_format, data, position)
+                self.assertEqual((32, 32), (record[0], record[-1]))
+                frame.append(list(record[1:-1]))
+                position += struct.calcsize(record_format)
+            frames.append(frame)
+
+        self.assertEqual(3, len(frames))
+        self.assertEqual([2.0] * 8, frames[2][0])
+        self.assertEqual([0.0, 1.0, 1.0, 2.0, 3.0, 4.0, 4.0, 5.0], frames[1][1])
+        self.assertEqual([-0.0, -1.0, -1.0, -2.0, -3.0, -4.0, -4.0, -5.0], frames[0][2])
+
+    def test_dcd_invalid_frame(self):
+        system = self.__make_chain_system(1)
+        trajectory_file_name = self.__output_path("trajectory.xyz")
+        with open(trajectory_file_name, 'w') as trajectory_file:
+            trajectory_file.write("3\n\nC 0 0 0\nC 1 0 0\nC 2 0 0\n3\n\nC 0 0 0\nO 1 0 0\nC 2 0 0\n")
+
+        dcd_file_name = self.__output_path("chain.dcd")
+        self.assertFalse(savingutils.DCDSaver(dcd_file_name, system, trajectory_file_name).save_to_file())
+        self.assertFalse(os.path.exists(dcd_file_name))
+
+    def test_compressed_and_stream_outputs(self):
+        system = self.__write_system_xyz(self.__make_chain_system(3))
+        pdb_file_name = self.__output_path("chain.pdb")
+        self.assertTrue(savingutils.PDBSaver(pdb_file_name, system).save_to_file())
+        with open(pdb_file_name, 'rb') as pdb_file:
+            expected = pdb_file.read()
+
+        self.assertTrue(savingutils.PDBSaver(pdb_file_name + ".gz", system).save_to_file())
+        with gzip.open(pdb_file_name + ".gz", 'rb') as pdb_file:
+            self.assertEqual(expected, pdb_file.read())
+
+        binary_stream = io.BytesIO()
+        self.assertTrue(savingutils.PDBSaver(binary_stream, system, compression="xz").save_to_file())
+        self.assertEqual(expected, lzma.decompress(binary_stream.getvalue()))
+
+        text_stream = io.StringIO()
+        self.assertTrue(savingutils.PDBSaver(text_stream, system).save_to_file())
+        self.assertEqual(expected.decode(), text_stream.getvalue())
+
+        with self.assertRaises(ValueError):
+            savingutils.NAMDBinarySaver(io.StringIO(), system).save_to_file()
+        with self.assertRaises(ValueError):
+            savingutils.PSFSaver(io.StringIO(), system, compression="gzip").save_to_file()
+        text_wrapper = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        self.assertTrue(savingutils.PDBSaver(text_wrapper, system, compression="gzip").save_to_file())
+        self.assertEqual(expected, gzip.decompress(text_wrapper.buffer.getvalue()))
+        with self.assertRaises(ValueError):
+            savingutils.PSFSaver(binary_stream, system, compression="zip")
+
+    def test_dcd_stream_matches_file(self):
+        system = self.__write_system_xyz(self.__make_chain_system(2))
+        dcd_file_name = self.__output_path("chain.dcd")
+        self.assertTrue(savingutils.DCDSaver(dcd_file_name, system).save_to_file())
+
+        stream = io.BytesIO()
+        self.assertTrue(savingutils.DCDSaver(stream, system, compression="gzip").save_to_file())
+        with open(dcd_file_name, 'rb') as dcd_file:
+            self.assertEqual(dcd_file.read(), gzip.decompress(stream.getvalue()))
+
+    def test_failed_save_keeps_previous_file(self):
+        system = self.__write_system_xyz(self.__make_chain_system(1))
+        pdb_file_name = self.__output_path("chain.pdb")
+        with open(pdb_file_name, 'w') as pdb_file:
+            pdb_file.write("previous")
+        with open(system.xyz_file_name) as xyz_file:
+            lines = xyz_file.readlines()
+        lines[3] = lines[3].replace("C", "N")
+        with open(system.xyz_file_name, 'w') as xyz_file:
+            xyz_file.writelines(lines)
+
+        self.assertFalse(savingutils.PDBSaver(pdb_file_name, system).save_to_file())
+        with open(pdb_file_name) as pdb_file:
+            self.assertEqual("previous", pdb_file.read())
+        self.assertEqual(["chain.pdb", "system.xyz"], sorted(os.listdir(self._output_directory.name)))
+
+    def test_save_concurrently(self):
+        system = self.__write_system_xyz(self.__make_chain_system(3))
+        psf_file_name = self.__output_path("chain.psf")
+        pdb_file_name = self.__output_path("chain.pdb")
+
+        succeeded = savingutils.save_concurrently(system, [(savingutils.PSFSaver, psf_file_name, ()),
+                                                           (savingutils.PDBSaver, pdb_file_name, ())])
+        self.assertTrue(succeeded)
+        self.assertEqual(["chain.pdb", "chain.psf", "system.xyz"], sorted(os.listdir(self._output_directory.name)))
+
+    def test_save_concurrently_failure(self):
+        system = self.__write_system_xyz(self.__make_chain_system(3))
+        with open(system.xyz_file_name) as xyz_file:
+            lines = xyz_file.readlines()
+        lines[3] = lines[3].replace("C", "N")
+        with open(system.xyz_file_name, 'w') as xyz_file:
+            xyz_file.writelines(lines)
+
+        succeeded = savingutils.save_concurrently(system, [
+            (savingutils.PSFSaver, self.__output_path("chain.psf"), ()),
+            (savingutils.PDBSaver, self.__output_path("chain.pdb"), ())])
+        self.assertFalse(succeeded)
+        self.assertEqual(["system.xyz"], os.listdir(self._output_directory.name))
+
+    def test_save_concurrently_failure_while_writing(self):
+        system = self.__make_chain_system(3)
+
+        succeeded = savingutils.save_concurrently(system, [(SlowSaver, self.__output_path("slow.psf"), ()),
+                                                           (FailingSaver, self.__output_path("failing.pdb"), ())])
+        self.assertFalse(succeeded)
+        self.assertEqual([], os.listdir(self._output_directory.name))
+
+    def test_save_concurrently_interrupted(self):
+        system = self.__make_chain_system(3)
+        directory = self._output_directory.name
+
+        def interrupt(results, processes):
+            # once the slow saver is writing
+            for _ in range(0, 100):
+                if os.listdir(directory):
+                    break
+                time.sleep(0.05)
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(savingutils, "_wait_for_result", interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                savingutils.save_concurrently(system, [(SlowSaver, self.__output_path("slow.psf"), ())])
+        self.assertEqual([], os.listdir(directory))
@@ -0,0 +1,40 @@
+import tempfile
+import unittest
+
+from utils import readingutils, syntheticutils
+
+
+class TestSyntheticUtils(unittest.TestCase):
+
+    def setUp(self):
+        self._output_directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._output_directory.cleanup()
+
+    def __read_system(self, tinker_format, include_drude, tinker_connectivity="conn"):
+        packmol_file_name = syntheticutils.generate_system(self._output_directory.name, 1005, tinker_format, 5)
+        reader = readingutils.InputReader(packmol_file_name, tinker_format, include_drude,
+                                          tinker_connectivity=tinker_connectivity)
+        reader.parse_packmol_input()
+        return reader.read_xyz_data()
+
+    def test_default_system(self):
+        system = self.__read_system(False, False)
+
+        self.assertEqual(1005, system.atoms_number)
+        self.assertEqual((201 * 4, 201 * 3, 201 * 2), (system.bonds_number, system.angles_number,
+                                                       system.dihedrals_number))
+        self.assertEqual(1005, readingutils.SystemXYZReader(system.xyz_file_name).read().atoms_number)
+
+    def test_tinker_drude_system(self):
+        system = self.__read_system(True, True)
+        molecule = system.molecules[0][0]
+
+        self.assertEqual(2010, system.atoms_number_with_drude)
+        self.assertEqual(syntheticutils.RESIDUE_NAME, molecule.residue_name)
+        self.assertEqual(molecule.bonds, self.__read_system(True, True, "xyz").molecules[0][0].bonds)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import random
+import unittest
+from array import array
+from itertools import combinations
+from math import sqrt
+
+from utils import model, validationutils
+
+
+def distance(first, second):
+    return sqrt(sum((first[axis] - second[axis]) ** 2 for axis in range(0, 3)))
+
+
+class TestValidationUtils(unittest.TestCase):
+
+    @staticmethod
+    def __make_system(positions, copies, drude=False, residue=None):
+        # chain residues of three bonded carbons or residues of unbonded carbons at the residue positions,
+        # positions gives x, y, z of every atom of the system
+        atoms = [model.Atom("C", model.Coordinates(*position), 0.0, 12.011, "CT")
+                 for position in residue or [(1.5 * i, 0.0, 0.0) for i in range(0, 3)]]
+        molecule = model.Molecule(atoms, "PRO")
+        if drude:
+            molecule.create_drude_atoms({0: 1.0, 1: 1.0})
+        shifts = molecule.shifts
+        if residue is None:
+            molecule.bonds = ((shifts[0], 1 + shifts[1]), (1 + shifts[1], 2 + shifts[2]))
+        system = model.System([(molecule, copies)], "unused.xyz")
+        coordinates = model.SystemCoordinates(len(positions), model.SymbolTable(), array('I', [0] * len(positions)),
+                                              array('d', [value for position in positions for value in position]))
+
+        return system, coordinates
+
+    def test_valid_geometry(self):
+        positions = [(1.5 * i, 3.0 * copy, 0.0) for copy in range(0, 4) for i in range(0, 3)]
+        (system, coordinates) = self.__make_system(positions, 4)
+
+        report = validationutils.validate_geometry(system, coordinates)
+        self.assertTrue(report.valid)
+        self.assertEqual(8, report.bonds_checked)
+        self.assertEqual({}, report.residues)
+        self.assertRaises(ValueError, validationutils.validate_geometry, system, coordinates, clash_distance=0.0)
+        for tolerance in (-0.1, float('nan'), float('inf')):
+            self.assertRaises(ValueError, validationutils.validate_geometry, system, coordinates,
+                              bond_tolerance=tolerance)
+            self.assertRaises(ValueError, validationutils.check_bonds, system, coordinates.coordinates, tolerance,
+                              validationutils.GeometryReport())
+
+    def test_stretched_bonds_and_clashes(self):
+        # the last atom of the third residue is pulled away, the fourth residue is moved onto the third one
+        positions = [(1.5 * i, min(3.0 * copy, 6.5), 0.0) for copy in range(0, 4) for i in range(0, 3)]
+        positions[8] = (4.0, 6.0, 0.0)
+        (system, coordinates) = self.__make_system(positions, 4, drude=True)
+
+        report = validationutils.validate_geometry(system, coordinates)
+        self.assertFalse(report.valid)
+        self.assertEqual(1, report.stretched_bonds_number)
+        self.assertEqual([(2, 1, 2, 2.5, 1.5)], report.stretched_bonds)
+        self.assertEqual(2, report.clashes_number)
+        self.assertEqual([(6, 9), (7, 10)], sorted(clash[0:2] for clash in report.clashes))
+        self.assertAlmostEqual(0.5, report.clashes[0][2])
+        self.assertEqual({2: (1, 2), 3: (0, 2)}, report.residues)
+        self.assertIn("residue PRO 3 (line 9)", report.summary(system, coordinates))
+
+    def test_clashes_match_all_pairs(self):
+        random.seed(5)
+        copies = 400
+        positions = [(random.uniform(0.0, 20.0), random.uniform(-10.0, 10.0), random.uniform(0.0, 20.0))
+                     for _ in range(0, 3 * copies)]
+        (system, coordinates) = self.__make_system(positions, copies)
+
+        expected = sum(1 for (first, second) in combinations(range(0, len(positions)), 2)
+                       if first // 3 != second // 3 and distance(positions[first], positions[second]) < 1.2)
+        report = validationutils.validate_geometry(system, coordinates, clash_distance=1.2)
+        self.assertEqual(expected, report.clashes_number)
+        self.assertEqual(0, report.overcrowded_atoms_number)
+
+    def test_overcrowded_cells(self):
+        (system, coordinates) = self.__make_system([(0.0, 0.0, 0.0)] * 30, 10)
+
+        report = validationutils.validate_geometry(system, coordinates)
+        self.assertEqual(30, report.overcrowded_atoms_number)
+        self.assertFalse(report.valid)
+
+    def test_large_clash_distance(self):
+        # residues of 27 atoms 1 A apart fill whole cells of the grid, copies are 4 A apart
+        residue = [(float(x), float(y), float(z)) for x in range(0, 3) for y in range(0, 3) for z in range(0, 3)]
+        positions = [(x + 6.0 * copy, y, z) for copy in range(0, 5) for (x, y, z) in residue]
+        (system, coordinates) = self.__make_system(positions, 5, residue=residue)
+
+        report = validationutils.validate_geometry(system, coordinates, clash_distance=3.5)
+        self.assertTrue(report.valid)
+        # only facing atoms of neighbouring copies clash
+        report = validationutils.validate_geometry(system, coordinates, clash_distance=4.05)
+        self.assertEqual(0, report.overcrowded_atoms_number)
+        self.assertEqual(4 * 9, report.clashes_number)
+
+    def test_dense_clashes_match_all_pairs(self):
+        random.seed(7)
+        residue = [(float(x), float(y), float(z)) for x in range(0, 3) for y in range(0, 2) for z in range(0, 2)]
+        positions = []
+        for _ in range(0, 60):
+            shift = (random.uniform(0.0, 30.0), random.uniform(0.0, 30.0), random.uniform(0.0, 30.0))
+            positions.extend(tuple(map(sum, zip(shift, position))) for position in residue)
+        (system, coordinates) = self.__make_system(positions, 60, residue=residue)
+
+        expected = sum(1 for (first, second) in combinations(range(0, len(positions)), 2)
+                       if first // 12 != second // 12 and distance(positions[first], positions[second]) < 2.5)
+        report = validationutils.validate_geometry(system, coordinates, clash_distance=2.5)
+        self.assertEqual(0, report.overcrowded_atoms_number)
+        self.assertEqual(expected, report.clashes_number)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import io
+
+from utils import model, readingutils, savingutils
+
+OUTPUT_FORMATS = ("psf", "pdb", "coor", "dcd")
+
+
+def build_system(input_file_name, outputs=None, tinker_format=False, include_drude=False,
+                 bond_threshold=model.Molecule.DEFAULT_BOND_THRESHOLD, bond_cutoffs=None, template_cache=None,
+                 tinker_connectivity=readingutils.InputReader.TINKER_CONNECTIVITY_CONN,
+                 pdb_numbering=savingutils.PDBSaver.NUMBERING_HYBRID36, trajectory_file_name=None,
+                 compression=savingutils.OutputTarget.COMPRESSION_AUTO, profiler=None):
+    # outputs maps any of OUTPUT_FORMATS to a file name, a binary or text stream, or None to render it in memory;
+    # returns the system and a dictionary of outputs rendered in memory as bytes
+    outputs = outputs or {}
+    unknown_formats = set(outputs) - set(OUTPUT_FORMATS)
+    if unknown_formats:
+        raise ValueError("Unknown output formats: {}".format(", ".join(sorted(unknown_formats))))
+
+    reader = readingutils.InputReader(input_file_name, tinker_format, include_drude, bond_threshold, bond_cutoffs,
+                                      template_cache, tinker_connectivity, profiler)
+    reader.parse_packmol_input()
+    system = reader.read_xyz_data()
+
+    rendered = {}
+    for output_format in OUTPUT_FORMATS:
+        if output_format not in outputs:
+            continue
+
+        target = outputs[output_format]
+        if target is None:
+            target = io.BytesIO()
+
+        saver = create_saver(output_format, target, system, pdb_numbering, trajectory_file_name, compression,
+                             profiler)
+        if not saver.save_to_file():
+            raise RuntimeError("Writing {} output failed, see messages above".format(output_format.upper()))
+
+        if outputs[output_format] is None:
+            rendered[output_format] = target.getvalue()
+
+    return system, rendered
+
+
+def create_saver(output_format, target, system, pdb_numbering, trajectory_file_name, compression, profiler):
+    if output_format == "psf":
+        return savingutils.PSFSaver(target, system, profiler=profiler, compression=compression)
+    if output_format == "pdb":
+        return savingutils.PDBSaver(target, system, pdb_numbering, profiler=profiler, compression=compression)
+    if output_format == "coor":
+        return savingutils.NAMDBinarySaver(target, system, profiler=profiler, compression=compression)
+
+    return savingutils.DCDSaver(target, system, trajectory_file_name, profiler=profiler, compression=compression)
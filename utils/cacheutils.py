@@ -0,0 +1,156 @@
+import hashlib
+import os
+import pickle
+
+
+# bump whenever the pickled form of Molecule changes or topology is derived differently
+TEMPLATE_FORMAT_VERSION = 5
+
+
+def template_key(file_names, options):
+    # files which do not exist are hashed as missing, so creating them later invalidates the entry
+    digest = hashlib.sha256()
+    digest.update(repr((TEMPLATE_FORMAT_VERSION, options)).encode())
+
+    for file_name in file_names:
+        digest.update(b'\0')
+        try:
+            with open(file_name, 'rb') as input_file:
+                digest.update(b'F')
+                for block in iter(lambda: input_file.read(1 << 20), b''):
+                    digest.update(block)
+        except FileNotFoundError:
+            digest.update(b'M')
+
+    return digest.hexdigest()
+
+
+class TemplateCache:
+    ENTRY_SUFFIX = '.template'
+    DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self._directory = directory
+        self._max_size = max_size
+        self._warned = False
+
+    @staticmethod
+    def default_directory():
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(cache_home, 'psf-pdb-builder')
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def key(self, file_names, options):
+        return template_key(file_names, options)
+
+    def load(self, key):
+        # a cache which cannot be used only makes residues parsed again
+        entry_name = self.__entry_name(key)
+        try:
+            with open(entry_name, 'rb') as entry_file:
+                molecule = pickle.load(entry_file)
+        except FileNotFoundError:
+            return None
+        except OSError as error:
+            self.__warn(error)
+            return None
+        except Exception:
+            # damaged or incompatible entry, treat it as missing
+            self.__remove(entry_name)
+            return None
+
+        try:
+            os.utime(entry_name)
+        except OSError:
+            pass
+        return molecule
+
+    def store(self, key, molecule):
+        entry_name = self.__entry_name(key)
+        partial_name = '{}.{}.partial'.format(entry_name, os.getpid())
+
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(partial_name, 'wb') as entry_file:
+                pickle.dump(molecule, entry_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(partial_name, entry_name)
+
+            self.__evict()
+        except OSError as error:
+            self.__warn(error)
+            self.__remove(partial_name)
+
+    def clear(self):
+        for (entry_name, size, modification_time) in self.__entries():
+            self.__remove(entry_name)
+
+    def __warn(self, error):
+        # printed once, every residue would fail the same way
+        if not self._warned:
+            print('[WARNING] Residue template cache in {} cannot be used, residues are parsed again: {}'.format(
+                self._directory, error))
+            self._warned = True
+
+    def __entry_name(self, key):
+        return os.path.join(self._directory, key + self.ENTRY_SUFFIX)
+
+    def __entries(self):
+        result = []
+        if not os.path.isdir(self._directory):
+            return result
+
+        for file_name in os.listdir(self._directory):
+            if file_name.endswith(self.ENTRY_SUFFIX):
+                entry_name = os.path.join(self._directory, file_name)
+                try:
+                    status = os.stat(entry_name)
+                except FileNotFoundError:
+                    continue
+                result.append((entry_name, status.st_size, status.st_mtime))
+
+        return result
+
+    def __evict(self):
+        # least recently used entries are removed first, loading an entry refreshes its modification time
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        total_size = sum(entry[1] for entry in entries)
+
+        for (entry_name, size, modification_time) in entries:
+            if total_size <= self._max_size:
+                break
+            self.__remove(entry_name)
+            total_size -= size
+
+    @staticmethod
+    def __remove(entry_name):
+        try:
+            os.remove(entry_name)
+        except OSError:
+            pass
+
+
+class MemoryTemplateCache:
+    # keeps templates of one process in memory, optionally in front of a persistent TemplateCache
+    def __init__(self, backing_cache=None):
+        self._backing_cache = backing_cache
+        self._molecules = {}
+
+    def key(self, file_names, options):
+        return template_key(file_names, options)
+
+    def load(self, key):
+        molecule = self._molecules.get(key)
+        if molecule is None and self._backing_cache is not None:
+            molecule = self._backing_cache.load(key)
+            if molecule is not None:
+                self._molecules[key] = molecule
+
+        return molecule
+
+    def store(self, key, molecule):
+        self._molecules[key] = molecule
+        if self._backing_cache is not None:
+            self._backing_cache.store(key, molecule)
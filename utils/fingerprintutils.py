@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+# bump whenever the content of an output changes for the same inputs, so outputs built before are rebuilt
+FINGERPRINT_VERSION = 2
+RECORD_SUFFIX = '.fingerprint'
+BLOCK_SIZE = 1 << 20
+
+
+def file_fingerprint(file_name, previous=None):
+    # size, modification time and SHA-256 of a file, None when it does not exist; the digest of previous is reused
+    # when the size and modification time did not change, so unchanged large files are not read again
+    try:
+        status = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+
+    if previous is not None and previous["size"] == status.st_size and previous["mtime_ns"] == status.st_mtime_ns:
+        return previous
+
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return {"size": status.st_size, "mtime_ns": status.st_mtime_ns, "sha256": digest.hexdigest()}
+
+
+def output_status(file_name):
+    try:
+        status = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+
+    return {"size": status.st_size, "mtime_ns": status.st_mtime_ns}
+
+
+class OutputFingerprint:
+    # fingerprints of all inputs of an output file, recorded next to it after it was written; the output is up to date
+    # while neither its inputs, nor options, nor the output itself changed
+    def __init__(self, output_file_name, input_file_names, options):
+        self._output_file_name = output_file_name
+        self._record_file_name = output_file_name + RECORD_SUFFIX
+        self._options = repr((FINGERPRINT_VERSION, options))
+        self._previous = self.__load()
+
+        previous_inputs = self._previous["inputs"] if self._previous else {}
+        self._inputs = {}
+        for file_name in input_file_names:
+            file_name = os.path.realpath(file_name)
+            self._inputs[file_name] = file_fingerprint(file_name, previous_inputs.get(file_name))
+
+    @property
+    def output_file_name(self):
+        return self._output_file_name
+
+    def up_to_date(self):
+        previous = self._previous
+        return previous is not None and previous["options"] == self._options and \
+            self.__digests(previous["inputs"]) == self.__digests(self._inputs) and \
+            previous["output"] is not None and previous["output"] == output_status(self._output_file_name)
+
+    def invalidate(self):
+        # an output which fails to be rebuilt keeps its old content, which must not be taken as up to date
+        try:
+            os.remove(self._record_file_name)
+        except FileNotFoundError:
+            pass
+
+    def record(self):
+        record = {"options": self._options, "inputs": self._inputs,
+                  "output": output_status(self._output_file_name)}
+        partial_name = '{}.{}.partial'.format(self._record_file_name, os.getpid())
+        with open(partial_name, 'w') as record_file:
+            json.dump(record, record_file, indent=1, sort_keys=True)
+        os.replace(partial_name, self._record_file_name)
+
+    @staticmethod
+    def __digests(inputs):
+        # a file touched without changes keeps its digest
+        return {file_name: fingerprint and fingerprint["sha256"] for (file_name, fingerprint) in inputs.items()}
+
+    def __load(self):
+        try:
+            with open(self._record_file_name, 'r') as record_file:
+                record = json.load(record_file)
+            if not {"options", "inputs", "output"} <= set(record):
+                return None
+            return record
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # damaged record, the output is rebuilt
+            return None
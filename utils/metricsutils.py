@@ -0,0 +1,132 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    # a stage entered several times, e.g. once per residue, accumulates times and counts of all its calls
+    def __init__(self, name):
+        self._name = name
+        self._calls = 0
+        self._wall_time = 0.0
+        self._cpu_time = 0.0
+        self._peak_memory = None
+        self._counts = {}
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def calls(self):
+        return self._calls
+
+    @property
+    def wall_time(self):
+        return self._wall_time
+
+    @property
+    def cpu_time(self):
+        return self._cpu_time
+
+    @property
+    def peak_memory(self):
+        # bytes, None when memory is not traced
+        return self._peak_memory
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def count(self, name, value):
+        self._counts[name] = self._counts.get(name, 0) + value
+
+    def as_dict(self):
+        return {"name": self._name, "calls": self._calls, "wall_time": self._wall_time, "cpu_time": self._cpu_time,
+                "peak_memory": self._peak_memory, "counts": dict(self._counts)}
+
+
+class Profiler:
+    def __init__(self, trace_memory=False, hook=None):
+        # hook is called with ("start" or "end", stage name) around every stage, e.g. to drive an external profiler
+        self._trace_memory = trace_memory
+        self._hook = hook
+        self._stages = {}
+        self._open_peaks = []
+        self._started_tracing = False
+
+    @property
+    def stages(self):
+        return list(self._stages.values())
+
+    def start(self):
+        if self._trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        metrics = self._stages.get(name)
+        if metrics is None:
+            metrics = self._stages[name] = StageMetrics(name)
+
+        tracing = self._trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # peak of enclosing stages is kept before the peak is reset for this one
+            peak = tracemalloc.get_traced_memory()[1]
+            self._open_peaks = [max(open_peak, peak) for open_peak in self._open_peaks]
+            # before Python 3.9 the peak cannot be reset and covers everything traced so far
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self._open_peaks.append(0)
+
+        if self._hook is not None:
+            self._hook("start", name)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        try:
+            yield metrics
+        finally:
+            metrics._wall_time += time.perf_counter() - wall_start
+            metrics._cpu_time += time.process_time() - cpu_start
+            metrics._calls += 1
+            if self._hook is not None:
+                self._hook("end", name)
+
+            if tracing:
+                peak = max(self._open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                self._open_peaks = [max(open_peak, peak) for open_peak in self._open_peaks]
+                metrics._peak_memory = max(metrics._peak_memory or 0, peak)
+
+    def report(self):
+        lines = ["{:<24} {:>5} {:>10} {:>10} {:>12}  {}".format("stage", "calls", "wall [s]", "cpu [s]",
+                                                                "peak [MiB]", "counts")]
+        for metrics in self._stages.values():
+            peak_memory = "-" if metrics.peak_memory is None else "{:.2f}".format(metrics.peak_memory / 2 ** 20)
+            counts = ", ".join("{} {}".format(name, value) for (name, value) in metrics.counts.items())
+            lines.append("{:<24} {:>5} {:>10.3f} {:>10.3f} {:>12}  {}".format(metrics.name, metrics.calls,
+                                                                            metrics.wall_time, metrics.cpu_time,
+                                                                            peak_memory, counts))
+
+        return "\n".join(lines)
+
+    def save_json(self, file_name):
+        with open(file_name, 'w') as json_file:
+            json.dump({"stages": [metrics.as_dict() for metrics in self._stages.values()]}, json_file, indent=2)
+
+
+class NullProfiler(Profiler):
+    # used when nothing is profiled, stages are neither measured nor stored
+    @contextmanager
+    def stage(self, name):
+        yield StageMetrics(name)
+
+
+NULL_PROFILER = NullProfiler()
@@ -1,9 +1,26 @@
-from collections import Counter
-from functools import reduce
-from math import sqrt
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from itertools import product
+from math import floor, sqrt
+
+NEIGHBOUR_CELL_OFFSETS = tuple(product((-1, 0, 1), repeat=3))
+
+
+def build_cells(coordinates, cell_size):
+    # indices of the atoms in every cell of a grid of the given size, atoms closer than cell_size are in the same or
+    # neighbouring cells
+    cells = defaultdict(list)
+    for atom_index in range(0, len(coordinates) // 3):
+        x, y, z = coordinates[3 * atom_index:3 * atom_index + 3]
+        cells[(floor(x / cell_size), floor(y / cell_size), floor(z / cell_size))].append(atom_index)
+
+    return cells
 
 
 class Coordinates:
+    __slots__ = ('_x', '_y', '_z')
+
     def __init__(self, x=0.0, y=0.0, z=0.0):
         self._x = x
         self._y = y
@@ -43,121 +60,315 @@ class Coordinates:
         return str(self._x) + ' ' + str(self._y) + ' ' + str(self._z)
 
 
-class Atom:
+class SymbolTable:
+    __slots__ = ('_symbols', '_ids')
+
+    def __init__(self):
+        self._symbols = []
+        self._ids = {}
+
+    def intern(self, symbol):
+        symbol_id = self._ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = len(self._symbols)
+            self._symbols.append(symbol)
+            self._ids[symbol] = symbol_id
+
+        return symbol_id
+
+    def get(self, symbol, default=None):
+        return self._ids.get(symbol, default)
+
+    def __getitem__(self, symbol_id):
+        return self._symbols[symbol_id]
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+class ResidueTemplate:
+    # structure of arrays holding per-atom data of a residue, atom i occupies coordinates[3 * i:3 * i + 3]
+    __slots__ = ('_symbols', '_namd_symbols', '_symbol_ids', '_namd_symbol_ids', '_coordinates', '_charges',
+                 '_masses', '_polarizabilities', '_last_parameters', '_drude_flags', '_drude_namd_symbol_ids',
+                 '_drude_charges', '_drude_masses', '_drude_number')
+
     DRUDE_CHARGE_FACTOR = -0.0548768646057431
     POLARIZABLE_CENTER_LAST_PARAMETER = 1.3
 
+    def __init__(self):
+        self._symbols = SymbolTable()
+        self._namd_symbols = SymbolTable()
+        self._symbol_ids = array('I')
+        self._namd_symbol_ids = array('I')
+        self._coordinates = array('d')
+        self._charges = array('d')
+        self._masses = array('d')
+        self._polarizabilities = array('d')
+        self._last_parameters = array('d')
+        self._drude_flags = bytearray()
+        self._drude_namd_symbol_ids = array('I')
+        self._drude_charges = array('d')
+        self._drude_masses = array('d')
+        self._drude_number = 0
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        template = cls()
+        for atom in atoms:
+            coordinates = atom.coordinates
+            index = template.append(atom.symbol, coordinates.x, coordinates.y, coordinates.z,
+                                    atom.charge, atom.mass, atom.namd_symbol)
+            template._polarizabilities[index] = atom.polarizability
+            template._last_parameters[index] = atom.last_parameter
+
+            drude_atom = atom.drude_atom
+            if drude_atom is not None:
+                template.set_drude(index, drude_atom.charge, drude_atom.mass, drude_atom.namd_symbol)
+
+        return template
+
+    def __len__(self):
+        return len(self._symbol_ids)
+
+    def append(self, symbol, x, y, z, charge=0.0, mass=0.0, namd_symbol=None):
+        self._symbol_ids.append(self._symbols.intern(symbol))
+        self._namd_symbol_ids.append(self._namd_symbols.intern(symbol if namd_symbol is None else namd_symbol))
+        self._coordinates.extend((x, y, z))
+        self._charges.append(charge)
+        self._masses.append(mass)
+        self._polarizabilities.append(0.0)
+        self._last_parameters.append(0.0)
+        self._drude_flags.append(0)
+        self._drude_namd_symbol_ids.append(0)
+        self._drude_charges.append(0.0)
+        self._drude_masses.append(0.0)
+
+        return len(self) - 1
+
+    @property
+    def coordinates(self):
+        return self._coordinates
+
+    @property
+    def charges(self):
+        return self._charges
+
+    @property
+    def masses(self):
+        return self._masses
+
+    @property
+    def polarizabilities(self):
+        return self._polarizabilities
+
+    @property
+    def last_parameters(self):
+        return self._last_parameters
+
+    @property
+    def drude_flags(self):
+        return self._drude_flags
+
+    @property
+    def drude_charges(self):
+        return self._drude_charges
+
+    @property
+    def drude_masses(self):
+        return self._drude_masses
+
+    @property
+    def drude_number(self):
+        return self._drude_number
+
+    def symbol(self, index):
+        return self._symbols[self._symbol_ids[index]]
+
+    def namd_symbol(self, index):
+        return self._namd_symbols[self._namd_symbol_ids[index]]
+
+    def set_namd_symbol(self, index, namd_symbol):
+        self._namd_symbol_ids[index] = self._namd_symbols.intern(namd_symbol)
+
+    def drude_namd_symbol(self, index):
+        return self._namd_symbols[self._drude_namd_symbol_ids[index]]
+
+    def atom_coordinates(self, index):
+        offset = 3 * index
+        return Coordinates(self._coordinates[offset], self._coordinates[offset + 1], self._coordinates[offset + 2])
+
+    def set_drude(self, index, charge, mass, namd_symbol):
+        self._drude_number += 1 - self._drude_flags[index]
+        self._drude_flags[index] = 1
+        self._drude_namd_symbol_ids[index] = self._namd_symbols.intern(namd_symbol)
+        self._drude_charges[index] = charge
+        self._drude_masses[index] = mass
+
+    def remove_drude(self, index):
+        self._drude_number -= self._drude_flags[index]
+        self._drude_flags[index] = 0
+        self._drude_namd_symbol_ids[index] = 0
+        self._drude_charges[index] = 0.0
+        self._drude_masses[index] = 0.0
+
+    def create_drude(self, index, polarizability, bond_const=1000, mass=0.4):
+        drude_namd_symbol = "D" + self.namd_symbol(index)[:2]
+        drude_charge = self.DRUDE_CHARGE_FACTOR * sqrt(polarizability * bond_const)
+        self.set_drude(index, drude_charge, mass, drude_namd_symbol)
+
+        self._masses[index] -= mass
+        self._charges[index] -= drude_charge
+        self._polarizabilities[index] = -polarizability
+        self._last_parameters[index] = self.POLARIZABLE_CENTER_LAST_PARAMETER
+
+
+class Atom:
+    # thin view of a single atom stored in a ResidueTemplate
+    __slots__ = ('_template', '_index')
+
+    DRUDE_CHARGE_FACTOR = ResidueTemplate.DRUDE_CHARGE_FACTOR
+    POLARIZABLE_CENTER_LAST_PARAMETER = ResidueTemplate.POLARIZABLE_CENTER_LAST_PARAMETER
+
     def __init__(self, symbol, coordinates, charge=0.0, mass=0.0, namd_symbol=None):
-        self._symbol = symbol
-        self._coordinates = coordinates
-        self._charge = charge
-        self._mass = mass
-        self._drude_atom = None
-        self._polarizability = 0.0
-        self._last_parameter = 0.0
-
-        if namd_symbol is None:
-            self._namd_symbol = symbol
-        else:
-            self._namd_symbol = namd_symbol
+        self._template = ResidueTemplate()
+        self._index = self._template.append(symbol, coordinates.x, coordinates.y, coordinates.z,
+                                            charge, mass, namd_symbol)
+
+    @classmethod
+    def view(cls, template, index):
+        atom = cls.__new__(cls)
+        atom._template = template
+        atom._index = index
+        return atom
+
+    @property
+    def template(self):
+        return self._template
+
+    @property
+    def index(self):
+        return self._index
 
     @property
     def symbol(self):
-        return self._symbol
+        return self._template.symbol(self._index)
 
     @property
     def coordinates(self):
-        return self._coordinates
+        return self._template.atom_coordinates(self._index)
 
     @property
     def charge(self):
-        return self._charge
+        return self._template.charges[self._index]
 
     @charge.setter
     def charge(self, charge):
-        self._charge = charge
+        self._template.charges[self._index] = charge
 
     @property
     def mass(self):
-        return self._mass
+        return self._template.masses[self._index]
 
     @mass.setter
     def mass(self, mass):
-        self._mass = mass
+        self._template.masses[self._index] = mass
 
     @property
     def namd_symbol(self):
-        return self._namd_symbol
+        return self._template.namd_symbol(self._index)
 
     @namd_symbol.setter
     def namd_symbol(self, namd_symbol):
-        self._namd_symbol = namd_symbol
+        self._template.set_namd_symbol(self._index, namd_symbol)
 
     @property
     def drude_atom(self):
-        return self._drude_atom
+        template = self._template
+        index = self._index
+        if not template.drude_flags[index]:
+            return None
+
+        return Atom(template.symbol(index), template.atom_coordinates(index), template.drude_charges[index],
+                    template.drude_masses[index], template.drude_namd_symbol(index))
 
     @drude_atom.setter
     def drude_atom(self, drude_atom):
-        self._drude_atom = drude_atom
+        if drude_atom is None:
+            self._template.remove_drude(self._index)
+        else:
+            self._template.set_drude(self._index, drude_atom.charge, drude_atom.mass, drude_atom.namd_symbol)
 
     @property
     def polarizability(self):
-        return self._polarizability
+        return self._template.polarizabilities[self._index]
 
     @property
     def last_parameter(self):
-        return self._last_parameter
+        return self._template.last_parameters[self._index]
 
     def __eq__(self, other):
         if not isinstance(other, Atom):
             return NotImplemented
 
-        return self._symbol == other._symbol and \
-               self._coordinates == other._coordinates and \
-               self._charge == other._charge and \
-               self._mass == other._mass and \
-               self._namd_symbol == other._namd_symbol
+        return self.symbol == other.symbol and \
+               self.coordinates == other.coordinates and \
+               self.charge == other.charge and \
+               self.mass == other.mass and \
+               self.namd_symbol == other.namd_symbol
 
     def create_drude_atom(self, polarizability, bond_const=1000, mass=0.4):
-        drude_namd_symbol = "D" + self._namd_symbol[:2]
-        drude_charge = self.DRUDE_CHARGE_FACTOR * sqrt(polarizability * bond_const)
-        drude_atom = Atom(self._symbol, self._coordinates, drude_charge, mass, drude_namd_symbol)
-
-        self._mass -= mass
-        self._charge -= drude_charge
-        self._drude_atom = drude_atom
-        self._polarizability = -polarizability
-        self._last_parameter = self.POLARIZABLE_CENTER_LAST_PARAMETER
+        self._template.create_drude(self._index, polarizability, bond_const, mass)
 
     def __hash__(self):
-        return hash((self._symbol, self._coordinates, self._charge, self._mass, self._namd_symbol))
+        return hash((self.symbol, self.coordinates, self.charge, self.mass, self.namd_symbol))
 
     def __str__(self):
-        return self._namd_symbol + '(' + self._symbol + ') ' + str(self._coordinates) + ' charge: ' + str(
-            self._charge) + ', mass: ' + str(self._mass)
+        return self.namd_symbol + '(' + self.symbol + ') ' + str(self.coordinates) + ' charge: ' + str(
+            self.charge) + ', mass: ' + str(self.mass)
 
 
 class Molecule:
+    DEFAULT_BOND_THRESHOLD = 1.70
+
     def __init__(self, atoms, residue_name="MOL"):
-        self._atoms = atoms
+        # atoms may be given as a ready ResidueTemplate or as any iterable of Atom objects
+        if isinstance(atoms, ResidueTemplate):
+            self._template = atoms
+        else:
+            self._template = ResidueTemplate.from_atoms(atoms)
+
+        self._atoms = None
         self._residue_name = residue_name
         self._bonds = ()
         self._drude_bonds = ()
         self._angles = ()
         self._dihedrals = ()
-        self._shifts = {i: 0 for i in range(0, self.atoms_number)}
+        self._shifts = array('I', bytes(4 * self.atoms_number))
+        self._adjacency = None
+        self._revision = 0
+
+    @property
+    def template(self):
+        return self._template
 
     @property
     def atoms_number(self):
-        return len(self._atoms)
+        return len(self._template)
 
     @property
     def atoms_number_with_drude(self):
-        return reduce(lambda a, b: a + (1 if b.drude_atom is None else 2), self._atoms, 0)
+        return self.atoms_number + self._template.drude_number
+
+    @property
+    def revision(self):
+        # changes whenever topology or Drude particles of the molecule change, so cached counts can be refreshed
+        return self._revision
 
     @property
     def atoms(self):
+        if self._atoms is None:
+            self._atoms = [Atom.view(self._template, i) for i in range(0, self.atoms_number)]
+
         return self._atoms
 
     @property
@@ -175,6 +386,20 @@ class Molecule:
     @bonds.setter
     def bonds(self, bonds):
         self._bonds = tuple(bonds)
+        self._adjacency = None
+        self._revision += 1
+
+    @property
+    def adjacency(self):
+        # maps atom index to indices of its bonded neighbours, kept in the order of bonds
+        if self._adjacency is None:
+            adjacency = defaultdict(list)
+            for (first, second) in self._bonds:
+                adjacency[first].append(second)
+                adjacency[second].append(first)
+            self._adjacency = dict(adjacency)
+
+        return self._adjacency
 
     @property
     def drude_bonds(self):
@@ -183,6 +408,7 @@ class Molecule:
     @drude_bonds.setter
     def drude_bonds(self, drude_bonds):
         self._drude_bonds = tuple(drude_bonds)
+        self._revision += 1
 
     @property
     def angles(self):
@@ -191,6 +417,7 @@ class Molecule:
     @angles.setter
     def angles(self, angles):
         self._angles = tuple(angles)
+        self._revision += 1
 
     @property
     def dihedrals(self):
@@ -199,90 +426,154 @@ class Molecule:
     @dihedrals.setter
     def dihedrals(self, dihedrals):
         self._dihedrals = tuple(dihedrals)
+        self._revision += 1
 
     @property
     def shifts(self):
+        # shifts[i] is the number of Drude particles placed before atom i, every one follows its parent atom
         return self._shifts
 
     def add_drude_atom(self, atom, polarizability, drude_bonds_list):
+        if atom.template is not self._template:
+            raise ValueError("Atom does not belong to molecule {}".format(self._residue_name))
+
+        index = atom.index
         atom.create_drude_atom(polarizability)
-        index = self._atoms.index(atom)
-        shifted_index = index + self.shifts[index]
+        shifted_index = index + self._shifts[index]
         drude_bonds_list.append((shifted_index, shifted_index + 1))
 
         for i in range(index + 1, self.atoms_number):
             self._shifts[i] += 1
 
+        self._revision += 1
+
+    def create_drude_atoms(self, polarizabilities):
+        # polarizabilities maps indices of atoms to the polarizability of their Drude particles, shifts and
+        # Drude bonds are built in one pass from the running number of Drude particles
+        template = self._template
+        drude_flags = template.drude_flags
+        shifts = self._shifts
+        drude_bonds = []
+        shift = 0
+
+        for index in range(0, self.atoms_number):
+            shifts[index] = shift
+            polarizability = polarizabilities.get(index)
+            if polarizability is not None:
+                template.create_drude(index, polarizability)
+
+            if drude_flags[index]:
+                drude_bonds.append((index + shift, index + shift + 1))
+                shift += 1
+
+        self.drude_bonds = drude_bonds
+
+    def __getstate__(self):
+        # atom views and the adjacency index are rebuilt on demand
+        state = self.__dict__.copy()
+        state['_atoms'] = None
+        state['_adjacency'] = None
+        return state
+
     def __eq__(self, other):
         if not isinstance(other, Molecule):
             return NotImplemented
 
-        return Counter(self._atoms) == Counter(other._atoms) and self._residue_name == other._residue_name
+        if self is other:
+            return True
+
+        return self._residue_name == other._residue_name and \
+               self.atoms_number == other.atoms_number and \
+               Counter(self.atoms) == Counter(other.atoms)
 
     def __hash__(self):
-        return hash((tuple(self._atoms), self._residue_name))
+        # cheap and stable while the template is filled in, equal molecules still compare their atoms
+        return hash((self._residue_name, self.atoms_number))
 
     def __str__(self):
         result = 'Molecule: ' + self._residue_name + '\n'
 
-        for atom in self._atoms:
+        for atom in self.atoms:
             result += str(atom) + '\n'
 
         return result
 
-    def determine_bonds(self, threshold=1.70):
-        result = []
+    def determine_bonds(self, threshold=DEFAULT_BOND_THRESHOLD, cutoffs=None):
+        # cutoffs optionally maps pairs of element symbols to their own bond threshold
+        cutoffs = cutoffs or {}
+        for distance in [threshold] + list(cutoffs.values()):
+            if not distance > 0:
+                raise ValueError("Bond thresholds must be positive, got {}".format(distance))
+        cell_size = max([threshold] + list(cutoffs.values()))
+        template = self._template
+        coordinates = template.coordinates
+        cells = build_cells(coordinates, cell_size)
 
-        for atom in self._atoms[:-1]:
-            atom_index = self._atoms.index(atom)
-            for neighbour in self._atoms[atom_index + 1:]:
-                if atom.coordinates.calculate_distance(neighbour.coordinates) <= threshold:
-                    atom_index += self._shifts[atom_index]
-                    neighbour_index = self._atoms.index(neighbour)
-                    neighbour_index += self._shifts[neighbour_index]
-                    result.append((atom_index, neighbour_index))
-        self._bonds = tuple(result)
+        result = []
+        for atom_index in range(0, self.atoms_number):
+            x, y, z = coordinates[3 * atom_index:3 * atom_index + 3]
+            symbol = template.symbol(atom_index)
+            cell = (floor(x / cell_size), floor(y / cell_size), floor(z / cell_size))
+            neighbours = []
+
+            for offset in NEIGHBOUR_CELL_OFFSETS:
+                neighbour_cell = (cell[0] + offset[0], cell[1] + offset[1], cell[2] + offset[2])
+                for neighbour_index in cells.get(neighbour_cell, ()):
+                    if neighbour_index <= atom_index:
+                        continue
+
+                    pair_threshold = threshold
+                    if cutoffs:
+                        neighbour_symbol = template.symbol(neighbour_index)
+                        pair_threshold = cutoffs.get((symbol, neighbour_symbol),
+                                                     cutoffs.get((neighbour_symbol, symbol), threshold))
+
+                    offset_index = 3 * neighbour_index
+                    distance = sqrt((x - coordinates[offset_index]) ** 2 +
+                                    (y - coordinates[offset_index + 1]) ** 2 +
+                                    (z - coordinates[offset_index + 2]) ** 2)
+                    if distance <= pair_threshold:
+                        neighbours.append(neighbour_index)
+
+            neighbours.sort()
+            shifted_atom_index = atom_index + self._shifts[atom_index]
+            for neighbour_index in neighbours:
+                result.append((shifted_atom_index, neighbour_index + self._shifts[neighbour_index]))
+
+        self.bonds = result
 
     def determine_angles(self):
         if len(self.bonds) == 0:
             return
 
+        adjacency = self.adjacency
         result = []
-        for i in range(0, self.atoms_number):
-            filtered_bonds = list(filter(lambda x: i in x, self._bonds))
-
-            for j in range (0, len(filtered_bonds)):
-                for k in range(j + 1, len(filtered_bonds)):
-                    first_bond = filtered_bonds[j]
-                    second_bond = filtered_bonds[k]
+        for i in sorted(adjacency):
+            neighbours = adjacency[i]
 
-                    left_index = first_bond[0] if first_bond[0] != i else first_bond[1]
-                    right_index = second_bond[0] if second_bond[0] != i else second_bond[1]
+            for j in range(0, len(neighbours)):
+                for k in range(j + 1, len(neighbours)):
+                    result.append((neighbours[j], i, neighbours[k]))
 
-                    result.append((left_index, i, right_index))
+        self.angles = result
 
-        self._angles = tuple(result)
-
-    def determine_dihedrals(self):
+    def determine_dihedrals(self, skip_three_rings=False):
+        # skip_three_rings leaves out terms whose end atoms are the same atom of a three-membered ring, as Tinker does
         if len(self.bonds) == 0:
             return
 
+        adjacency = self.adjacency
         result = []
-        for bond in self._bonds:
-            i = bond[0]
-            j = bond[1]
-
-            left_sides = list(filter(lambda x: i in x and j not in x, self._bonds))
-            right_sides = list(filter(lambda x: j in x and i not in x, self._bonds))
+        for (i, j) in self._bonds:
+            left_indices = [index for index in adjacency[i] if index != j]
+            right_indices = [index for index in adjacency[j] if index != i]
 
-            for left_side in left_sides:
-                for right_side in right_sides:
-                    left_index = left_side[0] if left_side[0] != i else left_side[1]
-                    right_index = right_side[0] if right_side[0] != j else right_side[1]
+            for left_index in left_indices:
+                for right_index in right_indices:
+                    if right_index != left_index or not skip_three_rings:
+                        result.append((left_index, i, j, right_index))
 
-                    result.append((left_index, i, j, right_index))
-
-        self._dihedrals = tuple(result)
+        self.dihedrals = result
 
 
 class System:
@@ -290,6 +581,10 @@ class System:
         self._molecules = molecules
         self._xyz_file_name = xyz_file_name
         self._segment_id = segment_id
+        self._counts_key = None
+        self._counts = None
+        self._atom_offsets = None
+        self._atom_offsets_with_drude = None
 
     @property
     def molecules(self):
@@ -305,16 +600,149 @@ class System:
 
     @property
     def atoms_number(self):
-        result = 0
-        for (molecule, molecule_count) in self._molecules:
-            result += molecule.atoms_number * molecule_count
-
-        return result
+        return self.__counts()[0]
 
     @property
     def atoms_number_with_drude(self):
-        result = 0
-        for (molecule, molecule_count) in self._molecules:
-            result += molecule.atoms_number_with_drude * molecule_count
+        return self.__counts()[1]
 
-        return result
+    @property
+    def bonds_number(self):
+        # Drude bonds included, as they are listed among bonds in PSF
+        return self.__counts()[2]
+
+    @property
+    def angles_number(self):
+        return self.__counts()[3]
+
+    @property
+    def dihedrals_number(self):
+        return self.__counts()[4]
+
+    def atom_offset(self, molecule_index, copy=0):
+        # index of the first atom of the given residue copy among all atoms of the system
+        self.__counts()
+        return self._atom_offsets[molecule_index] + copy * self._molecules[molecule_index][0].atoms_number
+
+    def atom_offset_with_drude(self, molecule_index, copy=0):
+        self.__counts()
+        return self._atom_offsets_with_drude[molecule_index] + \
+            copy * self._molecules[molecule_index][0].atoms_number_with_drude
+
+    def global_atom_index(self, molecule_index, copy, local_index, with_drude=False):
+        if with_drude:
+            return self.atom_offset_with_drude(molecule_index, copy) + local_index
+
+        return self.atom_offset(molecule_index, copy) + local_index
+
+    def locate_atom(self, global_index, with_drude=False):
+        # inverse of global_atom_index, the residue block is found by bisection over block offsets
+        atoms_number = self.atoms_number_with_drude if with_drude else self.atoms_number
+        if not 0 <= global_index < atoms_number:
+            raise IndexError("Atom index {} out of range, system has {} atoms".format(global_index, atoms_number))
+
+        offsets = self._atom_offsets_with_drude if with_drude else self._atom_offsets
+        molecule_index = bisect_right(offsets, global_index) - 1
+        molecule = self._molecules[molecule_index][0]
+        residue_size = molecule.atoms_number_with_drude if with_drude else molecule.atoms_number
+        (copy, local_index) = divmod(global_index - offsets[molecule_index], residue_size)
+
+        return molecule_index, copy, local_index
+
+    def global_bonds(self, include_drude=True):
+        # terms are numbered like atoms with Drude particles, one residue copy is expanded at a time
+        if include_drude:
+            return self.__global_terms(lambda molecule: sorted(molecule.bonds + molecule.drude_bonds))
+
+        return self.__global_terms(lambda molecule: molecule.bonds)
+
+    def global_angles(self):
+        return self.__global_terms(lambda molecule: molecule.angles)
+
+    def global_dihedrals(self):
+        return self.__global_terms(lambda molecule: molecule.dihedrals)
+
+    def __global_terms(self, molecule_terms):
+        for (molecule_index, (molecule, molecule_count)) in enumerate(self._molecules):
+            terms = molecule_terms(molecule)
+            if len(terms) == 0:
+                continue
+
+            base = self.atom_offset_with_drude(molecule_index)
+            atoms_number = molecule.atoms_number_with_drude
+            for _ in range(0, molecule_count):
+                for term in terms:
+                    yield tuple(base + index for index in term)
+                base += atoms_number
+
+    def __counts(self):
+        # recomputed only when the list of residues or any of them has changed since the last call
+        counts_key = tuple((id(molecule), molecule.revision, molecule.atoms_number, molecule.atoms_number_with_drude,
+                            molecule_count) for (molecule, molecule_count) in self._molecules)
+        if counts_key != self._counts_key:
+            counts = [0, 0, 0, 0, 0]
+            atom_offsets = array('Q')
+            atom_offsets_with_drude = array('Q')
+
+            for (molecule, molecule_count) in self._molecules:
+                atom_offsets.append(counts[0])
+                atom_offsets_with_drude.append(counts[1])
+                counts[0] += molecule.atoms_number * molecule_count
+                counts[1] += molecule.atoms_number_with_drude * molecule_count
+                counts[2] += (len(molecule.bonds) + len(molecule.drude_bonds)) * molecule_count
+                counts[3] += len(molecule.angles) * molecule_count
+                counts[4] += len(molecule.dihedrals) * molecule_count
+
+            self._counts = tuple(counts)
+            self._atom_offsets = atom_offsets
+            self._atom_offsets_with_drude = atom_offsets_with_drude
+            self._counts_key = counts_key
+
+        return self._counts
+
+
+class SystemCoordinates:
+    # columnar positions of all atoms of the system, atom i occupies coordinates[3 * i:3 * i + 3]
+    __slots__ = ('_declared_atoms_number', '_symbols', '_symbol_ids', '_coordinates', '_line_numbers',
+                 '_first_atom_line')
+
+    FIRST_ATOM_LINE = 3
+
+    def __init__(self, declared_atoms_number, symbols, symbol_ids, coordinates, line_numbers=None,
+                 first_atom_line=FIRST_ATOM_LINE):
+        # first_atom_line differs from FIRST_ATOM_LINE for later frames of a multi-frame .xyz
+        self._declared_atoms_number = declared_atoms_number
+        self._symbols = symbols
+        self._symbol_ids = symbol_ids
+        self._coordinates = coordinates
+        self._line_numbers = line_numbers
+        self._first_atom_line = first_atom_line
+
+    @property
+    def declared_atoms_number(self):
+        return self._declared_atoms_number
+
+    @property
+    def atoms_number(self):
+        return len(self._symbol_ids)
+
+    @property
+    def symbols(self):
+        return self._symbols
+
+    @property
+    def symbol_ids(self):
+        return self._symbol_ids
+
+    @property
+    def coordinates(self):
+        return self._coordinates
+
+    def symbol(self, index):
+        return self._symbols[self._symbol_ids[index]]
+
+    def line_number(self, index):
+        if self._line_numbers is None:
+            return index + self._first_atom_line
+
+        return self._line_numbers[index]
@@ -1,6 +1,9 @@
+import mmap
 import os
+import re
+from array import array
 
-from utils import model
+from utils import metricsutils, model
 
 
 class InputReader:
@@ -11,13 +14,29 @@ class InputReader:
     ANGLE_SECTION_BEGINNING = "Angle Bending Parameters"
     DIHEDRAL_SECTION_BEGINNING = "Torsional Angle Parameters"
     CONN_LINES_TO_OMIT = 3
+    CONN_SECTION_HEADERS = re.compile(b"|".join(re.escape(header.encode()) for header in (
+        BOND_SECTION_BEGINNING, ANGLE_SECTION_BEGINNING, DIHEDRAL_SECTION_BEGINNING)))
+    CONN_SECTION_END = re.compile(rb'\n[ \t\r\f\v]*(\n|$)')
+    TINKER_CONNECTIVITY_CONN = "conn"
+    TINKER_CONNECTIVITY_XYZ = "xyz"
+
+    def __init__(self, input_file_name, tinker_format=False, include_drude=False,
+                 bond_threshold=model.Molecule.DEFAULT_BOND_THRESHOLD, bond_cutoffs=None, template_cache=None,
+                 tinker_connectivity=TINKER_CONNECTIVITY_CONN, profiler=None):
+        if tinker_connectivity not in (self.TINKER_CONNECTIVITY_CONN, self.TINKER_CONNECTIVITY_XYZ):
+            raise ValueError("Unknown source of Tinker connectivity: {}".format(tinker_connectivity))
 
-    def __init__(self, input_file_name, tinker_format=False, include_drude=False):
         self._input_file_name = input_file_name
         self._xyz_data = []
         self._packmol_output_name = None
         self._tinker_format = tinker_format
         self._include_drude = include_drude
+        self._bond_threshold = bond_threshold
+        self._bond_cutoffs = bond_cutoffs
+        self._template_cache = template_cache
+        self._tinker_connectivity = tinker_connectivity
+        self._profiler = profiler or metricsutils.NULL_PROFILER
+        self._molecules = {}
 
     @property
     def xyz_data(self):
@@ -28,6 +47,12 @@ class InputReader:
         return self._packmol_output_name
 
     def parse_packmol_input(self):
+        with self._profiler.stage("parse_packmol_input") as stage:
+            self.__parse_packmol_input()
+            stage.count("structures", len(self._xyz_data))
+            stage.count("residues", sum(molecule_count for (xyz_file_name, molecule_count) in self._xyz_data))
+
+    def __parse_packmol_input(self):
         input_file = open(self._input_file_name, 'r')
         dirname = os.path.dirname(input_file.name)
         if dirname != "":
@@ -52,96 +77,161 @@ class InputReader:
         input_file.close()
 
     def read_xyz_data(self):
+        with self._profiler.stage("read_residues") as stage:
+            molecules = []
+
+            for (xyz_file_name, molecule_count) in self._xyz_data:
+                molecules.append((self.__read_molecule(xyz_file_name), molecule_count))
+
+            system = model.System(molecules, self._packmol_output_name)
+            stage.count("templates", len(self._molecules))
+            stage.count("residues", sum(molecule_count for (molecule, molecule_count) in molecules))
+            stage.count("atoms", system.atoms_number)
+            stage.count("atoms_with_drude", system.atoms_number_with_drude)
+            stage.count("bonds", system.bonds_number)
+            stage.count("angles", system.angles_number)
+            stage.count("dihedrals", system.dihedrals_number)
+
+        return system
+
+    def __read_molecule(self, xyz_file_name):
+        # the same residue listed in several structure blocks is parsed once and shared
+        residue_key = (tuple(os.path.realpath(file_name) for file_name in self.residue_file_names(xyz_file_name)),
+                       self.topology_options())
+        molecule = self._molecules.get(residue_key)
+        if molecule is None:
+            molecule = self.__load_molecule(xyz_file_name)
+            self._molecules[residue_key] = molecule
+
+        return molecule
+
+    def __load_molecule(self, xyz_file_name):
+        cache_key = None
+        if self._template_cache is not None:
+            cache_key = self._template_cache.key(self.residue_file_names(xyz_file_name), self.topology_options())
+            with self._profiler.stage("load_cached_template") as stage:
+                molecule = self._template_cache.load(cache_key)
+                stage.count("hits", molecule is not None)
+            if molecule is not None:
+                return molecule
+
         if self._tinker_format:
-            return self.__read_xyz_data_tinker()
+            molecule = self.__read_molecule_tinker(xyz_file_name)
         else:
-            return self.__read_xyz_data_default()
+            molecule = self.__read_molecule_default(xyz_file_name)
 
-    def __read_xyz_data_default(self):
-        molecules = []
+        if cache_key is not None:
+            self._template_cache.store(cache_key, molecule)
 
-        for (xyz_file_name, molecule_count) in self._xyz_data:
-            xyz_file = open(xyz_file_name, 'r')
+        return molecule
 
-            atoms_number = int(xyz_file.readline())
-            xyz_file.readline()  # omit commentary line in XYZ file
-            atoms = []
+    def residue_file_names(self, xyz_file_name):
+        file_names = [xyz_file_name, xyz_file_name.replace('.xyz', '.dat')]
+        if self._tinker_format and self._tinker_connectivity == self.TINKER_CONNECTIVITY_CONN:
+            file_names.append(xyz_file_name.replace('.xyz', '.conn'))
 
-            for xyz_line in xyz_file:
-                xyz_line = xyz_line.split()
-                if len(xyz_line) >= self.COORDINATE_LINE_COLUMNS:
-                    atom_symbol = xyz_line[0]
-                    atom_coordinates = model.Coordinates(float(xyz_line[1]), float(xyz_line[2]), float(xyz_line[3]))
+        return file_names
 
-                    atoms.append(model.Atom(atom_symbol, atom_coordinates))
+    def topology_options(self):
+        bond_cutoffs = tuple(sorted((self._bond_cutoffs or {}).items()))
+        return self._tinker_format, self._tinker_connectivity, self._include_drude, self._bond_threshold, bond_cutoffs
 
-            xyz_file.close()
+    def __read_molecule_default(self, xyz_file_name):
+        xyz_file = open(xyz_file_name, 'r')
 
-            if len(atoms) != atoms_number:
-                print(
-                    '[WARNING] Difference between declared and read atoms number in file {}, declared: {}, read: {}'.format(
-                        xyz_file_name, atoms_number, len(atoms)))
+        atoms_number = int(xyz_file.readline())
+        xyz_file.readline()  # omit commentary line in XYZ file
+        template = model.ResidueTemplate()
 
-            molecule = model.Molecule(atoms)
-            self.__read_dat_data(xyz_file_name.replace('.xyz', '.dat'), molecule)
+        for xyz_line in xyz_file:
+            xyz_line = xyz_line.split()
+            if len(xyz_line) >= self.COORDINATE_LINE_COLUMNS:
+                template.append(xyz_line[0], float(xyz_line[1]), float(xyz_line[2]), float(xyz_line[3]))
 
-            molecule.determine_angles()
-            molecule.determine_dihedrals()
-            molecules.append((molecule, molecule_count))
+        xyz_file.close()
 
-        system = model.System(molecules, self._packmol_output_name)
-        return system
+        if len(template) != atoms_number:
+            print(
+                '[WARNING] Difference between declared and read atoms number in file {}, declared: {}, read: {}'.format(
+                    xyz_file_name, atoms_number, len(template)))
 
-    def __read_xyz_data_tinker(self):
-        molecules = []
+        molecule = model.Molecule(template)
+        self.__read_dat_data(xyz_file_name.replace('.xyz', '.dat'), molecule)
 
-        for (xyz_file_name, molecule_count) in self._xyz_data:
-            xyz_file = open(xyz_file_name, 'r')
+        with self._profiler.stage("topology") as stage:
+            molecule.determine_angles()
+            molecule.determine_dihedrals()
+            stage.count("angles", len(molecule.angles))
+            stage.count("dihedrals", len(molecule.dihedrals))
 
-            atoms_number = int(xyz_file.readline().split()[0])
-            atoms = []
+        return molecule
 
-            for xyz_line in xyz_file:
-                xyz_line = xyz_line.split()
-                if len(xyz_line) >= self.COORDINATE_LINE_COLUMNS_TINKER:
-                    atom_symbol = xyz_line[1]
-                    atom_coordinates = model.Coordinates(float(xyz_line[2]), float(xyz_line[3]), float(xyz_line[4]))
+    def __read_molecule_tinker(self, xyz_file_name):
+        xyz_file = open(xyz_file_name, 'r')
 
-                    atoms.append(model.Atom(atom_symbol, atom_coordinates))
+        atoms_number = int(xyz_file.readline().split()[0])
+        template = model.ResidueTemplate()
+        # bonded neighbours listed after the atom type
+        neighbours = []
 
-            xyz_file.close()
+        for xyz_line in xyz_file:
+            xyz_line = xyz_line.split()
+            if len(xyz_line) >= self.COORDINATE_LINE_COLUMNS_TINKER:
+                template.append(xyz_line[1], float(xyz_line[2]), float(xyz_line[3]), float(xyz_line[4]))
+                neighbours.append(xyz_line[self.COORDINATE_LINE_COLUMNS_TINKER + 1:])
 
-            if len(atoms) != atoms_number:
-                print(
-                    '[WARNING] Difference between declared and read atoms number in file {}, declared: {}, read: {}'.format(
-                        xyz_file_name, atoms_number, len(atoms)))
+        xyz_file.close()
 
-            molecule = model.Molecule(atoms)
-            self.__read_dat_data(xyz_file_name.replace('.xyz', '.dat'), molecule)
+        if len(template) != atoms_number:
+            print(
+                '[WARNING] Difference between declared and read atoms number in file {}, declared: {}, read: {}'.format(
+                    xyz_file_name, atoms_number, len(template)))
 
-            if molecule.atoms_number > 1:
+        molecule = model.Molecule(template)
+        self.__read_dat_data(xyz_file_name.replace('.xyz', '.dat'), molecule)
+
+        with self._profiler.stage("topology") as stage:
+            if self._tinker_connectivity == self.TINKER_CONNECTIVITY_XYZ:
+                self.__read_xyz_connectivity(neighbours, molecule)
+            elif molecule.atoms_number > 1:
                 self.__read_conn_data(xyz_file_name.replace('.xyz', '.conn'), molecule)
+            stage.count("bonds", len(molecule.bonds))
+            stage.count("angles", len(molecule.angles))
+            stage.count("dihedrals", len(molecule.dihedrals))
 
-            molecules.append((molecule, molecule_count))
+        return molecule
 
-        system = model.System(molecules, self._packmol_output_name)
-        return system
+    @staticmethod
+    def __read_xyz_connectivity(neighbours, molecule):
+        # bonds are numbered like Tinker does, every pair once from the lower atom, angles and dihedrals are then
+        # generated in the order of Tinker analyze
+        shifts = molecule.shifts
+        bonds = []
+        for (index, atom_neighbours) in enumerate(neighbours):
+            for neighbour_index in sorted(int(neighbour) - 1 for neighbour in atom_neighbours):
+                if neighbour_index > index:
+                    bonds.append((index + shifts[index], neighbour_index + shifts[neighbour_index]))
+
+        molecule.bonds = bonds
+        molecule.determine_angles()
+        molecule.determine_dihedrals(skip_three_rings=True)
 
     def __read_dat_data(self, dat_file_name, molecule):
         dat_file = open(dat_file_name, 'r')
         molecule.residue_name = dat_file.readline().replace('\n', '')
-        drude_bonds_list = []
+        polarizabilities = {}
+        template = molecule.template
 
-        for atom in molecule.atoms:
+        for index in range(0, molecule.atoms_number):
             dat_line = dat_file.readline().split()
-            atom.namd_symbol = dat_line[0]
-            atom.charge = float(dat_line[1])
-            atom.mass = float(dat_line[2])
+            template.set_namd_symbol(index, dat_line[0])
+            template.charges[index] = float(dat_line[1])
+            template.masses[index] = float(dat_line[2])
 
             if self._include_drude and len(dat_line) >= self.DRUDE_LINE_COLUMNS:
-                molecule.add_drude_atom(atom, float(dat_line[4]), drude_bonds_list)
+                polarizabilities[index] = float(dat_line[4])
 
-        molecule.drude_bonds = drude_bonds_list
+        molecule.create_drude_atoms(polarizabilities)
 
         if not self._tinker_format:
             if 'BONDS' in dat_file.readline():
@@ -155,85 +245,181 @@ class InputReader:
 
                 molecule.bonds = bonds
             else:
-                molecule.determine_bonds()
+                with self._profiler.stage("topology") as stage:
+                    molecule.determine_bonds(self._bond_threshold, self._bond_cutoffs)
+                    stage.count("bonds", len(molecule.bonds))
 
         dat_file.close()
 
     def __read_conn_data(self, conn_file_name, molecule):
-        conn_file = open(conn_file_name, 'r')
-
-        self.__jump_to_conn_section(conn_file, self.BOND_SECTION_BEGINNING, self.CONN_LINES_TO_OMIT)
-        self.__read_bond_conn_data(conn_file, molecule)
-
+        # sections are located in one scan of the memory-mapped file, their rows are then parsed table by table
+        sections = [(self.BOND_SECTION_BEGINNING, 2, 'bonds')]
         if molecule.atoms_number > 2:
-            self.__jump_to_conn_section(conn_file, self.ANGLE_SECTION_BEGINNING, self.CONN_LINES_TO_OMIT)
-            self.__read_angles_conn_data(conn_file, molecule)
-
+            sections.append((self.ANGLE_SECTION_BEGINNING, 3, 'angles'))
         if molecule.atoms_number > 3:
-            self.__jump_to_conn_section(conn_file, self.DIHEDRAL_SECTION_BEGINNING, self.CONN_LINES_TO_OMIT)
-            self.__read_dihedrals_conn_data(conn_file, molecule)
+            sections.append((self.DIHEDRAL_SECTION_BEGINNING, 4, 'dihedrals'))
 
-        conn_file.close()
+        # maps 1-based atom numbers from .conn to indices shifted by preceding Drude particles
+        shifts = molecule.shifts
+        index_map = array('q', [-1])
+        index_map.extend(index + shifts[index] for index in range(0, molecule.atoms_number))
+
+        with open(conn_file_name, 'rb') as conn_file:
+            with mmap.mmap(conn_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                headers = [(match.group().decode(), match.start(), match.end())
+                           for match in self.CONN_SECTION_HEADERS.finditer(data)]
+                position = 0
+
+                for (section_beginning, term_size, attribute) in sections:
+                    for (header, header_start, header_end) in headers:
+                        if header == section_beginning and header_start >= position:
+                            break
+                    else:
+                        raise ValueError("Section '{}' not found in {}".format(section_beginning, conn_file_name))
+
+                    (terms, position) = self.__parse_conn_section(data, header_end, term_size, index_map,
+                                                                  conn_file_name)
+                    setattr(molecule, attribute, terms)
+
+    def __parse_conn_section(self, data, header_end, term_size, index_map, conn_file_name):
+        # rows start after the rest of the header line and the omitted lines, and end with a blank line
+        position = header_end
+        for _ in range(0, self.CONN_LINES_TO_OMIT + 1):
+            position = data.find(b'\n', position) + 1 or len(data)
+
+        section_end = self.CONN_SECTION_END.search(data, position - 1)
+        end = section_end.start() + 1 if section_end else len(data)
+        # a match keeps the memory map exported, it could not be closed
+        del section_end
+
+        values = []
+        for line in data[position:end].split(b'\n'):
+            fields = line.split(None, term_size + 1)
+            if len(fields) == 0:
+                continue
+            if len(fields) <= term_size:
+                raise ValueError("Invalid row in {}: {}".format(conn_file_name, line.decode(errors='replace')))
+            values.extend(fields[1:term_size + 1])
+
+        atom_numbers = array('q', map(int, values))
+        if len(atom_numbers) > 0 and (min(atom_numbers) < 1 or max(atom_numbers) >= len(index_map)):
+            raise ValueError("Atom number out of range in {}".format(conn_file_name))
+
+        indices = map(index_map.__getitem__, atom_numbers)
+        return list(zip(*[indices] * term_size)), end
 
     @staticmethod
-    def __jump_to_conn_section(conn_file, section_beginning, lines_to_omit):
-        line = conn_file.readline()
-        while section_beginning not in line:
-            line = conn_file.readline()
+    def shift(string_value, shifts):
+        result = int(string_value) - 1
+        result += shifts[result]
+        return result
 
-        for _ in range(0, lines_to_omit):
-            conn_file.readline()
 
-    @staticmethod
-    def __read_bond_conn_data(conn_file, molecule):
-        shifts = molecule.shifts
-        bonds = []
-        line = conn_file.readline().strip()
-        while line != "":
-            line = line.split()
-            bond = (InputReader.shift(line[1], shifts), InputReader.shift(line[2], shifts))
-            bonds.append(bond)
-            line = conn_file.readline().strip()
+class SystemXYZReader:
+    COORDINATE_LINE_COLUMNS = 4
+    CHUNK_SIZE = 1 << 24
+
+    def __init__(self, xyz_file_name):
+        self._xyz_file_name = xyz_file_name
+
+    def read(self):
+        # the first frame only, anything after its declared atoms is omitted
+        frames = self.frames()
+        try:
+            return next(frames)
+        finally:
+            frames.close()
+
+    def frames(self):
+        # frames of a multi-frame .xyz one after another, only the current frame is kept in memory
+        with open(self._xyz_file_name, 'rb') as xyz_file:
+            with mmap.mmap(xyz_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                position = 0
+                line_number = 1
+
+                while position < len(data):
+                    line_end = data.find(b'\n', position)
+                    if line_end == -1:
+                        line_end = len(data)
+
+                    if data[position:line_end].strip():
+                        (system_coordinates, position, line_number) = self.__read_frame(data, position, line_number)
+                        yield system_coordinates
+                    else:
+                        # blank lines between frames
+                        position = line_end + 1
+                        line_number += 1
+
+    def __read_frame(self, data, position, header_line_number):
+        header_end = data.find(b'\n', position)
+        if header_end == -1:
+            header_end = len(data)
+        try:
+            declared_atoms_number = int(data[position:header_end])
+        except ValueError:
+            raise ValueError("Expected number of atoms in line {} of {}".format(header_line_number,
+                                                                                self._xyz_file_name)) from None
+        # omit commentary line in .xyz
+        position = data.find(b'\n', header_end + 1) + 1
+        if position == 0:
+            position = len(data)
+
+        first_atom_line = header_line_number + 2
+        symbols = model.SymbolTable()
+        symbol_ids = array('I')
+        coordinates = array('d')
+        line_numbers = None
+        symbol_cache = {}
+        chunk_first_line = first_atom_line
+
+        while position < len(data) and len(symbol_ids) < declared_atoms_number:
+            chunk_end = len(data)
+            if position + self.CHUNK_SIZE < chunk_end:
+                chunk_end = data.rfind(b'\n', position, position + self.CHUNK_SIZE) + 1
+                if chunk_end <= position:
+                    chunk_end = data.find(b'\n', position + self.CHUNK_SIZE) + 1 or len(data)
+
+            chunk = data[position:chunk_end]
+            # never read past the lines which may still belong to this frame
+            remaining_lines = declared_atoms_number - len(symbol_ids)
+            if chunk.count(b'\n') >= remaining_lines:
+                rest = chunk.split(b'\n', remaining_lines)[-1]
+                chunk = chunk[:len(chunk) - len(rest)]
+
+            stripped_chunk = chunk.rstrip()
+            lines_number = stripped_chunk.count(b'\n') + 1 if stripped_chunk else 0
+            tokens = stripped_chunk.split()
+
+            # atom lines so far are contiguous, so line numbers follow from atom indices
+            contiguous = chunk_first_line == first_atom_line + len(symbol_ids)
+            if line_numbers is None and contiguous and len(tokens) == self.COORDINATE_LINE_COLUMNS * lines_number:
+                chunk_symbols = tokens[0::self.COORDINATE_LINE_COLUMNS]
+                del tokens[0::self.COORDINATE_LINE_COLUMNS]
+                self.__intern_symbols(chunk_symbols, symbols, symbol_ids, symbol_cache)
+                coordinates.extend(map(float, tokens))
+            else:
+                # irregular lines, parse line by line and remember where every atom came from
+                if line_numbers is None:
+                    line_numbers = array('Q', range(first_atom_line, len(symbol_ids) + first_atom_line))
+                for (line_index, line) in enumerate(chunk.split(b'\n')):
+                    line = line.split()
+                    if len(line) < self.COORDINATE_LINE_COLUMNS:
+                        continue
 
-        molecule.bonds = bonds
+                    self.__intern_symbols(line[:1], symbols, symbol_ids, symbol_cache)
+                    coordinates.extend(map(float, line[1:self.COORDINATE_LINE_COLUMNS]))
+                    line_numbers.append(chunk_first_line + line_index)
 
-    @staticmethod
-    def __read_angles_conn_data(conn_file, molecule):
-        shifts = molecule.shifts
-        angles = []
-        line = conn_file.readline().strip()
-        while line != "":
-            line = line.split()
-            angle = (
-                InputReader.shift(line[1], shifts),
-                InputReader.shift(line[2], shifts),
-                InputReader.shift(line[3], shifts)
-            )
-            angles.append(angle)
-            line = conn_file.readline().strip()
+            chunk_first_line += chunk.count(b'\n')
+            position += len(chunk)
 
-        molecule.angles = angles
+        system_coordinates = model.SystemCoordinates(declared_atoms_number, symbols, symbol_ids, coordinates,
+                                                     line_numbers, first_atom_line)
+        return system_coordinates, position, chunk_first_line
 
     @staticmethod
-    def __read_dihedrals_conn_data(conn_file, molecule):
-        shifts = molecule.shifts
-        dihedrals = []
-        line = conn_file.readline().strip()
-        while line != "":
-            line = line.split()
-            dihedral = (
-                InputReader.shift(line[1], shifts),
-                InputReader.shift(line[2], shifts),
-                InputReader.shift(line[3], shifts),
-                InputReader.shift(line[4], shifts)
-            )
-            dihedrals.append(dihedral)
-            line = conn_file.readline().strip()
-
-        molecule.dihedrals = dihedrals
+    def __intern_symbols(raw_symbols, symbols, symbol_ids, symbol_cache):
+        for raw_symbol in set(raw_symbols).difference(symbol_cache):
+            symbol_cache[raw_symbol] = symbols.intern(raw_symbol.decode())
 
-    @staticmethod
-    def shift(string_value, shifts):
-        result = int(string_value) - 1
-        result += shifts[result]
-        return result
+        symbol_ids.extend(map(symbol_cache.__getitem__, raw_symbols))
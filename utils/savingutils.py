@@ -1,245 +1,990 @@
 import abc
-
-from utils import model
+import bz2
+import gzip
+import io
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from functools import lru_cache
+from itertools import chain, repeat
+
+from utils import metricsutils, readingutils
+
+
+class OutputTarget:
+    # a file written under a temporary name and renamed only when its saver succeeded, or a binary or text stream
+    # which is written directly and left open; both can be compressed on the fly
+    COMPRESSION_AUTO = 'auto'
+    COMPRESSION_NONE = 'none'
+    COMPRESSION_GZIP = 'gzip'
+    COMPRESSION_BZ2 = 'bz2'
+    COMPRESSION_XZ = 'xz'
+    COMPRESSIONS = (COMPRESSION_AUTO, COMPRESSION_NONE, COMPRESSION_GZIP, COMPRESSION_BZ2, COMPRESSION_XZ)
+    COMPRESSION_SUFFIXES = {'.gz': COMPRESSION_GZIP, '.bz2': COMPRESSION_BZ2, '.xz': COMPRESSION_XZ}
+    # zlib default, level 9 of GzipFile is several times slower for little gain on PSF and PDB
+    GZIP_LEVEL = 6
+
+    def __init__(self, target, compression=COMPRESSION_AUTO, binary=False, encoding='utf-8'):
+        self._target = target
+        self._compression = self.resolve_compression(target, compression)
+        self._partial_file_name = None
+        self._stream = target
+        self._file = None
+        self._writer = None
+        self._compressor = None
+
+        if self.is_path(target):
+            self._partial_file_name = self.partial_file_name(target, os.getpid())
+        elif isinstance(target, io.TextIOBase):
+            if binary or self._compression != self.COMPRESSION_NONE:
+                # compressed output is binary as well
+                if not hasattr(target, 'buffer'):
+                    raise ValueError('{} output cannot be written to a text stream'.format(
+                        'Binary' if binary else 'Compressed'))
+                target.flush()
+                self._stream = target.buffer
+            else:
+                # rendered chunks are whole pieces, so every one of them decodes on its own
+                self._stream = _StreamWriter(target, encoding)
+
+    @staticmethod
+    def is_path(target):
+        return isinstance(target, (str, bytes, os.PathLike))
+
+    @staticmethod
+    def partial_file_name(file_name, pid):
+        # temporary name of a file written by the process pid
+        return '{}.{}.partial'.format(os.fsdecode(file_name), pid)
+
+    @classmethod
+    def resolve_compression(cls, target, compression):
+        # automatic compression is chosen by the suffix of a file name, streams are not compressed
+        if compression not in cls.COMPRESSIONS:
+            raise ValueError('Unknown compression: {}'.format(compression))
+
+        if compression == cls.COMPRESSION_AUTO:
+            if not cls.is_path(target):
+                return cls.COMPRESSION_NONE
+            extension = os.path.splitext(os.fsdecode(target))[1].lower()
+            return cls.COMPRESSION_SUFFIXES.get(extension, cls.COMPRESSION_NONE)
+
+        return compression
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def file_name(self):
+        # file to which bytes can be written at any position, None for streams and compressed files
+        if self._compression != self.COMPRESSION_NONE:
+            return None
+        return self._partial_file_name
+
+    @property
+    def seekable(self):
+        return self.file_name is not None
+
+    @property
+    def bytes_written(self):
+        # size of the file or number of bytes passed to the stream, after compression
+        if self._partial_file_name is not None:
+            return os.path.getsize(self._target)
+        return self._writer.bytes_written if self._writer is not None else 0
+
+    def open(self):
+        # binary file object taking the whole output, opened once
+        if self._writer is not None:
+            return self._compressor or self._writer
+
+        if self._partial_file_name is not None:
+            self._file = open(self._partial_file_name, 'wb')
+            self._writer = self._file if self.seekable else _StreamWriter(self._file)
+        else:
+            self._writer = _StreamWriter(self._stream)
+
+        if self._compression == self.COMPRESSION_GZIP:
+            self._compressor = gzip.GzipFile(fileobj=self._writer, mode='wb', compresslevel=self.GZIP_LEVEL)
+        elif self._compression == self.COMPRESSION_BZ2:
+            self._compressor = bz2.BZ2File(self._writer, 'wb')
+        elif self._compression == self.COMPRESSION_XZ:
+            self._compressor = lzma.LZMAFile(self._writer, 'wb')
+
+        return self._compressor or self._writer
+
+    def close(self, succeeded):
+        # a given stream stays open, a file replaces the target only when succeeded
+        try:
+            if self._compressor is not None:
+                self._compressor.close()
+            if self._file is not None:
+                self._file.close()
+            elif self._writer is not None:
+                self._writer.flush()
+        finally:
+            if self._partial_file_name is not None and os.path.exists(self._partial_file_name):
+                if succeeded:
+                    os.replace(self._partial_file_name, self._target)
+                else:
+                    os.remove(self._partial_file_name)
+
+
+class _StreamWriter:
+    # counts bytes passed to a binary stream, or decodes them for a text stream when encoding is given
+    def __init__(self, stream, encoding=None):
+        self._stream = stream
+        self._encoding = encoding
+        self._bytes_written = 0
+
+    @property
+    def bytes_written(self):
+        return self._bytes_written
+
+    def write(self, data):
+        self._bytes_written += len(data)
+        if self._encoding is not None:
+            self._stream.write(bytes(data).decode(self._encoding))
+        else:
+            self._stream.write(data)
+        return len(data)
+
+    def flush(self):
+        self._stream.flush()
 
 
 class FileSaver(metaclass=abc.ABCMeta):
-    def __init__(self, output_file_name, system):
-        self._output_file = open(output_file_name, 'w')
+    ENCODING = 'utf-8'
+    DEFAULT_BUFFER_SIZE = 1 << 20
+    STAGE_NAME = "write"
+    BINARY = False
+
+    def __init__(self, output, system, workers=1, buffer_size=DEFAULT_BUFFER_SIZE, profiler=None,
+                 compression=OutputTarget.COMPRESSION_AUTO):
+        # output is a file name or a binary or text stream
+        self._output = output
+        self._compression = OutputTarget.resolve_compression(output, compression)
+        self._target = None
         self._system = system
+        self._workers = workers
+        self._buffer_size = buffer_size
+        self._profiler = profiler or metricsutils.NULL_PROFILER
+        self._peak_buffered_size = 0
+
+    @property
+    def peak_buffered_size(self):
+        # largest number of rendered bytes held in memory at once by the last serial write
+        return self._peak_buffered_size
 
-    @abc.abstractmethod
     def save_to_file(self):
+        # returns True when the whole output has been written, a file which is not complete is not left behind
+        with self._profiler.stage(self.STAGE_NAME) as stage:
+            self._target = OutputTarget(self._output, self._compression, self.BINARY, self.ENCODING)
+            succeeded = False
+            try:
+                succeeded = self._save()
+            finally:
+                self._target.close(succeeded)
+
+            if succeeded:
+                stage.count("atoms", self._system.atoms_number_with_drude)
+                stage.count("bytes_written", self._target.bytes_written)
+
+        return succeeded
+
+    @abc.abstractmethod
+    def _save(self):
         raise NotImplementedError('Saving not implemented!')
 
+    def _write_pieces(self, renderer):
+        # renderer splits the file into (size in bytes, method name, arguments) pieces which are rendered one by one,
+        # or by a pool of worker processes when every piece has a fixed, known size
+        if self._workers > 1 and renderer.fixed_width() and self._target.file_name is not None:
+            self.__write_pieces_parallel(renderer, renderer.pieces())
+        else:
+            self.__write_chunks(render_chunks(renderer, self.ENCODING))
+
+    def __write_chunks(self, chunks):
+        # chunks are collected until buffer_size bytes are pending and then written at once
+        pending = []
+        pending_size = 0
+        self._peak_buffered_size = 0
+        output_file = self._target.open()
+
+        for chunk in chunks:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            self._peak_buffered_size = max(self._peak_buffered_size, pending_size)
+
+            if pending_size >= self._buffer_size:
+                output_file.write(b"".join(pending))
+                pending.clear()
+                pending_size = 0
+
+        output_file.write(b"".join(pending))
+
+    def __write_pieces_parallel(self, renderer, pieces):
+        encoding = self.ENCODING
+
+        tasks = []
+        file_size = 0
+        for (size, method_name, arguments) in pieces:
+            tasks.append((file_size, size, method_name, arguments))
+            file_size += size
+
+        output_file = self._target.open()
+        output_file.truncate(file_size)
+        output_file.flush()
+
+        with multiprocessing.Pool(self._workers, _initialize_parallel_writer,
+                                  (renderer, self._target.file_name, encoding)) as pool:
+            for _ in pool.imap(_write_piece, tasks):
+                pass
+
+
+def render_chunks(renderer, encoding):
+    # encoded pieces of the file in order, only one piece is rendered at a time
+    for (size, method_name, arguments) in renderer.pieces():
+        yield getattr(renderer, method_name)(*arguments).encode(encoding)
+
+
+def save_concurrently(system, savers, compression=OutputTarget.COMPRESSION_AUTO):
+    # savers is a list of (saver class, output file name, additional constructor arguments), every file is written
+    # by its own process to a temporary file and all of them are renamed only if every saver succeeded;
+    # compression is chosen by the final file names, not the temporary ones; a saver writes its temporary file under
+    # a temporary name of its own, left behind when the saver is terminated
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    processes = []
+    partial_file_names = []
+
+    for (job_index, (saver_class, output_file_name, arguments)) in enumerate(savers):
+        partial_file_name = OutputTarget.partial_file_name(output_file_name, os.getpid())
+        partial_file_names.append(partial_file_name)
+
+        output_compression = OutputTarget.resolve_compression(output_file_name, compression)
+        process = context.Process(target=_run_saver, args=(job_index, saver_class, partial_file_name, system,
+                                                           arguments, output_compression, results))
+        process.start()
+        processes.append(process)
+
+    succeeded = True
+    try:
+        for _ in range(0, len(processes)):
+            (job_index, job_succeeded, message) = _wait_for_result(results, processes)
+            if not job_succeeded:
+                if message:
+                    print('[ERROR] Writing {} failed: {}'.format(savers[job_index][1], message))
+                succeeded = False
+                break
+    except BaseException:
+        # interrupted wait, files of savers which did not finish must not be left behind
+        succeeded = False
+        raise
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        if not succeeded:
+            for (partial_file_name, process) in zip(partial_file_names, processes):
+                for file_name in (partial_file_name, OutputTarget.partial_file_name(partial_file_name, process.pid)):
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+
+    if succeeded:
+        for ((saver_class, output_file_name, arguments), partial_file_name) in zip(savers, partial_file_names):
+            os.replace(partial_file_name, output_file_name)
+
+    return succeeded
+
+
+def _run_saver(job_index, saver_class, output_file_name, system, arguments, compression, results):
+    try:
+        saver = saver_class(output_file_name, system, *arguments, compression=compression)
+        results.put((job_index, bool(saver.save_to_file()), None))
+    except Exception as error:
+        results.put((job_index, False, '{}: {}'.format(type(error).__name__, error)))
+
+
+def _wait_for_result(results, processes):
+    while True:
+        try:
+            return results.get(timeout=0.1)
+        except queue.Empty:
+            for (job_index, process) in enumerate(processes):
+                if process.exitcode is not None and process.exitcode != 0:
+                    return job_index, False, 'process exited with code {}'.format(process.exitcode)
+
+
+_parallel_writer_state = None
 
-class PSFSaver(FileSaver):
+
+def _initialize_parallel_writer(renderer, output_file_name, encoding):
+    global _parallel_writer_state
+    _parallel_writer_state = (renderer, output_file_name, encoding)
+
+
+def _write_piece(task):
+    (offset, size, method_name, arguments) = task
+    (renderer, output_file_name, encoding) = _parallel_writer_state
+
+    data = getattr(renderer, method_name)(*arguments).encode(encoding)
+    if len(data) != size:
+        raise RuntimeError('Rendered {} bytes at offset {}, expected {}'.format(len(data), offset, size))
+
+    if size == 0:
+        return 0
+
+    map_offset = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(output_file_name, 'r+b') as output_file:
+        with mmap.mmap(output_file.fileno(), offset + size - map_offset, offset=map_offset) as output_map:
+            output_map[offset - map_offset:] = data
+
+    return size
+
+
+@lru_cache(maxsize=256)
+def _connectivity_format(values_number, first_column, values_per_line, ends_section):
+    # format of values_number consecutive values, the first of them placed in first_column of its line
+    result = []
+    column = first_column
+
+    for _ in range(0, values_number):
+        if column == 0:
+            result.append(" ")
+        result.append("{:9d} ")
+        column = (column + 1) % values_per_line
+        if column == 0:
+            result.append("\n")
+
+    if ends_section and column != 0:
+        result.append("\n")
+
+    return "".join(result)
+
+
+class PSFRenderer:
     PSF_HEADER = "PSF EXT CMAP CHEQ DRUDE\n\n1 !NTITLE\nREMARKS written by psf-pdb-builder\n"
-    ATOM_LINE_FORMAT = "{:>10}   {:3} {:8d} {:>11} {:>7}   {:3}   {:.10f} {:>9.4f}           0   {:.5f}       {:.5f}\n"
+    CONNECTIVITY_LINES_PER_CHUNK = 4096
+    CONNECTIVITY_VALUE_WIDTH = 10
+    ATOM_LINES_PER_CHUNK = 16384
+    ATOM_NUMBER_FORMAT_SPEC = ">10"
+    ATOM_LINE_RESIDUE_FORMAT = "   {:3} {:8d}"
+    ATOM_LINE_SUFFIX_FORMAT = " {:>11} {:>7}   {:3}   {:.10f} {:>9.4f}           0   {:.5f}       {:.5f}\n"
+    ATOM_LINE_FORMAT = "{:" + ATOM_NUMBER_FORMAT_SPEC + "}" + ATOM_LINE_RESIDUE_FORMAT + ATOM_LINE_SUFFIX_FORMAT
+    # (header format, atoms in a term, terms in a line) of bonds, angles and dihedrals sections
+    CONNECTIVITY_SECTIONS = (
+        ("{:>6}       !NBOND: bonds\n", 2, 4),
+        ("{:>6}     !NTHETA: angles\n", 3, 3),
+        ("{:>6}    !NPHI: dihedrals\n", 4, 2)
+    )
+    FILE_ENDING = "0 !NIMPHI: impropers\n" \
+                  "0 !NDON: donors\n" \
+                  "0 !NACC: acceptors\n" \
+                  "0 !NNB\n" \
+                  "0 !NGRP\n" \
+                  "0          0 !NUMLP NUMLPH\n" \
+                  "0 !NCRTERM: cross-terms\n" \
+                  "0 !NUMANISO\n" \
+                  "END\n"
+
+    def __init__(self, system, encoding='utf-8'):
+        self._system = system
+        self._encoding = encoding
+        self._atom_formats = {}
+        self._terms = {}
+
+    def fixed_width(self):
+        # atom numbers fill "{:>10}" and "{:9d}" columns, residue ids the "{:8d}" column
+        max_counter = max([counter for (molecule, counter) in self._system.molecules] + [0])
+        return self._system.atoms_number_with_drude < 10 ** (self.CONNECTIVITY_VALUE_WIDTH - 1) and max_counter < 10 ** 8
+
+    def pieces(self):
+        # generated lazily section by section, a piece never holds more than one chunk of residue copies
+        system = self._system
+        yield self.__text_piece(self.PSF_HEADER + "{:>6}    !NATOM\n".format(system.atoms_number_with_drude))
+
+        for (molecule_index, (molecule, counter)) in enumerate(system.molecules):
+            (copy_format, lines_number, copy_size) = self.__atom_format(molecule_index)
+            copies_per_chunk = max(1, self.ATOM_LINES_PER_CHUNK // max(1, lines_number))
+
+            for first_copy in range(0, counter, copies_per_chunk):
+                copies = min(copies_per_chunk, counter - first_copy)
+                atom_number = system.atom_offset_with_drude(molecule_index, first_copy) + 1
+                yield copies * copy_size, 'atoms', (molecule_index, first_copy, copies, atom_number)
+
+        for section_index in range(0, len(self.CONNECTIVITY_SECTIONS)):
+            yield from self.__connectivity_pieces(section_index)
+
+        yield self.__text_piece(self.FILE_ENDING)
+
+    def text(self, text):
+        return text
+
+    def atoms(self, molecule_index, first_copy, copies, first_atom_number):
+        (copy_format, lines_number, copy_size) = self.__atom_format(molecule_index)
+        segment_id = self._system.segment_id
+        atom_number = first_atom_number
+        result = []
+
+        for residue_id in range(first_copy + 1, first_copy + copies + 1):
+            residue = self.ATOM_LINE_RESIDUE_FORMAT.format(segment_id, residue_id)
+            result.append(copy_format.format(*range(atom_number, atom_number + lines_number), residue=residue))
+            atom_number += lines_number
+
+        return "".join(result)
+
+    def connectivity(self, section_index, molecule_index, copies, first_base, first_value_index, values_number):
+        # every copy of a residue differs only by the offset added to its indices
+        (header_format, term_size, terms_per_line) = self.CONNECTIVITY_SECTIONS[section_index]
+        values_per_line = term_size * terms_per_line
+        template_values = self.__terms(section_index, molecule_index)
+        atoms_number = self._system.molecules[molecule_index][0].atoms_number_with_drude
+        values = []
+        base = first_base
+
+        for _ in range(0, copies):
+            values.extend(map(base.__add__, template_values))
+            base += atoms_number
+
+        first_column = first_value_index % values_per_line
+        head_values = min((values_per_line - first_column) % values_per_line, len(values))
+        full_lines_values = (len(values) - head_values) // values_per_line * values_per_line
+        section_end = first_value_index + len(values) == values_number
+        result = []
+
+        # split into the incomplete first line, full lines and the incomplete last line to reuse cached formats
+        for (start, end) in ((0, head_values),
+                             (head_values, head_values + full_lines_values),
+                             (head_values + full_lines_values, len(values))):
+            if start < end:
+                line_format = _connectivity_format(end - start, (first_column + start) % values_per_line,
+                                                   values_per_line, section_end and end == len(values))
+                result.append(line_format.format(*values[start:end]))
+
+        return "".join(result)
+
+    def __text_piece(self, text):
+        return len(text.encode(self._encoding)), 'text', (text,)
+
+    def __connectivity_pieces(self, section_index):
+        (header_format, term_size, terms_per_line) = self.CONNECTIVITY_SECTIONS[section_index]
+        values_per_line = term_size * terms_per_line
+        system = self._system
+        terms_number = (system.bonds_number, system.angles_number, system.dihedrals_number)[section_index]
+        values_number = term_size * terms_number
+
+        yield self.__text_piece(header_format.format(terms_number))
+        if values_number == 0:
+            yield self.__text_piece(" \n")
+            return
 
-    def save_to_file(self):
-        self._output_file.write(self.PSF_HEADER)
-        self.__save_atoms_section()
-        self.__save_bonds_section()
-        self.__save_angles_section()
-        self.__save_dihedrals_section()
-        self.__save_file_ending()
-        self._output_file.close()
+        value_index = 0
+        for (molecule_index, (molecule, counter)) in enumerate(system.molecules):
+            copy_values = len(self.__terms(section_index, molecule_index))
+            if copy_values == 0:
+                continue
+
+            copies_per_chunk = max(1, self.CONNECTIVITY_LINES_PER_CHUNK * values_per_line // copy_values)
+            for first_copy in range(0, counter, copies_per_chunk):
+                copies = min(copies_per_chunk, counter - first_copy)
+                base = system.atom_offset_with_drude(molecule_index, first_copy) + 1
+                next_value_index = value_index + copies * copy_values
+                size = self.__connectivity_text_length(next_value_index, values_per_line, values_number) - \
+                    self.__connectivity_text_length(value_index, values_per_line, values_number)
+                yield size, 'connectivity', (section_index, molecule_index, copies, base, value_index, values_number)
+                value_index = next_value_index
+
+    def __connectivity_text_length(self, values, values_per_line, values_number):
+        # length of the section text preceding the value with the given index
+        started_lines = -(-values // values_per_line)
+        finished_lines = values // values_per_line
+        last_line_ending = 1 if values == values_number and values % values_per_line != 0 else 0
+        return self.CONNECTIVITY_VALUE_WIDTH * values + started_lines + finished_lines + last_line_ending
+
+    def __atom_format(self, molecule_index):
+        # only the atom number and the residue id differ between copies of a residue
+        if molecule_index not in self._atom_formats:
+            suffixes = self.__render_atom_line_suffixes(self._system.molecules[molecule_index][0])
+            copy_format = "".join("{" + str(k) + ":" + self.ATOM_NUMBER_FORMAT_SPEC + "}{residue}" +
+                                  suffix.replace("{", "{{").replace("}", "}}") for (k, suffix) in enumerate(suffixes))
+            lines_number = len(suffixes)
+            residue = self.ATOM_LINE_RESIDUE_FORMAT.format(self._system.segment_id, 1)
+            copy_size = len(copy_format.format(*range(1, lines_number + 1), residue=residue).encode(self._encoding))
+            self._atom_formats[molecule_index] = (copy_format, lines_number, copy_size)
+
+        return self._atom_formats[molecule_index]
+
+    def __render_atom_line_suffixes(self, molecule):
+        template = molecule.template
+        charges = template.charges
+        masses = template.masses
+        polarizabilities = template.polarizabilities
+        last_parameters = template.last_parameters
+        drude_flags = template.drude_flags
+        suffixes = []
+
+        for index in range(0, molecule.atoms_number):
+            suffixes.append(self.ATOM_LINE_SUFFIX_FORMAT.format(molecule.residue_name,
+                                                                template.symbol(index),
+                                                                template.namd_symbol(index),
+                                                                charges[index],
+                                                                masses[index],
+                                                                polarizabilities[index],
+                                                                last_parameters[index]))
+
+            if drude_flags[index]:
+                suffixes.append(self.ATOM_LINE_SUFFIX_FORMAT.format(molecule.residue_name,
+                                                                    template.symbol(index),
+                                                                    template.drude_namd_symbol(index),
+                                                                    template.drude_charges[index],
+                                                                    template.drude_masses[index],
+                                                                    0.0,
+                                                                    0.0))
+
+        return suffixes
+
+    def __terms(self, section_index, molecule_index):
+        key = (section_index, molecule_index)
+        if key not in self._terms:
+            molecule = self._system.molecules[molecule_index][0]
+            if section_index == 0:
+                terms = sorted(molecule.bonds + molecule.drude_bonds)
+            elif section_index == 1:
+                terms = molecule.angles
+            else:
+                terms = molecule.dihedrals
+            self._terms[key] = array('q', chain.from_iterable(terms))
+
+        return self._terms[key]
+
+
+class PSFSaver(FileSaver):
+    PSF_HEADER = PSFRenderer.PSF_HEADER
+    ATOM_LINE_FORMAT = PSFRenderer.ATOM_LINE_FORMAT
+    STAGE_NAME = "write_psf"
+
+    def _save(self):
+        self._write_pieces(PSFRenderer(self._system, self.ENCODING))
         print('PSF file successfully written')
+        return True
 
-    def __save_atoms_section(self):
-        atom_number = 1
-        self._output_file.write("{:>6}    !NATOM\n".format(self._system.atoms_number_with_drude))
-
-        for (molecule, counter) in self._system.molecules:
-            residue_id = 1
-
-            for i in range(0, counter):
-                for atom in molecule.atoms:
-                    self._output_file.write(self.ATOM_LINE_FORMAT.format(atom_number,
-                                                                         self._system.segment_id,
-                                                                         residue_id,
-                                                                         molecule.residue_name,
-                                                                         atom.symbol,
-                                                                         atom.namd_symbol,
-                                                                         atom.charge,
-                                                                         atom.mass,
-                                                                         atom.polarizability,
-                                                                         atom.last_parameter))
 
-                    drude_atom = atom.drude_atom
-                    if drude_atom is not None:
-                        atom_number += 1
-                        self._output_file.write(self.ATOM_LINE_FORMAT.format(atom_number,
-                                                                             self._system.segment_id,
-                                                                             residue_id,
-                                                                             molecule.residue_name,
-                                                                             drude_atom.symbol,
-                                                                             drude_atom.namd_symbol,
-                                                                             drude_atom.charge,
-                                                                             drude_atom.mass,
-                                                                             drude_atom.polarizability,
-                                                                             drude_atom.last_parameter))
+def hybrid36_encode(width, value):
+    # decimal up to 10^width - 1, then upper case and finally lower case base-36 numbers of the same width
+    if value < 10 ** width:
+        return "{:{}d}".format(value, width)
 
-                    atom_number += 1
-                residue_id += 1
-
-    def __save_bonds_section(self):
-        bonds = {}
-        bonds_number = 0
-
-        for (molecule, counter) in self._system.molecules:
-            bonds[molecule] = sorted(molecule.bonds + molecule.drude_bonds)
-            bonds_number += counter * len(bonds[molecule])
-
-        self._output_file.write("{:>6}       !NBOND: bonds\n".format(bonds_number))
-        base = 1
-
-        self._output_file.write(" ")
-        items_in_line = 0
-
-        bond_counter = 0
-
-        for (molecule, counter) in self._system.molecules:
-            bond_list = bonds[molecule]
-
-            for i in range(0, counter):
-                for (first, second) in bond_list:
-                    self._output_file.write("{:9d} {:9d} ".format(first + base, second + base))
-                    items_in_line = (items_in_line + 1) % 4
-                    bond_counter += 1
-
-                    if items_in_line == 0 and bond_counter < bonds_number:
-                        self._output_file.write('\n ')
-                base += molecule.atoms_number_with_drude
-
-        self._output_file.write('\n')
-
-    def __save_angles_section(self):
-        angles = {}
-        angles_number = 0
-
-        for (molecule, counter) in self._system.molecules:
-            angles[molecule] = molecule.angles
-            angles_number += counter * len(angles[molecule])
-
-        self._output_file.write("{:>6}     !NTHETA: angles\n".format(angles_number))
-        base = 1
-
-        self._output_file.write(" ")
-        items_in_line = 0
-
-        angle_counter = 0
-
-        for (molecule, counter) in self._system.molecules:
-            angle_list = angles[molecule]
-
-            for i in range(0, counter):
-                for (first, middle, last) in angle_list:
-                    self._output_file.write("{:9d} {:9d} {:9d} ".format(first + base, middle + base, last + base))
-                    items_in_line = (items_in_line + 1) % 3
-                    angle_counter += 1
-
-                    if items_in_line == 0 and angle_counter < angles_number:
-                        self._output_file.write('\n ')
-                base += molecule.atoms_number_with_drude
-
-        self._output_file.write('\n')
-
-    def __save_dihedrals_section(self):
-        dihedrals = {}
-        dihedrals_number = 0
-
-        for (molecule, counter) in self._system.molecules:
-            dihedrals[molecule] = molecule.dihedrals
-            dihedrals_number += counter * len(dihedrals[molecule])
-
-        self._output_file.write("{:>6}    !NPHI: dihedrals\n".format(dihedrals_number))
-        base = 1
-
-        self._output_file.write(" ")
-        items_in_line = 0
+    value -= 10 ** width
+    block_size = 26 * 36 ** (width - 1)
+    for digits in (HYBRID36_UPPER_DIGITS, HYBRID36_LOWER_DIGITS):
+        if value < block_size:
+            value += 10 * 36 ** (width - 1)
+            result = ""
+            while value > 0:
+                value, digit = divmod(value, 36)
+                result = digits[digit] + result
+            return result
 
-        dihedral_counter = 0
+        value -= block_size
 
-        for (molecule, counter) in self._system.molecules:
-            dihedral_list = dihedrals[molecule]
+    raise ValueError("Value out of hybrid-36 range for width {}".format(width))
 
-            for i in range(0, counter):
-                for (first, second, third, fourth) in dihedral_list:
-                    self._output_file.write(
-                        "{:9d} {:9d} {:9d} {:9d} ".format(first + base, second + base, third + base, fourth + base))
-                    items_in_line = (items_in_line + 1) % 2
-                    dihedral_counter += 1
 
-                    if items_in_line == 0 and dihedral_counter < dihedrals_number:
-                        self._output_file.write('\n ')
-                base += molecule.atoms_number_with_drude
+def hybrid36_max(width):
+    # largest value hybrid36_encode accepts for the width
+    return 10 ** width + 2 * 26 * 36 ** (width - 1) - 1
 
-        self._output_file.write('\n')
 
-    def __save_file_ending(self):
-        self._output_file.write("{} !NIMPHI: impropers\n".format(0))
-        self._output_file.write("{} !NDON: donors\n".format(0))
-        self._output_file.write("{} !NACC: acceptors\n".format(0))
-        self._output_file.write("{} !NNB\n".format(0))
-        self._output_file.write("{} !NGRP\n".format(0))
-        self._output_file.write("{}  {:>9} !NUMLP NUMLPH\n".format(0, 0))
-        self._output_file.write("{} !NCRTERM: cross-terms\n".format(0))
-        self._output_file.write("{} !NUMANISO\n".format(0))
-        self._output_file.write("END\n")
+def hybrid36_encode_range(width, start, stop):
+    # the same as hybrid36_encode for every value of range(start, stop); base-36 numbers of every 36 consecutive
+    # values share all digits but the last one, so only the first value of such a group is encoded
+    decimal_stop = min(stop, 10 ** width)
+    result = list(map(("%" + str(width) + "d").__mod__, range(start, decimal_stop)))
 
+    value = max(start, 10 ** width)
+    while value < stop:
+        last_digit = (value - 10 ** width) % 36
+        group_stop = min(stop, value + 36 - last_digit)
+        encoded = hybrid36_encode(width, value)
+        digits = HYBRID36_LOWER_DIGITS if encoded[0].islower() else HYBRID36_UPPER_DIGITS
+        result.extend(map(encoded[:-1].__add__, digits[last_digit:last_digit + group_stop - value]))
+        value = group_stop
 
-class PDBSaver(FileSaver):
+    return result
+
+
+HYBRID36_UPPER_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+HYBRID36_LOWER_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+class PDBRenderer:
     FIRST_LINE = "CRYST1    0.000    0.000    0.000  90.00  90.00  90.00 P 1           1\n"
     LINE_FORMAT = "ATOM {:6d}  {:3} {:>3} X {:3d}     {:7.3f} {:7.3f} {:7.3f} {:5.2f} {:5.2f}      {:4}\n"
-
-    def save_to_file(self):
-        xyz_file = open(self._system.xyz_file_name, 'r')
+    SERIAL_WIDTH = 5
+    RESIDUE_ID_WIDTH = 4
+    NUMBERING_HYBRID36 = "hybrid36"
+    NUMBERING_WRAP = "wrap"
+    LINES_PER_CHUNK = 16384
+    # coordinates in this range always fill exactly the "{:7.3f}" columns
+    MIN_FIXED_WIDTH_COORDINATE = -99.999
+    MAX_FIXED_WIDTH_COORDINATE = 999.999
+
+    def __init__(self, system, coordinates, numbering=NUMBERING_HYBRID36, encoding='utf-8'):
+        self._system = system
+        self._coordinates = coordinates
+        self._numbering = numbering
+        self._encoding = encoding
+        self._copy_formats = {}
 
         occupancy = 0.00
         temperature_factor = 0.00
-        atom_number = 1
+        line_ending = " {:5.2f} {:5.2f}      {:4}\n".format(occupancy, temperature_factor, system.segment_id)
+        self._line_ending = line_ending.replace("%", "%%")
+
+    def fixed_width(self):
+        if len(self._coordinates) == 0:
+            return True
+
+        return min(self._coordinates) >= self.MIN_FIXED_WIDTH_COORDINATE and \
+            max(self._coordinates) <= self.MAX_FIXED_WIDTH_COORDINATE
+
+    def pieces(self):
+        system = self._system
+        yield self.__text_piece(self.FIRST_LINE)
+
+        for (molecule_index, (molecule, counter)) in enumerate(system.molecules):
+            (decimal_format, encoded_format, line_atoms, copy_size) = self.__copy_formats(molecule_index)
+            copies_per_chunk = max(1, self.LINES_PER_CHUNK // max(1, len(line_atoms)))
+
+            for first_copy in range(0, counter, copies_per_chunk):
+                copies = min(copies_per_chunk, counter - first_copy)
+                atom_number = system.atom_offset_with_drude(molecule_index, first_copy) + 1
+                coordinates_offset = 3 * system.atom_offset(molecule_index, first_copy)
+                yield copies * copy_size, 'atoms', (molecule_index, first_copy, copies, atom_number, coordinates_offset)
+
+        yield self.__text_piece('END\n')
+
+    def text(self, text):
+        return text
+
+    def atoms(self, molecule_index, first_copy, copies, first_atom_number, coordinates_offset):
+        # the whole block of copies is rendered by one % operation, its (serial, residue id, x, y, z) arguments of
+        # every line are laid out column by column
+        (decimal_format, encoded_format, line_atoms, copy_size) = self.__copy_formats(molecule_index)
+        atoms_number = self._system.molecules[molecule_index][0].atoms_number
+        lines_number = len(line_atoms)
+        block_lines = copies * lines_number
+        arguments = [None] * (5 * block_lines)
+
+        serials = range(first_atom_number, first_atom_number + block_lines)
+        if first_atom_number + block_lines - 1 <= 10 ** self.SERIAL_WIDTH - 1:
+            copy_format = decimal_format
+            arguments[0::5] = serials
+        else:
+            copy_format = encoded_format
+            arguments[0::5] = self.__numbers(self.SERIAL_WIDTH, serials)
+
+        residues = self.__numbers(self.RESIDUE_ID_WIDTH, range(first_copy + 1, first_copy + copies + 1))
+        arguments[1::5] = chain.from_iterable(map(repeat, residues, repeat(lines_number)))
+
+        block_coordinates = self._coordinates[coordinates_offset:coordinates_offset + 3 * atoms_number * copies]
+        if lines_number == atoms_number:
+            for axis in range(0, 3):
+                arguments[2 + axis::5] = block_coordinates[axis::3]
+        else:
+            # Drude particles are placed on their parent atoms
+            line_indices = self.__block_line_indices(line_atoms, atoms_number, copies)
+            for axis in range(0, 3):
+                arguments[2 + axis::5] = map(block_coordinates[axis::3].__getitem__, line_indices)
+
+        return (copy_format * copies) % tuple(arguments)
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def __block_line_indices(line_atoms, atoms_number, copies):
+        # index of the atom in the block whose coordinates every line of the block takes
+        return tuple(copy * atoms_number + index for copy in range(0, copies) for index in line_atoms)
+
+    def __text_piece(self, text):
+        return len(text.encode(self._encoding)), 'text', (text,)
+
+    def __number(self, width, value):
+        if self._numbering == self.NUMBERING_WRAP:
+            return "{:{}d}".format(value % 10 ** width, width)
+
+        return hybrid36_encode(width, value)
+
+    def __numbers(self, width, values):
+        if self._numbering == self.NUMBERING_WRAP:
+            return map(("%" + str(width) + "d").__mod__, map((10 ** width).__rmod__, values))
+
+        return hybrid36_encode_range(width, values.start, values.stop)
+
+    def __copy_formats(self, molecule_index):
+        if molecule_index not in self._copy_formats:
+            molecule = self._system.molecules[molecule_index][0]
+            fragments = self.__render_atom_fragments(molecule)
+            line_atoms = tuple(index for (index, fragment) in fragments)
+            decimal_format = self.__copy_format(fragments, "%" + str(self.SERIAL_WIDTH) + "d")
+            encoded_format = self.__copy_format(fragments, "%s")
+            sample = decimal_format % tuple(chain.from_iterable(
+                (serial, self.__number(self.RESIDUE_ID_WIDTH, 1), 0.0, 0.0, 0.0)
+                for serial in range(1, len(fragments) + 1)))
+            copy_size = len(sample.encode(self._encoding))
+            self._copy_formats[molecule_index] = (decimal_format, encoded_format, line_atoms, copy_size)
+
+        return self._copy_formats[molecule_index]
+
+    @staticmethod
+    def __render_atom_fragments(molecule):
+        # (atom index, text between serial and residue id) for every PDB line, Drude particles follow their parent
+        template = molecule.template
+        fragments = []
+
+        for index in range(0, molecule.atoms_number):
+            fragments.append((index, "  {:3} {:>3} X".format(template.namd_symbol(index), molecule.residue_name)))
+
+            if template.drude_flags[index]:
+                fragments.append((index, "  {:3} {:>3} X".format(template.drude_namd_symbol(index),
+                                                                 molecule.residue_name)))
+
+        return fragments
+
+    def __copy_format(self, fragments, serial_spec):
+        # arguments of every line are its serial, residue id and coordinates
+        line_formats = ["ATOM  " + serial_spec + fragment.replace("%", "%%") + "%s     %7.3f %7.3f %7.3f" +
+                        self._line_ending for (index, fragment) in fragments]
+
+        return "".join(line_formats)
 
-        # check if number of atoms in .xyz matches number given in system
-        atoms_number = int(xyz_file.readline())
-        if atoms_number != self._system.atoms_number:
-            print('[ERROR] Number of atoms calculated from Packmol input does not match number of atoms in .xyz file')
-            xyz_file.close()
-            return
 
-        # write header line in PDB
-        self._output_file.write(self.FIRST_LINE)
-
-        # omit commentary line in .xyz
-        xyz_file.readline()
-
-        for (molecule, counter) in self._system.molecules:
-            residue_id = 1
-
-            for i in range(0, counter):
-                for atom in molecule.atoms:
-                    xyz_line = xyz_file.readline().split()
-
-                    if xyz_line[0] != atom.symbol:
-                        print('[ERROR] No match between atoms in line {}, symbol is {}, expected {}'.format(xyz_line,
-                                                                                                            xyz_line[0],
-                                                                                                            atom.symbol))
-                        xyz_file.close()
-                        self._output_file.close()
-                        return
-
-                    coordinates = model.Coordinates(float(xyz_line[1]), float(xyz_line[2]), float(xyz_line[3]))
-                    self._output_file.write(self.LINE_FORMAT.format(atom_number,
-                                                                    atom.namd_symbol,
-                                                                    molecule.residue_name,
-                                                                    residue_id,
-                                                                    coordinates.x,
-                                                                    coordinates.y,
-                                                                    coordinates.z,
-                                                                    occupancy,
-                                                                    temperature_factor,
-                                                                    self._system.segment_id))
-
-                    drude_atom = atom.drude_atom
-                    if drude_atom is not None:
-                        atom_number += 1
-                        self._output_file.write(self.LINE_FORMAT.format(atom_number,
-                                                                        drude_atom.namd_symbol,
-                                                                        molecule.residue_name,
-                                                                        residue_id,
-                                                                        coordinates.x,
-                                                                        coordinates.y,
-                                                                        coordinates.z,
-                                                                        occupancy,
-                                                                        temperature_factor,
-                                                                        self._system.segment_id))
-
-                    atom_number += 1
-                residue_id += 1
-
-        self._output_file.write('END\n')
-
-        xyz_file.close()
-        self._output_file.close()
+class PDBSaver(FileSaver):
+    FIRST_LINE = PDBRenderer.FIRST_LINE
+    LINE_FORMAT = PDBRenderer.LINE_FORMAT
+    NUMBERING_HYBRID36 = PDBRenderer.NUMBERING_HYBRID36
+    NUMBERING_WRAP = PDBRenderer.NUMBERING_WRAP
+    STAGE_NAME = "write_pdb"
+
+    def __init__(self, output, system, numbering=NUMBERING_HYBRID36, workers=1,
+                 buffer_size=FileSaver.DEFAULT_BUFFER_SIZE, profiler=None, compression=OutputTarget.COMPRESSION_AUTO):
+        if numbering not in (self.NUMBERING_HYBRID36, self.NUMBERING_WRAP):
+            raise ValueError("Unknown PDB numbering mode: {}".format(numbering))
+
+        super().__init__(output, system, workers, buffer_size, profiler, compression)
+        self._numbering = numbering
+
+    def _save(self):
+        if not self.__numbering_fits():
+            return False
+
+        system_coordinates = readingutils.SystemXYZReader(self._system.xyz_file_name).read()
+
+        if not validate_coordinates(self._system, system_coordinates):
+            return False
+
+        self._write_pieces(PDBRenderer(self._system, system_coordinates.coordinates, self._numbering, self.ENCODING))
         print('PDB file successfully written')
+        return True
+
+    def __numbering_fits(self):
+        # residue ids restart with every residue type, wrapped numbers always fit
+        if self._numbering == self.NUMBERING_WRAP:
+            return True
+
+        fields = (("atom serial numbers", PDBRenderer.SERIAL_WIDTH, self._system.atoms_number_with_drude),
+                  ("residue ids", PDBRenderer.RESIDUE_ID_WIDTH,
+                   max((counter for (molecule, counter) in self._system.molecules), default=0)))
+        for (field_name, width, max_value) in fields:
+            if max_value > hybrid36_max(width):
+                print('[ERROR] PDB {} up to {} exceed the hybrid-36 range of {} columns ({}), use {} numbering'.format(
+                    field_name, max_value, width, hybrid36_max(width), self.NUMBERING_WRAP))
+                return False
+
+        return True
+
+
+class NAMDBinarySaver(FileSaver):
+    # NAMD binary coordinates: number of atoms as int32 followed by x, y, z of every atom as float64, little-endian
+    ATOMS_NUMBER_FORMAT = '<i'
+    STAGE_NAME = "write_coor"
+    BINARY = True
+
+    def _save(self):
+        system_coordinates = readingutils.SystemXYZReader(self._system.xyz_file_name).read()
+        if not validate_coordinates(self._system, system_coordinates):
+            return False
+
+        coordinates = system_coordinates.coordinates
+        expansion = drude_expansion(self._system)
+        if expansion is not None:
+            expanded_coordinates = array('d', bytes(8 * 3 * len(expansion)))
+            for axis in range(0, 3):
+                expanded_coordinates[axis::3] = array('d', map(coordinates[axis::3].__getitem__, expansion))
+            coordinates = expanded_coordinates
+        elif sys.byteorder != 'little':
+            coordinates = array('d', coordinates)
+
+        if sys.byteorder != 'little':
+            coordinates.byteswap()
+
+        output_file = self._target.open()
+        output_file.write(struct.pack(self.ATOMS_NUMBER_FORMAT, self._system.atoms_number_with_drude))
+        output_file.write(coordinates.tobytes())
+
+        print('NAMD binary coordinates file successfully written')
+        return True
+
+
+def validate_coordinates(system, system_coordinates):
+    # atoms read from .xyz have to follow the order of residues and their atoms in system
+    if system_coordinates.declared_atoms_number != system.atoms_number or \
+            system_coordinates.atoms_number != system.atoms_number:
+        print('[ERROR] Number of atoms calculated from Packmol input does not match number of atoms in .xyz file')
+        return False
+
+    symbols = system_coordinates.symbols
+    symbol_ids = system_coordinates.symbol_ids
+    missing_id = len(symbols)
+    position = 0
+
+    for (molecule, counter) in system.molecules:
+        template = molecule.template
+        atoms_number = molecule.atoms_number
+        expected_ids = array('I', (symbols.get(template.symbol(index), missing_id)
+                                   for index in range(0, atoms_number)))
+        block_end = position + atoms_number * counter
+
+        if symbol_ids[position:block_end] != expected_ids * counter:
+            for atom_index in range(position, block_end):
+                index = (atom_index - position) % atoms_number
+                if symbol_ids[atom_index] != expected_ids[index]:
+                    print('[ERROR] No match between atoms in line {}, symbol is {}, expected {}'.format(
+                        system_coordinates.line_number(atom_index),
+                        system_coordinates.symbol(atom_index),
+                        template.symbol(index)))
+                    return False
+
+        position = block_end
+
+    return True
+
+
+def drude_expansion(system):
+    # indices of .xyz atoms in the order of atoms with Drude particles, which take the position of their parent atom,
+    # None when there are no Drude particles
+    if system.atoms_number_with_drude == system.atoms_number:
+        return None
+
+    expansion = array('I')
+    for (molecule_index, (molecule, counter)) in enumerate(system.molecules):
+        drude_flags = molecule.template.drude_flags
+        local_indices = array('I')
+        for index in range(0, molecule.atoms_number):
+            local_indices.extend((index, index) if drude_flags[index] else (index,))
+
+        base = system.atom_offset(molecule_index)
+        for _ in range(0, counter):
+            expansion.extend(map(base.__add__, local_indices))
+            base += molecule.atoms_number
+
+    return expansion
+
+
+class DCDSaver(FileSaver):
+    # CHARMM/NAMD little-endian DCD without unit cell, every record is surrounded by its length as in Fortran
+    HEADER_FORMAT = '<i4s9if10ii'
+    TITLE_FORMAT = '<ii80s80si'
+    ATOMS_FORMAT = '<iii'
+    CHARMM_VERSION = 24
+    TITLE = (b"REMARKS written by psf-pdb-builder", b"REMARKS frames converted from .xyz")
+    STAGE_NAME = "write_dcd"
+    BINARY = True
+
+    def __init__(self, output, system, trajectory_file_name=None, first_step=0, steps_between_frames=1,
+                 timestep=1.0, profiler=None, compression=OutputTarget.COMPRESSION_AUTO):
+        super().__init__(output, system, profiler=profiler, compression=compression)
+        self._trajectory_file_name = trajectory_file_name or system.xyz_file_name
+        self._first_step = first_step
+        self._steps_between_frames = steps_between_frames
+        self._timestep = timestep
+
+    def _save(self):
+        # the header holds the number of frames, it is rewritten at the end of a file, while frames for a stream or
+        # a compressed file are kept in a temporary file until all of them are counted
+        expansion = drude_expansion(self._system)
+        frames_number = 0
+        succeeded = True
+        output_file = self._target.open()
+        frames_file = output_file if self._target.seekable else tempfile.TemporaryFile()
+
+        try:
+            if self._target.seekable:
+                output_file.write(self.__header(0))
+
+            try:
+                for system_coordinates in readingutils.SystemXYZReader(self._trajectory_file_name).frames():
+                    if not validate_coordinates(self._system, system_coordinates):
+                        print('[ERROR] Frame {} of {} does not match the system'.format(frames_number + 1,
+                                                                                       self._trajectory_file_name))
+                        succeeded = False
+                        break
+
+                    self.__write_frame(frames_file, system_coordinates.coordinates, expansion)
+                    frames_number += 1
+            except ValueError as error:
+                print('[ERROR] {}'.format(error))
+                succeeded = False
+
+            if not succeeded or frames_number == 0:
+                if succeeded:
+                    print('[ERROR] No frames found in {}'.format(self._trajectory_file_name))
+                return False
+
+            if self._target.seekable:
+                output_file.seek(0)
+                output_file.write(self.__header(frames_number))
+            else:
+                output_file.write(self.__header(frames_number))
+                frames_file.seek(0)
+                shutil.copyfileobj(frames_file, output_file, self.DEFAULT_BUFFER_SIZE)
+        finally:
+            if frames_file is not output_file:
+                frames_file.close()
+
+        print('DCD file successfully written, {} frames'.format(frames_number))
+        return True
+
+    def __header(self, frames_number):
+        atoms_number = self._system.atoms_number_with_drude
+        last_step = self._first_step + max(0, frames_number - 1) * self._steps_between_frames
+        return struct.pack(self.HEADER_FORMAT, 84, b'CORD', frames_number, self._first_step,
+                           self._steps_between_frames, last_step, 0, 0, 0, 0, 0, self._timestep, 0, 0, 0, 0, 0, 0, 0,
+                           0, 0, self.CHARMM_VERSION, 84) + \
+            struct.pack(self.TITLE_FORMAT, 164, len(self.TITLE), self.TITLE[0], self.TITLE[1], 164) + \
+            struct.pack(self.ATOMS_FORMAT, 4, atoms_number, 4)
+
+    @staticmethod
+    def __write_frame(output_file, coordinates, expansion):
+        atoms_number = len(coordinates) // 3 if expansion is None else len(expansion)
+        record_length = struct.pack('<i', 4 * atoms_number)
+
+        for axis in range(0, 3):
+            values = coordinates[axis::3]
+            if expansion is not None:
+                values = map(values.__getitem__, expansion)
+            values = array('f', values)
+            if sys.byteorder != 'little':
+                values.byteswap()
+
+            output_file.write(record_length)
+            output_file.write(values.tobytes())
+            output_file.write(record_length)
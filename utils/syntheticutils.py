@@ -0,0 +1,109 @@
+import math
+import os
+
+RESIDUE_NAME = "SYN"
+RESIDUE_FILE_NAME = "syn.xyz"
+SYSTEM_FILE_NAME = "system.xyz"
+PACKMOL_FILE_NAME = "system.inp"
+DEFAULT_RESIDUE_ATOMS = 10
+# zig-zag chain of carbons 1.5 A apart, residues placed on a cubic lattice so that none of them overlap
+CHAIN_STEP_X = 1.25
+CHAIN_STEP_Y = 0.83
+LATTICE_MARGIN = 3.0
+RESIDUES_PER_CHUNK = 4096
+
+
+def residue_coordinates(residue_atoms):
+    return [(CHAIN_STEP_X * i, CHAIN_STEP_Y * (i % 2), 0.0) for i in range(0, residue_atoms)]
+
+
+def chain_terms(residue_atoms, term_size):
+    # 1-based atom numbers of bonds, angles or dihedrals along the chain
+    return [tuple(range(i + 1, i + term_size + 1)) for i in range(0, residue_atoms - term_size + 1)]
+
+
+def generate_system(directory, atoms_number, tinker_format=False, residue_atoms=DEFAULT_RESIDUE_ATOMS):
+    # writes a Packmol input with one structure of chain residues, their .xyz, .dat (with polarizabilities, used only
+    # with Drude particles) and .conn files, and the system .xyz with about atoms_number atoms,
+    # returns the name of the Packmol input
+    os.makedirs(directory, exist_ok=True)
+    residues_number = max(1, atoms_number // residue_atoms)
+    coordinates = residue_coordinates(residue_atoms)
+
+    with open(os.path.join(directory, PACKMOL_FILE_NAME), 'w') as packmol_file:
+        packmol_file.write("tolerance 2.0\noutput {}\nfiletype xyz\n".format(SYSTEM_FILE_NAME))
+        packmol_file.write("structure {}\n  number {}\nend structure\n".format(RESIDUE_FILE_NAME, residues_number))
+
+    residue_file_name = os.path.join(directory, RESIDUE_FILE_NAME)
+    if tinker_format:
+        write_tinker_residue(residue_file_name, coordinates)
+        write_conn(residue_file_name.replace('.xyz', '.conn'), residue_atoms)
+    else:
+        write_residue(residue_file_name, coordinates)
+    write_dat(residue_file_name.replace('.xyz', '.dat'), residue_atoms, not tinker_format)
+
+    write_system(os.path.join(directory, SYSTEM_FILE_NAME), coordinates, residues_number)
+
+    return os.path.join(directory, PACKMOL_FILE_NAME)
+
+
+def write_residue(file_name, coordinates):
+    with open(file_name, 'w') as xyz_file:
+        xyz_file.write("{}\nsynthetic residue\n".format(len(coordinates)))
+        for (x, y, z) in coordinates:
+            xyz_file.write("C {:.6f} {:.6f} {:.6f}\n".format(x, y, z))
+
+
+def write_tinker_residue(file_name, coordinates):
+    with open(file_name, 'w') as xyz_file:
+        xyz_file.write("{:>6}  synthetic residue\n".format(len(coordinates)))
+        for (index, (x, y, z)) in enumerate(coordinates):
+            neighbours = [number for number in (index, index + 2) if 1 <= number <= len(coordinates)]
+            xyz_file.write("{:>6}  C {:12.6f} {:12.6f} {:12.6f} {:>5} {}\n".format(
+                index + 1, x, y, z, 1, " ".join("{:>5}".format(number) for number in neighbours)))
+
+
+def write_dat(file_name, residue_atoms, with_bonds):
+    with open(file_name, 'w') as dat_file:
+        dat_file.write(RESIDUE_NAME + "\n")
+        for i in range(0, residue_atoms):
+            dat_file.write("CT {:.2f} 12.011 d 1.00\n".format(-0.1 if i % 2 == 0 else 0.1))
+
+        if with_bonds:
+            dat_file.write("BONDS:\n")
+            for bond in chain_terms(residue_atoms, 2):
+                dat_file.write("{} {}\n".format(*bond))
+            dat_file.write("END\n")
+
+
+def write_conn(file_name, residue_atoms):
+    # only the parts of Tinker analyze output which are read
+    sections = (("Bond Stretching Parameters", 2), ("Angle Bending Parameters", 3), ("Torsional Angle Parameters", 4))
+
+    with open(file_name, 'w') as conn_file:
+        conn_file.write("\n Total Numbers of Atoms and Interactions :\n\n Atoms in System {:>21}\n".format(
+            residue_atoms))
+        for (header, term_size) in sections:
+            conn_file.write("\n {} :\n\n          Atom Numbers\n\n".format(header))
+            for (number, term) in enumerate(chain_terms(residue_atoms, term_size), 1):
+                conn_file.write("{:>6}   {}   1.0000\n".format(number, " ".join("{:>5}".format(i) for i in term)))
+
+
+def write_system(file_name, coordinates, residues_number):
+    lattice_size = max(1, math.ceil(round(residues_number ** (1 / 3), 6)))
+    spacing_x = CHAIN_STEP_X * len(coordinates) + LATTICE_MARGIN
+    spacing = CHAIN_STEP_Y + LATTICE_MARGIN
+
+    with open(file_name, 'w') as xyz_file:
+        xyz_file.write("{}\nsynthetic system\n".format(residues_number * len(coordinates)))
+
+        for first_residue in range(0, residues_number, RESIDUES_PER_CHUNK):
+            lines = []
+            for residue in range(first_residue, min(residues_number, first_residue + RESIDUES_PER_CHUNK)):
+                (offset_x, offset_y, offset_z) = (spacing_x * (residue % lattice_size),
+                                                  spacing * (residue // lattice_size % lattice_size),
+                                                  spacing * (residue // lattice_size ** 2))
+                for (x, y, z) in coordinates:
+                    lines.append("C {:.6f} {:.6f} {:.6f}\n".format(x + offset_x, y + offset_y, z + offset_z))
+
+            xyz_file.write("".join(lines))
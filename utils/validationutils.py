@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from itertools import repeat
+from math import sqrt
+
+from utils import model
+
+DEFAULT_BOND_TOLERANCE = 0.2
+DEFAULT_CLASH_DISTANCE = 1.0
+# atoms of more residues than this in one cell of the clash grid always clash, two of them share an eighth of the
+# cell and are closer than its size; such cells are reported but not searched
+MAX_CELL_RESIDUES = 8
+# every pair of neighbouring cells is visited once, the cell itself is searched separately
+HALF_NEIGHBOUR_CELL_OFFSETS = tuple(offset for offset in model.NEIGHBOUR_CELL_OFFSETS if offset > (0, 0, 0))
+
+
+class GeometryReport:
+    EXAMPLES_LIMIT = 10
+
+    def __init__(self):
+        self._bonds_checked = 0
+        self._stretched_bonds_number = 0
+        self._clashes_number = 0
+        self._overcrowded_atoms_number = 0
+        # numbers of stretched bonds and clashes of every offending residue, given by its index in the whole system
+        self._residue_stretched_bonds = Counter()
+        self._residue_clashes = Counter()
+        self._stretched_bonds = []
+        self._clashes = []
+
+    @property
+    def bonds_checked(self):
+        return self._bonds_checked
+
+    @property
+    def stretched_bonds_number(self):
+        return self._stretched_bonds_number
+
+    @property
+    def clashes_number(self):
+        return self._clashes_number
+
+    @property
+    def overcrowded_atoms_number(self):
+        return self._overcrowded_atoms_number
+
+    @property
+    def residues(self):
+        # index of every offending residue in the whole system mapped to (stretched bonds, clashes)
+        return {residue: (self._residue_stretched_bonds[residue], self._residue_clashes[residue])
+                for residue in set(self._residue_stretched_bonds) | set(self._residue_clashes)}
+
+    @property
+    def stretched_bonds(self):
+        # first EXAMPLES_LIMIT of (residue index, first atom, second atom, distance, template distance), atoms are
+        # numbered within the residue
+        return self._stretched_bonds
+
+    @property
+    def clashes(self):
+        # first EXAMPLES_LIMIT of (first global atom index, second global atom index, distance)
+        return self._clashes
+
+    @property
+    def valid(self):
+        return self._stretched_bonds_number == 0 and self._clashes_number == 0 and self._overcrowded_atoms_number == 0
+
+    def add_checked_bonds(self, bonds_number):
+        self._bonds_checked += bonds_number
+
+    def add_stretched_bonds(self, first, second, expected, residues, distances):
+        # one bond of a residue, stretched in the given residues
+        self._stretched_bonds_number += len(residues)
+        self._residue_stretched_bonds.update(residues)
+        for (residue, distance) in zip(residues, distances):
+            if len(self._stretched_bonds) >= self.EXAMPLES_LIMIT:
+                break
+            self._stretched_bonds.append((residue, first, second, distance, expected))
+
+    def add_clashes(self, atom, residue, other_atoms, other_residues, distances):
+        # clashes of one atom with atoms of other residues
+        self._clashes_number += len(other_atoms)
+        self._residue_clashes[residue] += len(other_atoms)
+        self._residue_clashes.update(other_residues)
+        for (other_atom, distance) in zip(other_atoms, distances):
+            if len(self._clashes) >= self.EXAMPLES_LIMIT:
+                break
+            self._clashes.append((min(atom, other_atom), max(atom, other_atom), distance))
+
+    def add_overcrowded_atoms(self, atoms_number):
+        self._overcrowded_atoms_number += atoms_number
+
+    def summary(self, system, system_coordinates):
+        residues = self.residues
+        lines = ['Checked {} bonds: {} stretched, {} intermolecular clashes, {} offending residues'.format(
+            self._bonds_checked, self._stretched_bonds_number, self._clashes_number, len(residues))]
+        residue_offsets = first_residue_indices(system)
+
+        for (residue, first, second, distance, expected) in self._stretched_bonds:
+            lines.append('[WARNING] Bond {}-{} of {} is {:.3f} A long, {:.3f} A in the residue file'.format(
+                first + 1, second + 1, self.__residue(system, system_coordinates, residue_offsets, residue), distance,
+                expected))
+
+        for (first, second, distance) in self._clashes:
+            (first_residue, second_residue) = (residue_offsets[molecule_index] + copy for (molecule_index, copy, index)
+                                               in (system.locate_atom(first), system.locate_atom(second)))
+            lines.append('[WARNING] Atoms in lines {} and {} are {:.3f} A apart, {} and {}'.format(
+                system_coordinates.line_number(first), system_coordinates.line_number(second), distance,
+                self.__residue(system, system_coordinates, residue_offsets, first_residue),
+                self.__residue(system, system_coordinates, residue_offsets, second_residue)))
+
+        if self._overcrowded_atoms_number:
+            lines.append('[WARNING] {} atoms are crowded in grid cells with atoms of more than {} residues, which '
+                         'clash and are not counted'.format(self._overcrowded_atoms_number, MAX_CELL_RESIDUES))
+
+        worst_residues = sorted(residues.items(), key=lambda item: (-sum(item[1]), item[0]))[0:self.EXAMPLES_LIMIT]
+        for (residue, (stretched_bonds, clashes)) in worst_residues:
+            lines.append('[WARNING] {}: {} stretched bonds, {} clashes'.format(
+                self.__residue(system, system_coordinates, residue_offsets, residue), stretched_bonds, clashes))
+
+        return "\n".join(lines)
+
+    @staticmethod
+    def __residue(system, system_coordinates, residue_offsets, residue):
+        molecule_index = bisect_right(residue_offsets, residue) - 1
+        copy = residue - residue_offsets[molecule_index]
+        return 'residue {} {} (line {})'.format(system.molecules[molecule_index][0].residue_name, copy + 1,
+                                                system_coordinates.line_number(system.atom_offset(molecule_index,
+                                                                                                  copy)))
+
+
+def validate_geometry(system, system_coordinates, bond_tolerance=DEFAULT_BOND_TOLERANCE,
+                      clash_distance=DEFAULT_CLASH_DISTANCE):
+    # atoms of system_coordinates have to match the residues, see savingutils.validate_coordinates
+    if not 0 <= bond_tolerance < float('inf'):
+        raise ValueError("Bond tolerance must be a non-negative number, got {}".format(bond_tolerance))
+    if not clash_distance > 0:
+        raise ValueError("Clash distance must be positive, got {}".format(clash_distance))
+
+    report = GeometryReport()
+    check_bonds(system, system_coordinates.coordinates, bond_tolerance, report)
+    check_clashes(system, system_coordinates.coordinates, clash_distance, report)
+
+    return report
+
+
+def check_bonds(system, coordinates, tolerance, report):
+    # every bond is compared with its length in the residue file in all copies of the residue
+    if not 0 <= tolerance < float('inf'):
+        raise ValueError("Bond tolerance must be a non-negative number, got {}".format(tolerance))
+
+    residue_offsets = first_residue_indices(system)
+    for (molecule_index, (molecule, counter)) in enumerate(system.molecules):
+        atoms_number = molecule.atoms_number
+        shifts = molecule.shifts
+        unshifted = {index + shifts[index]: index for index in range(0, atoms_number)}
+        template_coordinates = molecule.template.coordinates
+        atom_offset = system.atom_offset(molecule_index)
+
+        for bond in molecule.bonds:
+            (first, second) = (unshifted[bond[0]], unshifted[bond[1]])
+            expected = atoms_distance(template_coordinates, first, second)
+            residues = []
+            distances = []
+            for copy in range(0, counter):
+                copy_offset = atom_offset + copy * atoms_number
+                distance = atoms_distance(coordinates, copy_offset + first, copy_offset + second)
+                if distance > expected + tolerance or distance < expected - tolerance:
+                    residues.append(residue_offsets[molecule_index] + copy)
+                    distances.append(distance)
+
+            report.add_checked_bonds(counter)
+            if residues:
+                report.add_stretched_bonds(first, second, expected, residues, distances)
+
+
+def check_clashes(system, coordinates, clash_distance, report):
+    # atoms of different residues closer than clash_distance are in the same or neighbouring cells of a grid of that
+    # size; atoms of every cell are compared with each other and with atoms of half of its neighbours, so every pair
+    # is compared once
+    residue_ids = residue_indices(system)
+    cells = model.build_cells(coordinates, clash_distance)
+    drop_overcrowded_cells(cells, residue_ids, report)
+    limit = clash_distance ** 2
+
+    for ((x, y, z), atoms) in cells.items():
+        neighbours = [atom_index for (dx, dy, dz) in HALF_NEIGHBOUR_CELL_OFFSETS
+                      for atom_index in cells.get((x + dx, y + dy, z + dz), ())]
+        for (position, atom_index) in enumerate(atoms):
+            compare_pairs(atom_index, atoms[position + 1:] + neighbours, coordinates, residue_ids, limit, report)
+
+
+def drop_overcrowded_cells(cells, residue_ids, report):
+    # cells with atoms of more than MAX_CELL_RESIDUES residues are removed from the grid and their atoms reported
+    overcrowded = [cell for (cell, atoms) in cells.items() if len(atoms) > MAX_CELL_RESIDUES and
+                   len({residue_ids[atom_index] for atom_index in atoms}) > MAX_CELL_RESIDUES]
+    for cell in overcrowded:
+        report.add_overcrowded_atoms(len(cells.pop(cell)))
+
+
+def compare_pairs(atom_index, other_atoms, coordinates, residue_ids, limit, report):
+    # clashes of the atom with those of other_atoms which belong to other residues
+    residue = residue_ids[atom_index]
+    x, y, z = coordinates[3 * atom_index:3 * atom_index + 3]
+    clashing = []
+    distances = []
+    for other_atom in other_atoms:
+        if residue_ids[other_atom] == residue:
+            continue
+
+        offset = 3 * other_atom
+        squared_distance = ((x - coordinates[offset]) ** 2 + (y - coordinates[offset + 1]) ** 2 +
+                            (z - coordinates[offset + 2]) ** 2)
+        if squared_distance < limit:
+            clashing.append(other_atom)
+            distances.append(sqrt(squared_distance))
+
+    if clashing:
+        report.add_clashes(atom_index, residue, clashing, [residue_ids[other_atom] for other_atom in clashing],
+                           distances)
+
+
+def atoms_distance(coordinates, first, second):
+    return sqrt((coordinates[3 * first] - coordinates[3 * second]) ** 2 +
+                (coordinates[3 * first + 1] - coordinates[3 * second + 1]) ** 2 +
+                (coordinates[3 * first + 2] - coordinates[3 * second + 2]) ** 2)
+
+
+def first_residue_indices(system):
+    # index of the first copy of every residue among all residues of the system
+    result = []
+    residue_index = 0
+    for (molecule, counter) in system.molecules:
+        result.append(residue_index)
+        residue_index += counter
+
+    return result
+
+
+def residue_indices(system):
+    # global index of the residue copy of every atom
+    result = array('I')
+    residue_index = 0
+    for (molecule, counter) in system.molecules:
+        atoms_number = molecule.atoms_number
+        for _ in range(0, counter):
+            result.extend(repeat(residue_index, atoms_number))
+            residue_index += 1
+
+    return result